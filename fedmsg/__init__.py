@@ -39,8 +39,10 @@ __all__ = [
     'init',
     'send_message',
     'publish',
+    'publish_many',
     'destroy',
     'tail_messages',
+    'tail_batches',
     '__local',
 ]
 
@@ -100,6 +102,11 @@ def publish(topic=None, msg=None, **kw):
     return __local.__context.publish(topic, msg, **kw)
 
 
+@API_function(doc=fedmsg.core.FedMsgContext.publish_many.__doc__)
+def publish_many(messages=None, **kw):
+    return __local.__context.publish_many(messages, **kw)
+
+
 # This is old-school, and deprecated.
 send_message = publish
 
@@ -115,3 +122,9 @@ def destroy(**kw):
 def tail_messages(**kw):
     for item in __local.__context.tail_messages(**kw):
         yield item
+
+
+@API_function(doc=fedmsg.core.FedMsgContext.tail_batches.__doc__)
+def tail_batches(**kw):
+    for batch in __local.__context.tail_batches(**kw):
+        yield batch
@@ -0,0 +1,461 @@
+# This file is part of fedmsg.
+# Copyright (C) 2012 - 2014 Red Hat, Inc.
+#
+# fedmsg is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# fedmsg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with fedmsg; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+""" An asyncio flavour of the fedmsg API, built on :mod:`zmq.asyncio`.
+
+This mirrors the functions of :mod:`fedmsg`, but publishing is awaited and
+subscribing is an asynchronous generator::
+
+    import fedmsg.aio
+
+    async def main():
+        await fedmsg.aio.init(name='myapp.myhost')
+        await fedmsg.aio.publish(topic='testing', msg={'hello': 'world'})
+
+        async for name, endpoint, topic, msg in fedmsg.aio.tail_messages():
+            print(topic, msg)
+
+:func:`tail_batches` is there too, for consumers that work in bulk.
+
+Signing, the ``persistent_store``, signature validation and replay all
+block, so they run in an executor instead of on the event loop.  Everything
+else happens on the loop.
+
+This module needs Python 3.7 or later.  The :ref:`conf-publish-async`,
+:ref:`conf-shared-publisher` and :ref:`conf-spool-directory` settings don't
+apply here and are ignored.
+"""
+
+import asyncio
+import time
+import warnings
+
+import zmq
+import zmq.asyncio
+
+import fedmsg.config
+import fedmsg.encoding
+from fedmsg.core import (
+    FedMsgContext, ValidationError, _prefixes, _time_ns, _trace_frame)
+from fedmsg.utils import guess_calling_module
+
+__all__ = [
+    'AioFedMsgContext',
+    'init',
+    'publish',
+    'publish_many',
+    'destroy',
+    'tail_messages',
+    'tail_batches',
+]
+
+
+class AioFedMsgContext(FedMsgContext):
+    """
+    A :class:`fedmsg.core.FedMsgContext` whose sockets live on an asyncio
+    event loop.
+
+    :meth:`publish` and :meth:`publish_many` are coroutines and
+    :meth:`tail_messages` and :meth:`tail_batches` are asynchronous
+    generators.  The blocking work is
+    handed to :attr:`executor`, which is the loop's default executor unless
+    you set it to something else.
+    """
+
+    #: The :class:`concurrent.futures.Executor` to run blocking work in.
+    #: ``None`` means the event loop's default executor.
+    executor = None
+
+    def __init__(self, **config):
+        if not config.get('zmq_enabled', True):
+            raise ValueError("fedmsg.aio is only available for zeromq.")
+
+        self._monitor = None
+        self._waited = True
+        self._sync_context = None
+        super(AioFedMsgContext, self).__init__(**config)
+
+    def _init_sockets(self):
+        method = ['bind', 'connect'][self.c['active']]
+        # The spool needs a thread of its own; there is none here.
+        self._spool = None
+
+        self.context = zmq.asyncio.Context(self.c['io_threads'])
+        self._monitor = self._setup_publisher(method)
+        self._setup_lanes(method)
+
+        # We can't wait for a peer here without blocking the loop, so
+        # :meth:`ready` does it before the first message goes out.
+        self._waited = not getattr(self, 'publisher', None)
+
+    async def ready(self):
+        """ Wait until a peer reaches our publisher, like :func:`fedmsg.init`
+        does.
+
+        This waits up to :ref:`conf-post-init-sleep` seconds, once.  The first
+        :meth:`publish` calls it for you.
+        """
+        if self._waited:
+            return
+        self._waited = True
+
+        monitor, self._monitor = self._monitor, None
+        timeout = self.c['post_init_sleep']
+        if self._waits_for_subscription():
+            if await self.publisher.poll(timeout * 1000):
+                self.log.debug("publisher has a subscriber")
+            else:
+                self.log.debug("nobody subscribed to the publisher in %ss" % timeout)
+            self._read_subscriptions()
+            return
+
+        if monitor is None:
+            await asyncio.sleep(timeout)
+            return
+
+        try:
+            if await monitor.poll(timeout * 1000):
+                self.log.debug("publisher has a peer")
+            else:
+                self.log.debug("no peer reached the publisher in %ss" % timeout)
+        finally:
+            self._close_monitor(monitor)
+
+    def destroy(self):
+        """ Destroy a fedmsg context """
+        if self._monitor is not None:
+            self._close_monitor(self._monitor)
+            self._monitor = None
+
+        super(AioFedMsgContext, self).destroy()
+
+        if self._sync_context is not None:
+            self._sync_context.term()
+            self._sync_context = None
+
+    async def publish(self, topic=None, msg=None, modname=None,
+                      pre_fire_hook=None, **kw):
+        """ Send a message over the publishing zeromq socket.
+
+        This is the coroutine version of
+        :meth:`fedmsg.core.FedMsgContext.publish` and takes the same
+        arguments.
+        """
+        modname = modname or self.c.get('default_modname') or \
+            guess_calling_module(default="fedmsg")
+
+        await self.publisher_for(modname).publish(topic, msg, pre_fire_hook)
+
+    async def publish_many(self, messages, pre_fire_hook=None, **kw):
+        """ Send a batch of messages over the publishing zeromq socket.
+
+        This is the coroutine version of
+        :meth:`fedmsg.core.FedMsgContext.publish_many` and takes the same
+        arguments.
+        """
+        batch = self._envelopes(messages)
+        await self._dispatch(batch, pre_fire_hook)
+        return len(batch)
+
+    def _dispatch(self, batch, pre_fire_hook=None):
+        self._check_fork()
+        return self._process_async(
+            self._with_summaries(batch), pre_fire_hook)
+
+    async def _process_async(self, batch, pre_fire_hook=None):
+        await self.ready()
+
+        batch = self._filter(batch)
+        if not batch:
+            return
+
+        msgs = [msg for _, msg in batch]
+        if self.c.get('sign_messages', False) or \
+                self.c.get('persistent_store', None) or \
+                self.c.get('blob_store', None):
+            loop = asyncio.get_running_loop()
+            if len(msgs) == 1:
+                msgs = [await loop.run_in_executor(
+                    self.executor, self._sign_and_store, msgs[0])]
+            else:
+                msgs = await loop.run_in_executor(
+                    self.executor, self._sign_and_store_many, msgs)
+
+        for (topic, _), msg in zip(batch, msgs):
+            if pre_fire_hook:
+                pre_fire_hook(msg)
+            await self._send_async(topic, msg)
+
+    async def _send_async(self, topic, msg):
+        with self._stats.time('encode'):
+            payload = fedmsg.encoding.dumps(msg).encode('utf-8')
+
+        sock = self._socket_for(topic)
+        frames = [topic, payload]
+        if self._trace:
+            frames.append(_trace_frame(
+                [['publish', self.hostname, _time_ns()]]))
+        with self._stats.time('send'):
+            await sock.send_multipart(frames)
+
+        budget = self._budgets.get(sock)
+        if budget is not None:
+            budget.add(len(payload))
+
+        self._stats.add_message(msg['topic'], len(payload))
+
+    async def tail_messages(self, topic="", passive=False, **kw):
+        """
+        Subscribe to messages published on the sockets listed in
+        :ref:`conf-endpoints`.
+
+        This is the asynchronous generator version of
+        :meth:`fedmsg.core.FedMsgContext.tail_messages` and takes the same
+        arguments.  Signature validation and replay run in :attr:`executor`.
+
+        Yields:
+            tuple: A 4-tuple in the form (name, endpoint, topic, message).
+        """
+        subs = self._create_subs(topic=topic, passive=passive, **kw)
+        poller = zmq.asyncio.Poller()
+        for subscriber in subs:
+            poller.register(subscriber, zmq.POLLIN)
+
+        # Messages of high priority lanes go first.
+        priorities = self._priorities(subs)
+
+        watched_names = self._watched_names(subs)
+
+        # Gaps in ``i`` only mean something when we get every topic.
+        track_loss = '' in _prefixes(topic)
+
+        try:
+            while True:
+                ready = [s for s, _ in await poller.poll()]
+                for s in sorted(ready, key=priorities.get, reverse=True):
+                    for result in await self._receive(s, subs, watched_names):
+                        if track_loss and result[1]:
+                            self._loss.add(result[1], result[3])
+                        yield result
+        finally:
+            self._close_subs(subs)
+
+    async def tail_batches(self, topic="", passive=False, max_batch=100,
+                           max_latency=0.1, **kw):
+        """
+        Like :meth:`tail_messages`, but yield lists of messages.
+
+        This is the asynchronous generator version of
+        :meth:`fedmsg.core.FedMsgContext.tail_batches` and takes the same
+        arguments.
+
+        Yields:
+            list: Lists of one to ``max_batch`` 4-tuples in the form
+            (name, endpoint, topic, message).
+        """
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1, not %r" % max_batch)
+
+        subs = self._create_subs(topic=topic, passive=passive, **kw)
+        poller = zmq.asyncio.Poller()
+        for subscriber in subs:
+            poller.register(subscriber, zmq.POLLIN)
+
+        priorities = self._priorities(subs)
+        watched_names = self._watched_names(subs)
+        track_loss = '' in _prefixes(topic)
+
+        batch, deadline = [], None
+        try:
+            while True:
+                if batch:
+                    timeout = max(0, deadline - time.time()) * 1000
+                else:
+                    timeout = None
+                ready = [s for s, _ in await poller.poll(timeout)]
+
+                for s in sorted(ready, key=priorities.get, reverse=True):
+                    # Take what's queued on this socket, but leave the
+                    # others their turn.
+                    for _ in range(max_batch):
+                        try:
+                            results = await self._receive(
+                                s, subs, watched_names, zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        for result in results:
+                            if track_loss and result[1]:
+                                self._loss.add(result[1], result[3])
+                        batch.extend(results)
+
+                if batch and deadline is None:
+                    deadline = time.time() + max_latency
+
+                while len(batch) >= max_batch:
+                    yield batch[:max_batch]
+                    batch = batch[max_batch:]
+                if batch and time.time() >= deadline:
+                    yield batch
+                    batch = []
+                if not batch:
+                    deadline = None
+        finally:
+            self._close_subs(subs)
+
+    async def _receive(self, sock, subs, watched_names, flags=0):
+        """ Receive from ``sock`` and return the messages that came with it.
+        """
+        name, ep = subs[sock]
+        copy = sock not in self._peers
+        frames = await sock.recv_multipart(flags, copy=copy)
+        name, ep = self._attribute(sock, frames, name, ep)
+        if not copy:
+            frames = [frame.bytes for frame in frames]
+        self._count_received(sock, frames)
+
+        # Only leave the loop for the work that would block it.
+        blocking = self.c.get('validate_signatures', False) or \
+            len(self.c.get('replay_endpoints', {})) > 0
+
+        results = []
+        for pair in self._unpack_traced(frames):
+            try:
+                if blocking:
+                    result = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, self._handle_frames,
+                        pair, name, ep, watched_names)
+                else:
+                    result = self._handle_frames(pair, name, ep, watched_names)
+            except ValidationError as e:
+                warnings.warn("!! invalid message received: %r" % e.msg)
+                continue
+            results.append(result)
+        return results
+
+    def _schedule_summaries(self):
+        # The loop, rather than a thread, is what may use our sockets.
+        if self._summary_timer is not None:
+            return
+        due = self._limiter.next_summary()
+        if due is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not publishing from the loop; the next message takes it along.
+            return
+
+        self._summary_timer = loop.call_later(
+            max(0, due - self._limiter.clock()), self._send_summaries)
+
+    def _send_summaries(self):
+        self._summary_timer = None
+        if not getattr(self, 'publisher', None):
+            return
+        asyncio.ensure_future(self._dispatch([]))
+        self._schedule_summaries()
+
+    def _flush_summaries(self, force=False):
+        # destroy() can't wait for the loop, so this sends the blocking way,
+        # through plain sockets sharing ours.
+        for topic, msg in self._prepare(self._with_summaries([], force)):
+            payload = fedmsg.encoding.dumps(msg).encode('utf-8')
+            sock = zmq.Socket.shadow(self._socket_for(topic).underlying)
+            sock.send_multipart([topic, payload], flags=zmq.NOBLOCK)
+
+    def _replay_context(self):
+        # Replay queries run in the executor with blocking sockets, which
+        # need a context of their own.
+        if self._sync_context is None:
+            self._sync_context = zmq.Context()
+        return self._sync_context
+
+
+_context = None
+
+
+async def init(**kw):
+    """ Initialize an instance of :class:`AioFedMsgContext`.
+
+    This is the coroutine version of :func:`fedmsg.init`.  The context is
+    shared by every task of the process and waits for a peer before it is
+    returned.
+    """
+    global _context
+
+    if _context is not None:
+        raise ValueError("fedmsg.aio already initialized")
+
+    # Read config from CLI args and a config file
+    config = fedmsg.config.load_config([], None)
+
+    # Override the defaults with whatever the user explicitly passes in.
+    config.update(kw)
+
+    context = AioFedMsgContext(**config)
+    await context.ready()
+    _context = context
+    return _context
+
+
+async def _get_context(**kw):
+    if _context is None:
+        await init(**kw)
+    return _context
+
+
+async def publish(topic=None, msg=None, modname=None, pre_fire_hook=None,
+                  **kw):
+    """ Send a message; see :meth:`AioFedMsgContext.publish`. """
+    context = await _get_context(**kw)
+    await context.publish(topic, msg, modname=modname,
+                          pre_fire_hook=pre_fire_hook)
+
+
+async def publish_many(messages=None, pre_fire_hook=None, **kw):
+    """ Send a batch of messages; see :meth:`AioFedMsgContext.publish_many`.
+    """
+    context = await _get_context(**kw)
+    return await context.publish_many(messages, pre_fire_hook=pre_fire_hook)
+
+
+def destroy():
+    """ Destroy the context created by :func:`init`, if there is one. """
+    global _context
+
+    if _context is not None:
+        _context.destroy()
+        _context = None
+
+
+async def tail_messages(topic="", passive=False, **kw):
+    """ Subscribe to messages; see :meth:`AioFedMsgContext.tail_messages`. """
+    context = await _get_context(**kw)
+    async for item in context.tail_messages(topic=topic, passive=passive):
+        yield item
+
+
+async def tail_batches(topic="", passive=False, max_batch=100,
+                       max_latency=0.1, **kw):
+    """ Subscribe to messages in bulk; see
+    :meth:`AioFedMsgContext.tail_batches`.
+    """
+    context = await _get_context(**kw)
+    async for batch in context.tail_batches(
+            topic=topic, passive=passive, max_batch=max_batch,
+            max_latency=max_latency):
+        yield batch
@@ -0,0 +1,184 @@
+# This file is part of fedmsg.
+# Copyright (C) 2012 - 2014 Red Hat, Inc.
+#
+# fedmsg is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# fedmsg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with fedmsg; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+""" Moving large message fields out of band, see :ref:`conf-blob-store`.
+
+A publisher with a ``blob_store`` puts every field of ``msg`` whose JSON
+encoding is bigger than ``blob_threshold`` bytes in the store and sends a
+reference in its place::
+
+    {"$blob": "sha256:9f86d0...", "size": 1048576}
+
+The reference is what gets signed, so signatures hold whether or not anybody
+ever fetches the field.  Subscribers with the same store get a
+:class:`LazyBody` as ``msg``, which fetches the fields the first time they
+are looked up.
+
+A store is any object with ``put(data)``, returning the digest of ``data``,
+and ``get(digest)``, returning the data.  :class:`DirectoryBlobStore` keeps
+them in a directory, which may well be shared over NFS.
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+
+import fedmsg.encoding
+
+
+class DirectoryBlobStore(object):
+    """ A content-addressed store of blobs in ``directory``. """
+
+    algorithm = 'sha256'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, digest):
+        algorithm, _, value = digest.partition(':')
+        if algorithm != self.algorithm or len(value) < 3 or \
+                not all(c in '0123456789abcdef' for c in value):
+            raise ValueError("not a %s digest: %r" % (self.algorithm, digest))
+        return os.path.join(self.directory, value[:2], value[2:])
+
+    def put(self, data):
+        """ Store ``data`` (bytes) and return its digest. """
+        digest = '%s:%s' % (
+            self.algorithm, hashlib.new(self.algorithm, data).hexdigest())
+        path = self._path(digest)
+        if os.path.exists(path):
+            return digest
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Write elsewhere and rename, so that readers never see half a blob.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except:  # noqa: E722
+            os.unlink(tmp)
+            raise
+        return digest
+
+    def get(self, digest):
+        """ Return the data stored under ``digest``.
+
+        Raises ``KeyError`` if there is no such blob, and ``ValueError`` if
+        what is there doesn't match the digest.
+        """
+        try:
+            with open(self._path(digest), 'rb') as f:
+                data = f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(digest)
+            raise
+
+        algorithm, _, value = digest.partition(':')
+        if hashlib.new(algorithm, data).hexdigest() != value:
+            raise ValueError("blob %s is corrupt" % digest)
+        return data
+
+
+def is_reference(value):
+    """ Return whether ``value`` stands for a field moved to a blob store. """
+    return isinstance(value, dict) and '$blob' in value
+
+
+def offload(body, store, threshold):
+    """ Return ``body`` with its fields bigger than ``threshold`` bytes moved
+    to ``store``.
+
+    ``body`` itself is left alone.  Anything that isn't a dict is returned
+    as it is.
+    """
+    if not isinstance(body, dict):
+        return body
+
+    # No field can be bigger than the whole body, which is all most
+    # messages need to be measured by.
+    if len(fedmsg.encoding.dumps(body).encode('utf-8')) <= threshold:
+        return body
+
+    result = None
+    for key, value in body.items():
+        if is_reference(value):
+            continue
+        data = fedmsg.encoding.dumps(value).encode('utf-8')
+        if len(data) <= threshold:
+            continue
+        if result is None:
+            result = dict(body)
+        result[key] = {'$blob': store.put(data), 'size': len(data)}
+
+    return body if result is None else result
+
+
+def fetch(store, reference):
+    """ Return the value ``reference`` stands for. """
+    return fedmsg.encoding.loads(store.get(reference['$blob']).decode('utf-8'))
+
+
+class LazyBody(dict):
+    """ A message body whose offloaded fields are fetched on first access.
+
+    Indexing and :meth:`get` return the real values.  Everything else,
+    including :meth:`items` and encoding the body to JSON, sees the
+    references, just like the signature does.  Use :meth:`resolve` for a
+    plain dict of the real values.
+    """
+
+    def __init__(self, body, store):
+        super(LazyBody, self).__init__(body)
+        self.store = store
+        self._fetched = {}
+
+    def __getitem__(self, key):
+        value = super(LazyBody, self).__getitem__(key)
+        if not is_reference(value):
+            return value
+        if key not in self._fetched:
+            self._fetched[key] = fetch(self.store, value)
+        return self._fetched[key]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def resolve(self):
+        """ Return a plain dict with every offloaded field fetched. """
+        return dict((key, self[key]) for key in self)
+
+
+def wrap(msg, store):
+    """ Make the offloaded fields of the body of ``msg`` lazy, in place.
+
+    Returns ``msg``.
+    """
+    body = msg.get('msg')
+    if isinstance(body, dict) and not isinstance(body, LazyBody) and \
+            any(is_reference(value) for value in body.values()):
+        msg['msg'] = LazyBody(body, store)
+    return msg
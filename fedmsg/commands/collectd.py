@@ -23,6 +23,7 @@ import time
 
 import fedmsg
 import fedmsg.meta
+import fedmsg.utils
 
 from fedmsg.commands import BaseCommand
 from fedmsg.consumers import FedmsgConsumer
@@ -102,8 +103,7 @@ class CollectdCommand(BaseCommand):
         moksha_options = dict(
             mute=True,  # Disable some warnings.
             zmq_subscribe_endpoints=','.join(
-                ','.join(bunch) for bunch in self.config['endpoints'].values()
-            ),
+                fedmsg.utils.subscription_endpoints(self.config)),
         )
         self.config.update(moksha_options)
         self.config[CollectdConsumer.config_key] = True
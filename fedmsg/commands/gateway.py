@@ -22,6 +22,7 @@
 
 from fedmsg.commands import BaseCommand
 from fedmsg.consumers.gateway import GatewayConsumer
+from fedmsg.utils import subscription_endpoints
 
 
 class GatewayCommand(BaseCommand):
@@ -46,15 +47,18 @@ class GatewayCommand(BaseCommand):
         # to work with moksha's expected configuration.
         moksha_options = dict(
             zmq_subscribe_endpoints=','.join(
-                ','.join(bunch) for bunch in
-                self.config['endpoints'].values()
-            ),
+                subscription_endpoints(self.config)),
         )
         self.config.update(moksha_options)
 
         # Flip the special bit that allows the GatewayConsumer to run
         self.config[GatewayConsumer.config_key] = True
 
+        if self.config.get('publish_trace'):
+            # Take the trace frames of traced publishers and send them on.
+            from fedmsg.consumers.zeromq import install
+            install()
+
         from moksha.hub import main
         main(
             # Pass in our config dict
@@ -20,7 +20,7 @@
 from gettext import gettext as _
 import resource
 
-from fedmsg.utils import load_class
+from fedmsg.utils import load_class, subscription_endpoints
 from fedmsg.commands import BaseCommand
 
 
@@ -81,11 +81,15 @@ class HubCommand(BaseCommand):
         if self.config.get('zmq_enabled', True):
             moksha_options = dict(
                 zmq_subscribe_endpoints=','.join(
-                    ','.join(bunch) for bunch in self.config['endpoints'].values()
-                ),
+                    subscription_endpoints(self.config)),
             )
             self.config.update(moksha_options)
 
+            if self.config.get('publish_trace'):
+                # Take the trace frames of traced publishers.
+                from fedmsg.consumers.zeromq import install
+                install()
+
         self.set_rlimit_nofiles()
 
         # Note that the hub we kick off here cannot send any message.  You
@@ -28,6 +28,7 @@ Think of it like a one-way firehose that spews fedmsg messages to IRC.
 
 from fedmsg.commands import BaseCommand
 from fedmsg.consumers.ircbot import IRCBotConsumer
+from fedmsg.utils import subscription_endpoints
 
 
 class IRCCommand(BaseCommand):
@@ -44,8 +45,7 @@ class IRCCommand(BaseCommand):
         # work with moksha's expected configuration.
         moksha_options = dict(
             zmq_subscribe_endpoints=','.join(
-                ','.join(bunch) for bunch in self.config['endpoints'].values()
-            ),
+                subscription_endpoints(self.config)),
         )
         self.config.update(moksha_options)
 
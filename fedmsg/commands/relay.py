@@ -27,6 +27,7 @@ from moksha.hub.monitoring import MonitoringProducer
 
 from fedmsg.commands import BaseCommand
 from fedmsg.consumers.relay import RelayConsumer, SigningRelayConsumer
+from fedmsg.consumers.zeromq import install
 
 from kitchen.iterutils import iterate
 
@@ -62,6 +63,10 @@ class RelayCommand(BaseCommand):
         # Flip the special bit that allows the RelayConsumer to run
         self.config[self.relay_consumer.config_key] = True
 
+        if self.config.get('publish_trace'):
+            # Take the trace frames of traced publishers and send them on.
+            install()
+
         for publish_endpoint in self.config['endpoints']['relay_outbound']:
             self.config['zmq_publish_endpoints'] = publish_endpoint
             try:
@@ -30,7 +30,7 @@ import fedmsg
 import fedmsg.encoding
 import fedmsg.meta
 from fedmsg.commands import BaseCommand
-from fedmsg.utils import cowsay_output
+from fedmsg.utils import cowsay_output, topic_prefixes
 
 
 class TailCommand(BaseCommand):
@@ -40,8 +40,11 @@ class TailCommand(BaseCommand):
     extra_args = [
         (['--topic'], {
             'dest': 'topic',
-            'help': 'The topic pattern to listen for.  Everything by default.',
-            'default': '',
+            'metavar': 'PREFIX',
+            'help': 'A topic prefix to listen for; give it more than once for '
+            'more.  Everything by default.',
+            'action': 'append',
+            'default': None,
         }),
         (['--query'], {
             'dest': 'query',
@@ -131,6 +134,15 @@ class TailCommand(BaseCommand):
         # about having no publishing sockets established.
         self.config['mute'] = True
 
+        # Build regular expressions for use in our loop.  A bad one is
+        # reported before anything is derived from it.
+        exclusive_regexp = re.compile(self.config['exclusive_regexp'])
+        inclusive_regexp = re.compile(self.config['inclusive_regexp'])
+
+        # Have the publishers drop what --include would, where we can tell.
+        self.config['topic'] = topic_prefixes(
+            self.config['inclusive_regexp'], self.config['topic'])
+
         fedmsg.init(**self.config)
 
         # Build a message formatter
@@ -168,10 +180,6 @@ class TailCommand(BaseCommand):
                     format_ = "\n" + result
             return format_
 
-        # Build regular expressions for use in our loop.
-        exclusive_regexp = re.compile(self.config['exclusive_regexp'])
-        inclusive_regexp = re.compile(self.config['inclusive_regexp'])
-
         # Build username and package filter sets for use in our loop.
         users, packages = set(), set()
         if self.config['users']:
@@ -184,7 +192,7 @@ class TailCommand(BaseCommand):
             fedmsg.meta.make_processors(**self.config)
 
         # Spin up a zmq.Poller and yield messages
-        for name, ep, topic, message in fedmsg.tail_messages(**self.config):
+        for name, ep, topic, message in fedmsg.tail_messages(lazy=True, **self.config):
             if exclusive_regexp.search(topic):
                 continue
 
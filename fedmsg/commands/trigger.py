@@ -26,6 +26,7 @@ from six.moves import queue
 import fedmsg
 import fedmsg.encoding
 from fedmsg.commands import BaseCommand
+from fedmsg.utils import topic_prefixes
 
 
 class TriggerCommand(BaseCommand):
@@ -38,8 +39,11 @@ class TriggerCommand(BaseCommand):
     extra_args = [
         (['--topic'], {
             'dest': 'topic',
-            'help': 'The topic pattern to listen for.  Everything by default.',
-            'default': '',
+            'metavar': 'PREFIX',
+            'help': 'A topic prefix to listen for; give it more than once for '
+            'more.  Everything by default.',
+            'action': 'append',
+            'default': None,
         }),
         (['--exclude'], {
             'dest': 'exclusive_regexp',
@@ -101,11 +105,15 @@ class TriggerCommand(BaseCommand):
         # about having no publishing sockets established.
         self.config['mute'] = True
 
-        fedmsg.init(**self.config)
-
         exclusive_regexp = re.compile(self.config['exclusive_regexp'])
         inclusive_regexp = re.compile(self.config['inclusive_regexp'])
 
+        # Have the publishers drop what --include would, where we can tell.
+        self.config['topic'] = topic_prefixes(
+            self.config['inclusive_regexp'], self.config['topic'])
+
+        fedmsg.init(**self.config)
+
         wait_for = int(self.config['wait_for'])
         max_queue_size = int(self.config['max_queue_size'])
 
@@ -122,7 +130,7 @@ class TriggerCommand(BaseCommand):
                     self.log.info("Command returned error code %r" % result)
 
         try:
-            for name, ep, topic, message in fedmsg.tail_messages(**self.config):
+            for name, ep, topic, message in fedmsg.tail_messages(lazy=True, **self.config):
                 if exclusive_regexp.search(topic):
                     continue
 
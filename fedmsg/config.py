@@ -70,6 +70,17 @@ infrastructure.  It is used by :func:`fedmsg.publish` when it is
 constructing a fully-qualified topic.
 
 
+.. _conf-default-modname:
+
+default_modname
+---------------
+A string used as the ``modname`` part of the topic when
+:func:`fedmsg.publish` is called without an explicit ``modname``.  When this
+is not set, fedmsg guesses the name of the calling module from the call stack.
+
+The default value is ``None``.
+
+
 .. _conf-status-directory:
 
 status_directory
@@ -99,6 +110,236 @@ Upon restart skip the message that we worked on previously.
 This is an attempt to have the processing of the queue resume at
 the expense of droppin a message and possibly not awarding a badge.
 
+
+.. _conf-publish-async:
+
+publish_async
+-------------
+A boolean that, if ``True``, makes :func:`fedmsg.publish` return as soon as
+the message is built.  Signing, adding the message to the persistent store and
+sending it are done by a background thread.  Use
+:meth:`fedmsg.core.FedMsgContext.flush` to wait for queued messages to go
+out; :func:`fedmsg.destroy` does this for you.
+
+Errors raised while signing, storing or sending a queued message are logged
+rather than raised to the caller.
+
+The default value is ``False``.
+
+
+.. _conf-publish-queue-size:
+
+publish_queue_size
+------------------
+``int`` - The maximum number of publish calls waiting in the background queue
+when `publish_async`_ is enabled.  ``0`` means no limit.
+
+The default value is ``1000``.
+
+
+.. _conf-publish-queue-overflow:
+
+publish_queue_overflow
+----------------------
+What to do when the background queue of `publish_async`_ is full.  One of
+``block`` (wait for room), ``drop-oldest`` (discard the oldest queued
+messages) or ``drop-newest`` (discard the message being published).  Dropped
+messages are counted by :meth:`fedmsg.core.FedMsgContext.queue_stats`.
+
+The default value is ``block``.
+
+
+.. _conf-publish-stats:
+
+publish_stats
+-------------
+A boolean that, if ``True``, makes the publishing context count the messages
+and bytes it sends, per topic, and time each stage of
+:func:`fedmsg.publish`.  See :meth:`fedmsg.core.FedMsgContext.stats`.
+
+The default value is ``False``.
+
+
+.. _conf-publish-stats-callback:
+
+publish_stats_callback
+----------------------
+A callable that, when `publish_stats`_ is enabled, is called with the output
+of :meth:`fedmsg.core.FedMsgContext.stats` at most once every
+`publish_stats_interval`_ seconds, right after a message is sent.  Use it to
+export the numbers to a monitoring system.
+
+The default value is ``None``.
+
+
+.. _conf-publish-stats-interval:
+
+publish_stats_interval
+----------------------
+``float`` - The minimum number of seconds between two calls of
+`publish_stats_callback`_.
+
+The default value is ``60``.
+
+
+.. _conf-publish-coalesce:
+
+publish_coalesce
+----------------
+A boolean that, if ``True``, packs messages sent together on the same topic
+into a single zeromq multipart message: one topic frame followed by one frame
+per message body.  Subscribers pay one frame and one topic match for the
+whole group.  :meth:`fedmsg.core.FedMsgContext.publish_many` batches are
+coalesced as they are; with `publish_async`_ enabled, messages published
+within `publish_coalesce_linger`_ of each other are coalesced as well.
+
+:meth:`fedmsg.core.FedMsgContext.tail_messages` unpacks these groups and
+yields their messages one by one.  So do the ``fedmsg-hub``, ``fedmsg-relay``
+and ``fedmsg-gateway`` when `publish_trace`_ is enabled in their
+configuration; the relay and the gateway then send the messages on one by
+one.  Without it, moksha hub consumers don't understand these groups, and
+neither do older fedmsg releases.  Only turn this on for endpoints whose
+subscribers all use ``tail_messages`` or have `publish_trace`_ enabled.
+
+The default value is ``False``.
+
+
+.. _conf-publish-coalesce-linger:
+
+publish_coalesce_linger
+-----------------------
+``float`` - When both `publish_coalesce`_ and `publish_async`_ are enabled,
+the number of seconds the background thread keeps collecting queued messages
+before sending what it has.
+
+The default value is ``0.005``.
+
+
+.. _conf-publish-trace:
+
+publish_trace
+-------------
+A boolean that, if ``True``, has the publisher follow each message body with
+a trace frame, holding the host and the time in nanoseconds at which it was
+sent.  The frame is not part of the message, so signatures don't cover it
+and stores don't keep it.  :meth:`fedmsg.core.FedMsgContext.tail_messages`
+stamps the time each traced message arrived and
+:meth:`fedmsg.core.FedMsgContext.latency_stats` has the resulting histograms.
+
+The ``fedmsg-hub``, ``fedmsg-relay`` and ``fedmsg-gateway`` only take trace
+frames when this is enabled in their own configuration too; they then swap
+moksha's zeromq extension for
+:class:`fedmsg.consumers.zeromq.TracingZMQHubExtension`.  The relay and the
+gateway add a ``relay`` or ``gateway`` stamp and send the trace on, so a
+message that went through the relay ends up with ``publish->relay`` and
+``relay->receive`` histograms.  The consumers of the ``fedmsg-hub`` add a
+``consume`` stamp and keep their own histograms in ``latency_stats`` (see
+:class:`fedmsg.consumers.FedmsgConsumer`).  Hubs without it, and older fedmsg
+releases, take exactly two frames per message and drop the rest, so only
+turn this on for publishers once every hub, relay and gateway subscribed to
+their endpoints has it on as well.
+
+The default value is ``False``.
+
+
+.. _conf-publish-lazy:
+
+publish_lazy
+------------
+A boolean that, if ``True``, makes the publisher an XPUB socket that keeps
+track of what its subscribers subscribed to.  Messages no connected
+subscriber would receive are dropped before they are signed, added to the
+persistent store or encoded; :meth:`fedmsg.core.FedMsgContext.stats` counts
+them as ``skipped``.
+
+Skipped messages never make it to the persistent store, so they can't be
+replayed later either.  This has no effect when publishing to the
+``fedmsg-relay`` (which subscribes to everything) or through a
+`shared_publisher`_.
+
+The default value is ``False``.
+
+
+.. _conf-blob-store:
+
+blob_store
+----------
+An object that, if set, takes the fields of outgoing messages that are
+bigger than `blob_threshold`_ so that only a reference to them goes over the
+bus, is signed and is stored.  Subscribers with the same store fetch a field
+the first time they look it up.  The default value is ``None``.
+
+Any object with ``put(data)`` and ``get(digest)`` methods will do; see
+:mod:`fedmsg.blobs`.  To share a directory between publishers and
+subscribers::
+
+    import fedmsg.blobs
+    config = dict(
+        blob_store=fedmsg.blobs.DirectoryBlobStore('/srv/fedmsg/blobs'),
+    )
+
+Subscribers without a store get the references as they are.
+
+
+.. _conf-blob-threshold:
+
+blob_threshold
+--------------
+``int`` - The size, in bytes of JSON, above which a field of ``msg`` goes to
+the `blob_store`_.  Only the top level fields of ``msg`` are considered.
+
+The default value is ``65536``.
+
+
+.. _conf-msg-id-format:
+
+msg_id_format
+-------------
+``str`` - How the ``msg_id`` of outgoing messages is made.  Either way it is
+the year, a dash and a UUID, e.g.
+``2017-0158d3a5-6b2f-7c01-9a3e-5d1e8c2f4b7a``.
+
+``random``, the default, uses a random (version 4) UUID.  ``time-ordered``
+uses a version 7 UUID, which starts with the time in milliseconds and counts
+up within a millisecond, so the ids of a publisher sort in the order its
+messages were sent.  Stores indexing messages by ``msg_id``, like the
+:class:`fedmsg.replay.sqlstore.SqlStore`, then append to their index instead
+of inserting all over it, and ranges of ids are ranges of time; see the
+``msg_id_range`` query of :func:`fedmsg.replay.get_replay`.
+
+
+.. _conf-publish-rate-limits:
+
+publish_rate_limits
+-------------------
+``dict`` - Rate limits on what a publishing context sends.  Each key is a
+pattern matched against fully qualified topics with
+:func:`fnmatch.fnmatchcase`, e.g. ``'*.logger.*'`` for everything published
+with the ``logger`` modname.
+When several patterns match a topic, the longest one applies.  Each value is
+a dict with:
+
+``rate``
+    The number of messages per second the topics of the pattern may send,
+    together, on average.
+``burst``
+    How many messages may be sent at once after a quiet period.  Defaults
+    to ``rate``, and to at least ``1``.
+``action``
+    What to do with the messages over the rate.  ``drop`` discards them.
+    ``sample`` publishes one out of every ``sample`` of them (default ``10``)
+    and discards the others.  ``summarize`` discards them, but counts them
+    by topic; once ``interval`` seconds (default ``60``) have passed since
+    the first one, a ``fedmsg.rate_limit.summary`` message with these counts
+    is sent, whether or not anything else is published by then.
+    :func:`fedmsg.destroy` sends the summaries still pending.  Defaults to
+    ``drop``.
+
+Messages are held back before they are numbered, signed or queued.  See
+:meth:`fedmsg.core.FedMsgContext.rate_limit_stats` for the counters.
+
+The default value is ``{}``, which doesn't limit anything.
+
 .. _conf-endpoints:
 
 endpoints
@@ -160,6 +401,116 @@ app01.phx2.fedoraproject.org.
    "service key".  It is not always consistent in :mod:`fedmsg.core`.
 
 
+.. _conf-ipc-endpoints:
+
+ipc_endpoints
+-------------
+``dict`` - A mapping of service keys, the same as for `endpoints`_, to lists
+of ``ipc://`` endpoints paired, in order, with their `endpoints`_.  A
+publisher that binds to one of its endpoints also binds to its twin, and
+subscribers on the same host connect to the twin instead, sparing both
+sides the TCP stack.  The default is ``{}``.
+
+  >>> config = dict(
+  ...     ipc_endpoints={
+  ...         "bodhi.app01":  [
+  ...               "ipc:///var/run/fedmsg/bodhi.app01-3000",
+  ...               "ipc:///var/run/fedmsg/bodhi.app01-3001",
+  ...               "ipc:///var/run/fedmsg/bodhi.app01-3002",
+  ...               "ipc:///var/run/fedmsg/bodhi.app01-3003",
+  ...         ],
+  ...     },
+  ... )
+
+A subscriber takes a publisher to be on its host when the host of the
+endpoint resolves to a loopback address or to an address of the
+subscriber's own hostname.  These hosts are looked up together with the
+others, through the `dns_cache`_.  This applies to
+:func:`fedmsg.tail_messages` and to the ``fedmsg-hub`` family of commands;
+the socket files must be readable and writable by both sides.
+
+
+.. _conf-endpoint-lease-dir:
+
+endpoint_lease_dir
+------------------
+``str`` - A directory where publishers on this host keep lock files for the
+endpoints they have bound, e.g. ``/run/fedmsg``.  It must be writable by every
+process using fedmsg.
+
+When set, a process that binds its publishing socket claims an endpoint
+by taking a lock on its file first, starting from an entry picked by its
+pid.  This saves the workers of a prefork server (mod_wsgi, gunicorn)
+from trying to bind every endpoint of the list until one works.
+
+The lock is released when the process exits, or when
+:func:`fedmsg.destroy` is called.
+
+The default value is ``None``, which tries every endpoint of the list in
+order.
+
+Independently of this setting, a context that was created before the
+process forked is re-initialized, with its own sockets, the first time the
+child publishes.
+
+
+.. _conf-shared-publisher:
+
+shared_publisher
+----------------
+A boolean that, if ``True``, makes all the threads of a process publish
+through a single PUB socket.  :func:`fedmsg.init` still creates a context per
+thread, but only the first one claims an endpoint from `endpoints`_.  The
+others hand their messages to it over ``inproc://`` sockets, so a threaded
+application needs one endpoint per process rather than one per thread.
+
+Messages from different threads may reach subscribers in a different order
+than the order in which their ``i`` counters were assigned.
+
+The shared socket is closed when the last context using it is destroyed, or
+when the process exits.  Either way, the messages still queued are sent
+first, waiting up to ``zmq_linger`` milliseconds for subscribers to take them.
+
+The default value is ``False``.
+
+
+.. _conf-priority-lanes:
+
+priority_lanes
+--------------
+``dict`` - Extra publishing sockets for topics that must not queue up behind
+everything else.  Each key names a lane, and each value is a dict with:
+
+``topics``
+    A list of patterns matched against the fully qualified topic with
+    :func:`fnmatch.fnmatch`, e.g. ``'*.fedora.announce.*'``.
+``priority``
+    An ``int``; higher goes first.  Defaults to ``1``.  Topics of no lane
+    have priority ``0``.
+``high_water_mark``
+    The `high_water_mark`_ of the lane's socket.  Defaults to the global
+    one.
+``high_water_mark_bytes``
+    The `high_water_mark_bytes`_ of the lane's socket.  Defaults to the
+    global one.
+
+A publisher named ``bodhi.app01`` sends the messages of a lane named
+``critical`` from its own socket, bound to one of the endpoints listed under
+``bodhi.app01@critical`` in `endpoints`_.  Lanes without endpoints for the
+publisher's name are ignored, and so are lanes of publishers that connect to
+the ``fedmsg-relay`` or use a `shared_publisher`_.
+
+Subscribers tell the lane of an endpoint from the part of its name after
+the ``@``.  :func:`fedmsg.tail_messages` handles the messages of higher
+priority lanes first whenever several sockets have messages waiting, and
+yields them under the publisher's name, ``bodhi.app01``.  Each socket numbers
+its messages on its own, so the ``i`` counter has no holes for any of them.  The
+moksha hub polls its sockets itself and doesn't know about lanes, but lanes
+still don't share a high water mark or a socket queue with other topics.
+
+The default value is ``{}``.
+
+
 .. _conf-srv-endpoints:
 
 srv_endpoints
@@ -177,6 +528,51 @@ For example, the following would query the endpoints for foo.example.com.
   ...)
 
 
+.. _conf-dns-cache:
+
+dns_cache
+---------
+``str`` - A file in which to keep which hosts of `endpoints`_ resolve and
+which don't, e.g. ``/var/cache/fedmsg/dns.json``.  The default is ``None``,
+which means no cache.
+
+Before subscribing, :func:`fedmsg.tail_messages` and friends look up the
+hosts of every endpoint, all at once.  With a cache, hosts looked up less
+than `dns_cache_expiry`_ seconds ago aren't looked up again, which spares
+``fedmsg-tail`` waiting on hosts that are long gone.
+
+
+.. _conf-dns-cache-expiry:
+
+dns_cache_expiry
+----------------
+``int`` - Number of seconds to trust an answer, good or bad, of the
+`dns_cache`_.  The default is ``300``.
+
+
+.. _conf-subscriber-sockets:
+
+subscriber_sockets
+------------------
+``int`` - How many SUB sockets :func:`fedmsg.tail_messages` and friends
+share between the TCP `endpoints`_ they connect to.  The default is
+``None``, which means a socket for every endpoint.  With a full bus, that's
+hundreds of sockets and file descriptors to poll.
+
+Messages still come with the name and endpoint of their publisher, told by
+the address they came from.  The endpoints of a name always share a socket
+and no two names on the same host do, so more sockets than this may be
+needed.  Some details are lost, though:
+
+- Endpoints of a name on the same host look the same, so the endpoint of
+  their messages is ``None``.
+- Messages coming from an address their hostname doesn't resolve to, say
+  through NAT, have a name and endpoint of ``None``.
+
+Endpoints of `priority_lanes`_ and ``ipc://`` endpoints keep sockets of
+their own.
+
+
 .. _conf-replay-endpoints:
 
 replay_endpoints
@@ -205,6 +601,37 @@ messages.
 See :doc:`commands` for more information.
 
 
+.. _conf-spool-directory:
+
+spool_directory
+---------------
+``str`` - A directory where publishers that connect to the `relay_inbound`_
+endpoint keep the messages they publish while no ``fedmsg-relay`` is there
+to take them.  The default is ``None``, which drops them, as zeromq does.
+
+Spooled messages are written and synced to disk before ``publish`` returns,
+and a background thread sends them, `spool_batch_size`_ at a time, once the
+relay is back.  :func:`fedmsg.init` waits up to `post_init_sleep`_ seconds
+for the relay to subscribe, so a relay that is up doesn't see the first
+messages spooled, and :func:`fedmsg.destroy` sends whatever is left in the
+spool if the relay is there.  Several processes can share the directory; what
+a process couldn't send before it exited goes out with the next one.  Messages are
+sent at least once but not necessarily in order, and a message published in
+the instant the relay goes away may still be lost.
+
+This has no effect with a `shared_publisher`_ or in :mod:`fedmsg.aio`.
+
+
+.. _conf-spool-batch-size:
+
+spool_batch_size
+----------------
+``int`` - How many spooled messages to send at a time once the
+``fedmsg-relay`` is back; see `spool_directory`_.
+
+The default value is ``100``.
+
+
 .. _conf-relay-outbound:
 
 relay_outbound
@@ -437,6 +864,39 @@ A value of ``0`` means "no limit" and is the
 recommended value for fedmsg.  It is referenced when initializing
 sockets in :func:`fedmsg.init`.
 
+Message sizes vary a lot, so a number of messages says little about memory
+use.  See `high_water_mark_bytes`_ for a limit in bytes.
+
+
+.. _conf-high-water-mark-bytes:
+
+high_water_mark_bytes
+---------------------
+``int`` - A rough limit, in bytes, on what each publishing and subscribing
+socket may keep queued.  The default is ``None``, which leaves the limit to
+`high_water_mark`_.
+
+zeromq only counts messages, so fedmsg keeps an eye on the average size of
+the messages going through each socket and sets its high water mark to the
+number of such messages that fit in the budget.  It starts out assuming 1KB
+messages, so a budget of ``67108864`` (64MB) first allows 65536 messages.
+A lane of `priority_lanes`_ may set a budget of its own.
+
+The gateway consumer reads its budget from
+``fedmsg.consumers.gateway.high_water_mark_bytes`` instead.
+
+
+.. _conf-high-water-mark-policy:
+
+high_water_mark_policy
+----------------------
+``str`` - What publishing does once a subscriber's queue is full: ``drop``,
+the default, drops the messages that subscriber would have gotten, and
+``block`` waits for it to catch up.  A lone slow subscriber then holds up
+every publish, so keep ``block`` for the few consumers that must not miss
+anything, and pair it with `publish_async`_ to keep that wait out
+of your application's way.
+
 
 .. _conf-io-threads:
 
@@ -454,16 +914,38 @@ This value is referenced when initializing the zeromq context in
 
 post_init_sleep
 ---------------
-``float`` - A number of seconds to sleep after initializing and before
-sending any messages.  Setting this to a value greater than zero is
+``float`` - The maximum number of seconds to wait after initializing and
+before sending any messages.  Setting this to a value greater than zero is
 required so that zeromq doesn't drop messages that we ask it to send
 before the pub socket is finished initializing.
 
+With `post_init_handshake`_ enabled, :func:`fedmsg.init` returns as soon as
+a peer (the relay, in active mode, or a subscriber) has subscribed to, or
+at least completed its connection to, the publishing socket, so this is only
+an upper bound.
+Otherwise, fedmsg sleeps for the whole duration.
+
 Experimentation needs to be done to determine and sufficiently small and
 safe value for this number.  ``1`` is definitely safe, but annoyingly
 large.
 
 
+.. _conf-post-init-handshake:
+
+post_init_handshake
+-------------------
+A boolean that, if ``True``, makes :func:`fedmsg.init` stop waiting as soon
+as a peer is ready for our messages, instead of always sleeping for
+`post_init_sleep`_ seconds.
+
+In active mode, and whenever the publishing socket is an XPUB socket anyway
+(see `publish_lazy`_), that is when the first subscription arrives.  Otherwise
+fedmsg watches the socket with a zeromq socket monitor and stops at the end of
+the first peer's handshake, which can come a moment before its subscription.
+
+The default value is ``True``.
+
+
 .. _conf-zmq-enabled:
 
 zmq_enabled
@@ -875,6 +1357,10 @@ class FedmsgConfig(dict):
             'default': u'dev',
             'validator': _validate_none_or_type(six.text_type),
         },
+        'default_modname': {
+            'default': None,
+            'validator': _validate_none_or_type(six.text_type),
+        },
         'io_threads': {
             'default': 1,
             'validator': _validate_non_negative_int,
@@ -883,6 +1369,10 @@ class FedmsgConfig(dict):
             'default': 0.5,
             'validator': _validate_non_negative_float,
         },
+        'post_init_handshake': {
+            'default': True,
+            'validator': _validate_bool,
+        },
         'timeout': {
             'default': 2,
             'validator': _validate_non_negative_int,
@@ -895,6 +1385,14 @@ class FedmsgConfig(dict):
             'default': 0,
             'validator': _validate_non_negative_int,
         },
+        'high_water_mark_bytes': {
+            'default': None,
+            'validator': _validate_none_or_type(int),
+        },
+        'high_water_mark_policy': {
+            'default': u'drop',
+            'validator': _validate_none_or_type(six.text_type),
+        },
         # milliseconds
         'zmq_linger': {
             'default': 1000,
@@ -944,6 +1442,42 @@ class FedmsgConfig(dict):
             'default': u'tcp://127.0.0.1:2001',
             'validator': _validate_none_or_type(six.text_type),
         },
+        'spool_directory': {
+            'default': None,
+            'validator': _validate_none_or_type(six.text_type),
+        },
+        'spool_batch_size': {
+            'default': 100,
+            'validator': _validate_non_negative_int,
+        },
+        'ipc_endpoints': {
+            'default': {},
+            'validator': _validate_none_or_type(dict),
+        },
+        'endpoint_lease_dir': {
+            'default': None,
+            'validator': _validate_none_or_type(six.text_type),
+        },
+        'dns_cache': {
+            'default': None,
+            'validator': _validate_none_or_type(six.text_type),
+        },
+        'dns_cache_expiry': {
+            'default': 300,
+            'validator': _validate_non_negative_int,
+        },
+        'subscriber_sockets': {
+            'default': None,
+            'validator': _validate_none_or_type(int),
+        },
+        'shared_publisher': {
+            'default': False,
+            'validator': _validate_bool,
+        },
+        'priority_lanes': {
+            'default': {},
+            'validator': _validate_none_or_type(dict),
+        },
         'fedmsg.consumers.gateway.port': {
             'default': 9940,
             'validator': _validate_non_negative_int,
@@ -952,6 +1486,10 @@ class FedmsgConfig(dict):
             'default': 1000,
             'validator': _validate_non_negative_int,
         },
+        'fedmsg.consumers.gateway.high_water_mark_bytes': {
+            'default': None,
+            'validator': _validate_none_or_type(int),
+        },
         'sign_messages': {
             'default': False,
             'validator': _validate_bool,
@@ -1119,6 +1657,62 @@ class FedmsgConfig(dict):
             'default': False,
             'validator': _validate_bool,
         },
+        'publish_async': {
+            'default': False,
+            'validator': _validate_bool,
+        },
+        'publish_queue_size': {
+            'default': 1000,
+            'validator': _validate_non_negative_int,
+        },
+        'publish_queue_overflow': {
+            'default': u'block',
+            'validator': _validate_none_or_type(six.text_type),
+        },
+        'publish_stats': {
+            'default': False,
+            'validator': _validate_bool,
+        },
+        'publish_stats_callback': {
+            'default': None,
+            'validator': None,
+        },
+        'publish_stats_interval': {
+            'default': 60,
+            'validator': _validate_non_negative_float,
+        },
+        'publish_coalesce': {
+            'default': False,
+            'validator': _validate_bool,
+        },
+        'publish_coalesce_linger': {
+            'default': 0.005,
+            'validator': _validate_non_negative_float,
+        },
+        'publish_trace': {
+            'default': False,
+            'validator': _validate_bool,
+        },
+        'publish_lazy': {
+            'default': False,
+            'validator': _validate_bool,
+        },
+        'blob_store': {
+            'default': None,
+            'validator': None,
+        },
+        'blob_threshold': {
+            'default': 65536,
+            'validator': _validate_non_negative_int,
+        },
+        'msg_id_format': {
+            'default': u'random',
+            'validator': _validate_none_or_type(six.text_type),
+        },
+        'publish_rate_limits': {
+            'default': {},
+            'validator': _validate_none_or_type(dict),
+        },
     }
 
     def __getitem__(self, *args, **kw):
@@ -24,6 +24,7 @@ import logging
 import os
 import psutil
 import requests
+import socket
 import threading
 import time
 import warnings
@@ -31,8 +32,11 @@ import warnings
 import moksha.hub.api.consumer
 import six
 
+import fedmsg.blobs
+import fedmsg.core
 import fedmsg.crypto
 import fedmsg.encoding
+import fedmsg.stats
 from fedmsg.replay import check_for_replay
 
 
@@ -81,6 +85,17 @@ class FedmsgConsumer(moksha.hub.api.consumer.Consumer):
             query for playback in case of missed messages. It must match a service
             key in :ref:`conf-replay-endpoints`. This attribute is optional.
 
+        loss_stats (fedmsg.stats.LossStats): For consumers of every topic, the
+            messages that went missing before reaching the hub, worked out from
+            their ``i`` counter and ``sender``.  The hub doesn't tell consumers
+            which endpoint a message came from, so everything is counted under
+            ``None``.
+
+        latency_stats (fedmsg.stats.LatencyStats): How long the messages of
+            publishers with :ref:`conf-publish-trace` took to reach the hub.
+            Their trace gets a stamp named after ``trace_hop``, ``"consume"``
+            by default, and is left in the ``trace`` of the message.
+
     Args:
         hub (moksha.hub.hub.MokshaCentralHub): The Moksha Hub that is initializing this
             consumer.
@@ -88,6 +103,7 @@ class FedmsgConsumer(moksha.hub.api.consumer.Consumer):
 
     validate_signatures = None
     config_key = None
+    trace_hop = 'consume'
 
     def __init__(self, hub):
         module = inspect.getmodule(self).__name__
@@ -117,6 +133,13 @@ class FedmsgConsumer(moksha.hub.api.consumer.Consumer):
         if self.validate_signatures is None:
             self.validate_signatures = self.hub.config['validate_signatures']
 
+        # Gaps in ``i`` only mean something if we get every topic.
+        topics = self.topic if isinstance(self.topic, list) else [self.topic]
+        self.loss_stats = fedmsg.stats.LossStats()
+        self._track_loss = any(topic in ('', '*') for topic in topics)
+        self.latency_stats = fedmsg.stats.LatencyStats()
+        self.hostname = socket.gethostname().split('.', 1)[0]
+
         if hasattr(self, "replay_name"):
             self.name_to_seq_id = {}
             if self.replay_name in self.hub.config.get("replay_endpoints", {}):
@@ -310,11 +333,19 @@ class FedmsgConsumer(moksha.hub.api.consumer.Consumer):
             self.log.warn("Received invalid message {0}".format(e))
             return
 
+        self._stamp(message)
+
         # Pass along headers if present.  May be useful to filters or
         # fedmsg.meta routines.
         if isinstance(message, dict) and 'headers' in message and 'body' in message:
             message['body']['headers'] = message['headers']
 
+        if self._track_loss and isinstance(message, dict) and \
+                isinstance(message.get('body'), dict):
+            # The hub doesn't say where a message came from; the sender id
+            # in it tells the publishers apart.
+            self.loss_stats.add(None, message['body'])
+
         if hasattr(self, "replay_name"):
             for m in check_for_replay(
                     self.replay_name, self.name_to_seq_id,
@@ -322,11 +353,50 @@ class FedmsgConsumer(moksha.hub.api.consumer.Consumer):
 
                 try:
                     self.validate(m)
-                    return super(FedmsgConsumer, self)._consume(m)
+                    return super(FedmsgConsumer, self)._consume(
+                        self._lazy_blobs(m))
                 except RuntimeWarning as e:
                     self.log.warn("Received invalid message {}".format(e))
         else:
-            return super(FedmsgConsumer, self)._consume(message)
+            return super(FedmsgConsumer, self)._consume(
+                self._lazy_blobs(message))
+
+    def _consume_json(self, message):
+        """ Like moksha's, but keep the trace of a traced message. """
+        trace = getattr(message, 'trace', None)
+        if not trace:
+            return super(FedmsgConsumer, self)._consume_json(message)
+        try:
+            body = json.loads(message.body)
+        except ValueError:
+            body = message.body
+        return self._consume(
+            {'body': body, 'topic': message.topic, 'trace': trace})
+
+    def _stamp(self, message):
+        """ Add our stamp to the trace of ``message``, if it has one. """
+        if isinstance(message, dict):
+            trace = message.get('trace')
+        else:
+            trace = getattr(message, 'trace', None)
+        if not trace:
+            return
+        # The trace came with the message from the hub extension, which may
+        # have handed it to other consumers too.
+        trace = trace + [[self.trace_hop, self.hostname, fedmsg.core._time_ns()]]
+        self.latency_stats.add(trace)
+        if isinstance(message, dict):
+            message['trace'] = trace
+        else:
+            message.trace = trace
+
+    def _lazy_blobs(self, message):
+        """ Have big fields moved out of band fetched only if they're used. """
+        blob_store = self.hub.config.get('blob_store')
+        if blob_store and isinstance(message, dict) and \
+                isinstance(message.get('body'), dict):
+            fedmsg.blobs.wrap(message['body'], blob_store)
+        return message
 
     def pre_consume(self, message):
         self.save_status(dict(
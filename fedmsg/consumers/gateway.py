@@ -21,6 +21,8 @@ import threading
 import weakref
 import zmq
 
+import fedmsg.core
+import fedmsg.utils
 from fedmsg.consumers import FedmsgConsumer
 
 
@@ -28,6 +30,7 @@ class GatewayConsumer(FedmsgConsumer):
     config_key = 'fedmsg.consumers.gateway.enabled'
     jsonify = False
     topic = '*'
+    trace_hop = 'gateway'
 
     def __init__(self, hub):
         self.hub = hub
@@ -53,11 +56,18 @@ class GatewayConsumer(FedmsgConsumer):
         self._context = zmq.Context(1)
         self.gateway_socket = self._context.socket(zmq.PUB)
 
+        self._budget = None
+        budget = self.hub.config.get(
+            'fedmsg.consumers.gateway.high_water_mark_bytes')
+
         # Set this to an absurdly high number to increase the number of clients
         # we can serve.  To be effective, also increase nofile for fedmsg in
         # /etc/security/limits.conf to near fs.file-limit.  Try 160000.
         hwm = self.hub.config['fedmsg.consumers.gateway.high_water_mark']
-        if zmq.zmq_version().startswith("2."):
+        if budget and not zmq.zmq_version().startswith("2."):
+            # Follow the size of the messages instead of counting them.
+            self._budget = fedmsg.utils.ByteBudget(self.gateway_socket, budget)
+        elif zmq.zmq_version().startswith("2."):
             # zeromq2
             self.gateway_socket.setsockopt(zmq.HWM, hwm)
         else:
@@ -80,7 +90,11 @@ class GatewayConsumer(FedmsgConsumer):
 
     def consume(self, msg):
         self.log.debug("Gateway: %r" % msg.topic)
-        self.gateway_socket.send_multipart([
-            msg.topic.encode('utf-8'),
-            msg.body.encode('utf-8'),
-        ])
+        body = msg.body.encode('utf-8')
+        frames = [msg.topic.encode('utf-8'), body]
+        trace = getattr(msg, 'trace', None)
+        if trace:
+            frames.append(fedmsg.core._trace_frame(trace))
+        self.gateway_socket.send_multipart(frames)
+        if self._budget is not None:
+            self._budget.add(len(body))
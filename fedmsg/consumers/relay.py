@@ -20,6 +20,7 @@
 import logging
 
 from fedmsg.consumers import FedmsgConsumer
+from fedmsg.consumers.zeromq import send_traced
 from fedmsg import crypto
 
 log = logging.getLogger(__name__)
@@ -28,6 +29,7 @@ log = logging.getLogger(__name__)
 class RelayConsumer(FedmsgConsumer):
     config_key = 'fedmsg.consumers.relay.enabled'
     topic = '*'
+    trace_hop = 'relay'
 
     def __init__(self, hub):
         self.hub = hub
@@ -52,7 +54,11 @@ class RelayConsumer(FedmsgConsumer):
         # everywhere else.
 
         log.debug("Got message %r" % msg)
-        self.hub.send_message(topic=msg['topic'], message=msg['body'])
+        if msg.get('trace') and self.hub.config.get('publish_trace'):
+            # Send the trace on, with our stamp, see FedmsgConsumer._stamp.
+            send_traced(self.hub, msg['topic'], msg['body'], msg['trace'])
+        else:
+            self.hub.send_message(topic=msg['topic'], message=msg['body'])
 
 
 class SigningRelayConsumer(RelayConsumer):
@@ -0,0 +1,128 @@
+# This file is part of fedmsg.
+# Copyright (C) 2012 Red Hat, Inc.
+#
+# fedmsg is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# fedmsg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with fedmsg; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+"""
+The moksha hub's zeromq extension, taught the trace frames of
+:ref:`conf-publish-trace`.
+
+moksha hands its consumers the topic and body of two-frame messages and
+chokes on anything else.  :class:`TracingZMQHubExtension` takes traced
+messages too and hangs their trace on the message consumers get, as
+``trace``, so that the ``fedmsg-hub``, ``fedmsg-relay`` and
+``fedmsg-gateway`` can stamp it and send it on.  Those commands
+:func:`install` it when :ref:`conf-publish-trace` is enabled.
+"""
+
+import logging
+
+import moksha.hub.hub
+import six
+import txzmq
+import zmq
+
+from moksha.hub.zeromq.zeromq import ZMQHubExtension
+
+import fedmsg.core
+import fedmsg.encoding
+
+log = logging.getLogger(__name__)
+
+
+class TracedSubConnection(txzmq.ZmqSubConnection):
+    """ A txzmq subscriber that tells the hub extension each message's trace.
+    """
+
+    extension = None
+
+    def messageReceived(self, message):
+        for topic, body, trace in fedmsg.core._unpack(message):
+            self.extension._trace = trace
+            try:
+                self.gotMessage(body, topic)
+            finally:
+                self.extension._trace = None
+
+
+class TracingZMQHubExtension(ZMQHubExtension):
+    """ moksha's zeromq hub extension, keeping the trace of traced messages.
+
+    Every message handed to a subscriber has a ``trace`` attribute: the list
+    of stamps it came with, or ``None``.
+    """
+
+    def __init__(self, hub, config):
+        super(TracingZMQHubExtension, self).__init__(hub, config)
+        # moksha set its socket options on txzmq.ZmqSubConnection, which
+        # TracedSubConnection inherits.
+        self.connection_cls = self._connect
+        self._trace = None
+        self._callbacks = {}
+
+    def _connect(self, factory, endpoint):
+        connection = TracedSubConnection(factory, endpoint)
+        connection.extension = self
+        return connection
+
+    def subscribe(self, topic, callback):
+        # Messages reach the callback as soon as they are received, in the
+        # reactor thread, while _trace is theirs.
+        def traced(message):
+            message.trace = self._trace
+            return callback(message)
+
+        self._callbacks.setdefault(callback, []).append(traced)
+        super(TracingZMQHubExtension, self).subscribe(topic, traced)
+
+    def unsubscribe(self, callback):
+        for traced in self._callbacks.pop(callback, []):
+            super(TracingZMQHubExtension, self).unsubscribe(traced)
+
+    def send_message(self, topic, message, trace=None, **headers):
+        """ Send ``message``, followed by a frame of ``trace`` if there is one.
+        """
+        if not trace:
+            return super(TracingZMQHubExtension, self).send_message(
+                topic, message, **headers)
+
+        if isinstance(topic, six.text_type):
+            topic = topic.encode('utf-8')
+        if isinstance(message, six.text_type):
+            message = message.encode('utf-8')
+        try:
+            self.pub_socket.send_multipart(
+                [topic, message, fedmsg.core._trace_frame(trace)])
+        except zmq.ZMQError as e:
+            log.warning("Couldn't send message: %r" % e)
+
+
+def send_traced(hub, topic, message, trace):
+    """ Send ``message`` through ``hub`` like ``hub.send_message`` does, with
+    ``trace`` following it on the extensions that can carry it.
+    """
+    message = fedmsg.encoding.dumps(message)
+    for ext in hub.extensions:
+        if isinstance(ext, TracingZMQHubExtension):
+            ext.send_message(topic, message, trace=trace)
+        else:
+            ext.send_message(topic, message)
+
+
+def install():
+    """ Have moksha hubs created from now on use
+    :class:`TracingZMQHubExtension` for zeromq.
+    """
+    moksha.hub.hub.ZMQHubExtension = TracingZMQHubExtension
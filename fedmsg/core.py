@@ -18,10 +18,13 @@
 # Authors:  Ralph Bean <rbean@redhat.com>
 #
 
+import atexit
+import fnmatch
 import getpass
+import itertools
+import os
 import socket
 import threading
-import datetime
 import six
 import time
 import uuid
@@ -29,15 +32,25 @@ import warnings
 import weakref
 import zmq
 
+from six.moves import queue
 from kitchen.iterutils import iterate
 from kitchen.text.converters import to_bytes
 
+import fedmsg.blobs
 import fedmsg.encoding
 import fedmsg.crypto
+import fedmsg.ratelimit
+import fedmsg.spool
+import fedmsg.stats
 
 from fedmsg.utils import (
     set_high_water_mark,
+    time_ordered_uuid,
+    ipc_endpoint,
+    subscription_endpoint,
+    resolve_hostnames,
     guess_calling_module,
+    leased_endpoints,
     set_tcp_keepalive,
     set_tcp_reconnect,
 )
@@ -47,12 +60,532 @@ from fedmsg.replay import check_for_replay
 import logging
 
 
+# The pid of this process, kept up to date across forks when the interpreter
+# lets us know about them.  Otherwise, ask the kernel every time.
+if hasattr(os, 'register_at_fork'):
+    _pid = [os.getpid()]
+    os.register_at_fork(after_in_child=lambda: _pid.__setitem__(0, os.getpid()))
+
+    def _getpid():
+        return _pid[0]
+else:
+    _getpid = os.getpid
+
+
+# Trace frames start with a byte that no JSON body starts with.
+_TRACE_MARK = b'\x00'
+
+# Wall clock time in nanoseconds, as precise as the platform has it.
+_time_ns = getattr(time, 'time_ns', None) or (lambda: int(time.time() * 1e9))
+
+
+def _trace_frame(trace):
+    """ Encode ``trace``, a list of ``[hop, host, nanoseconds]`` stamps. """
+    return _TRACE_MARK + fedmsg.encoding.dumps(trace).encode('utf-8')
+
+
+def _unpack(frames):
+    """ Split a received multipart message into ``(topic, body, trace)``.
+
+    A plain message is a topic frame and a body frame.  A coalesced one (see
+    :ref:`conf-publish-coalesce`) has several bodies after its topic frame.
+    With :ref:`conf-publish-trace`, each body is followed by a trace frame,
+    which ends up decoded in ``trace``; otherwise ``trace`` is ``None``.
+    """
+    topic = frames[0]
+    result = []
+    for frame in frames[1:]:
+        # Bodies may be zero-copy frames, see FedMsgContext._run_socket.
+        if getattr(frame, 'buffer', frame)[:1] != _TRACE_MARK:
+            result.append((topic, frame, None))
+        elif result and result[-1][2] is None:
+            frame = getattr(frame, 'bytes', frame)
+            try:
+                trace = fedmsg.encoding.loads(frame[1:].decode('utf-8'))
+            except ValueError:
+                continue
+            result[-1] = (topic, result[-1][1], trace)
+    return result
+
+
+def _lane_base(name):
+    """ Return ``name`` without the ``@lane`` of a priority lane endpoint. """
+    if name and '@' in name:
+        return name.rsplit('@', 1)[0]
+    return name
+
+
+def _prefixes(topic):
+    """ Return the prefixes to subscribe to for ``topic``, a topic prefix or
+    a list of them.  An empty list means every topic, like ``""``.
+    """
+    return [prefix for prefix in iterate(topic) if prefix is not None] or ['']
+
+
+def _shard_endpoints(endpoints, addresses, count):
+    """ Spread ``endpoints``, ``(name, endpoint, hostname)`` triples, over
+    about ``count`` groups that can each share a SUB socket.
+
+    Returns a list of ``(peers, endpoints)`` pairs, ``peers`` mapping the
+    address of each publisher of the group to its ``(name, endpoint)``.  All
+    the endpoints of a name go in the same group and no two names of a group
+    share an address, so the address a message came from tells who sent it.
+    When many names share a host, that takes more than ``count`` groups.
+    """
+    by_name = {}
+    for name, endpoint, hostname in endpoints:
+        by_name.setdefault(name, []).append((endpoint, hostname))
+
+    groups = [({}, []) for _ in range(count)]
+    # The biggest first, for an even spread.
+    for name in sorted(by_name, key=lambda name: (-len(by_name[name]), name)):
+        peers = {}
+        for endpoint, hostname in by_name[name]:
+            for address in addresses.get(hostname, []):
+                # Endpoints of a name on the same host can't be told apart.
+                peers[address] = (name, None if address in peers else endpoint)
+
+        fits = [group for group in groups if not set(group[0]) & set(peers)]
+        if not fits:
+            fits = [({}, [])]
+            groups.extend(fits)
+        group = min(fits, key=lambda group: len(group[1]))
+        group[0].update(peers)
+        group[1].extend(endpoint for endpoint, _ in by_name[name])
+
+    return [group for group in groups if group[1]]
+
+
 class ValidationError(Exception):
     """ Error used internally to represent a validation failure. """
     def __init__(self, msg):
         self.msg = msg
 
 
+class SharedPublisher(object):
+    """
+    The one publishing socket of a process, fed by all of its threads.
+
+    Used when :ref:`conf-shared-publisher` is enabled.  The first
+    :class:`FedMsgContext` created in a process sets this up: a regular
+    context that binds (or connects) the PUB socket, and a thread that
+    forwards to it whatever arrives on an ``inproc://`` PULL socket.  Every
+    context of that process, in whatever thread, then sends over its own
+    PUSH socket connected to it instead of claiming an endpoint of its own.
+
+    It is closed when the last of those contexts is destroyed, or when the
+    process exits, after forwarding what is still queued.
+    """
+
+    endpoint = "inproc://fedmsg-shared-publisher"
+    control_endpoint = "inproc://fedmsg-shared-publisher-control"
+
+    def __init__(self, **config):
+        self.log = logging.getLogger(__name__)
+        config['shared_publisher'] = False
+        # Subscriptions would flow back into the PULL socket, which can't
+        # take them.
+        config['publish_lazy'] = False
+        config['high_water_mark_policy'] = 'drop'
+        config['spool_directory'] = None
+        self.owner = _SharedPublisherOwner(**config)
+        self.context = self.owner.context
+        self.counter = itertools.count(1)
+        self.sender = uuid.uuid4().hex
+        # How long, in milliseconds, to wait for the last messages to go out.
+        self.linger = config.get('zmq_linger', 1000)
+        # The contexts using us; see _get_shared_publisher.
+        self.users = 0
+        self.closed = False
+
+        self.collector = None
+        if self.owner.publisher:
+            self.collector = self.context.socket(zmq.PULL)
+            set_high_water_mark(self.collector, config)
+            self.collector.bind(self.endpoint)
+            # Tells the forwarder to stop.
+            self.control = self.context.socket(zmq.PAIR)
+            self.control.bind(self.control_endpoint)
+
+            self.forwarder = threading.Thread(
+                target=self._run, name="fedmsg-shared-publisher")
+            self.forwarder.daemon = True
+            self.forwarder.start()
+
+    def _run(self):
+        control = self.context.socket(zmq.PAIR)
+        control.connect(self.control_endpoint)
+        try:
+            zmq.proxy_steerable(
+                self.collector, self.owner.publisher, None, control)
+
+            # Stopped by close(); forward what the PUSH sockets left behind.
+            deadline = time.time() + self.linger / 1000.0
+            while time.time() < deadline:
+                try:
+                    frames = self.collector.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self.owner.publisher.send_multipart(frames)
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            control.close()
+            self.collector.close()
+
+    def connect(self):
+        """ Return a new PUSH socket feeding the shared publisher.
+
+        Like any zeromq socket, it must only be used by one thread at a time.
+        Returns ``None`` if the process has no publishing socket.
+        """
+        if self.collector is None:
+            return None
+
+        pusher = self.context.socket(zmq.PUSH)
+        set_high_water_mark(pusher, self.owner.c)
+        # Closing it must not drop what the forwarder hasn't taken yet.
+        pusher.setsockopt(zmq.LINGER, self.linger)
+        pusher.connect(self.endpoint)
+        return pusher
+
+    def close(self):
+        """ Forward what is still queued and close the publishing socket.
+
+        Subscribers get up to ``zmq_linger`` milliseconds to take the
+        last messages.  Sockets returned by :meth:`connect` that are still
+        open are closed too.
+        """
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.collector is None:
+            self.owner.destroy()
+            return
+
+        self.control.send(b'TERMINATE')
+        self.forwarder.join()
+        # Closes whatever sockets are left, the publisher last of all, and
+        # waits for them to send what they hold.
+        self.context.destroy(linger=self.linger)
+        self.owner.publisher = None
+        self.owner.context = None
+        self.owner.destroy()
+
+
+# The shared publisher of this process, by pid, so that forked children
+# don't pick up their parent's.
+_shared_publishers = {}
+_shared_publishers_lock = threading.Lock()
+
+
+def _get_shared_publisher(config):
+    """ Return the shared publisher of this process, counting a new user. """
+    with _shared_publishers_lock:
+        shared = _shared_publishers.get(_getpid())
+        if shared is None:
+            _shared_publishers.clear()
+            shared = _shared_publishers[_getpid()] = SharedPublisher(
+                **dict(config))
+        shared.users += 1
+        return shared
+
+
+def _release_shared_publisher(shared):
+    """ Count one user of ``shared`` less, and close it after the last one.
+    """
+    with _shared_publishers_lock:
+        shared.users -= 1
+        if shared.users > 0:
+            return
+        if _shared_publishers.get(_getpid()) is shared:
+            del _shared_publishers[_getpid()]
+    shared.close()
+
+
+@atexit.register
+def _close_shared_publishers():
+    """ Send what the shared publisher still holds before the process exits.
+    """
+    with _shared_publishers_lock:
+        shared = _shared_publishers.pop(_getpid(), None)
+    if shared is not None:
+        shared.close()
+
+
+class _Lane(object):
+    """ The publishing socket of one of the :ref:`conf-priority-lanes`. """
+
+    def __init__(self, name, patterns, socket, lease=None):
+        self.name = name
+        self.patterns = patterns
+        self.socket = socket
+        self.lease = lease
+        # Subscribers see each socket on its own, so each counts its own
+        # messages.
+        self.i = 0
+        self.sender = uuid.uuid4().hex
+
+    def matches(self, topic):
+        return any(fnmatch.fnmatchcase(topic, pattern)
+                   for pattern in self.patterns)
+
+    def close(self):
+        self.socket.close()
+        if self.lease is not None:
+            os.close(self.lease)
+            self.lease = None
+
+
+class PublishQueue(object):
+    """
+    A bounded queue of outgoing messages, drained by a background thread.
+
+    Used by :class:`FedMsgContext` when :ref:`conf-publish-async` is enabled.
+    :meth:`FedMsgContext.publish` builds the message envelope and puts it
+    here; the worker thread signs it, adds it to the ``persistent_store`` and
+    sends it.  What happens when the queue is full is decided by ``overflow``:
+
+    ``block``
+        Wait for the worker to make room.
+    ``drop-oldest``
+        Discard the oldest queued messages to make room.
+    ``drop-newest``
+        Discard the message being published.
+
+    With a ``linger`` (see :ref:`conf-publish-coalesce-linger`), the worker
+    keeps taking messages off the queue for that many seconds and sends them
+    together, so the context can coalesce them.
+    """
+
+    policies = ('block', 'drop-oldest', 'drop-newest')
+
+    def __init__(self, context, maxsize=1000, overflow='block', linger=None):
+        if overflow not in self.policies:
+            raise ValueError("publish_queue_overflow must be one of %r, "
+                             "not %r" % (self.policies, overflow))
+
+        self.context = context
+        self.overflow = overflow
+        self.linger = linger
+        self.log = logging.getLogger(__name__)
+        self.queue = queue.Queue(maxsize)
+        self.counters = dict(enqueued=0, sent=0, dropped=0, errors=0)
+        self._lock = threading.Lock()
+
+        self.worker = threading.Thread(
+            target=self._run, name="fedmsg-publish-queue")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counters[key] += n
+
+    def put(self, batch, pre_fire_hook=None):
+        """ Queue a list of ``(topic, msg)`` envelopes for sending. """
+        item = (batch, pre_fire_hook)
+        if self.overflow == 'block':
+            self.queue.put(item)
+        elif self.overflow == 'drop-newest':
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self._count('dropped', len(batch))
+                return
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        oldest, _ = self.queue.get_nowait()
+                    except queue.Empty:
+                        continue
+                    self.queue.task_done()
+                    self._count('dropped', len(oldest))
+
+        self._count('enqueued', len(batch))
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            if self.linger and items[0] is not None:
+                # Give messages published right after this one a chance to
+                # share its frame.
+                self._collect(items, self.linger)
+
+            try:
+                batches = [item for item in items if item is not None]
+                if len(batches) == 1:
+                    self._process(*batches[0])
+                elif batches:
+                    self._process_many(batches)
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+            if items[-1] is None:
+                return
+
+    def _collect(self, items, linger):
+        """ Append what gets queued in the next ``linger`` seconds to ``items``.
+
+        Stops early at the sentinel :meth:`close` puts on the queue.
+        """
+        deadline = time.time() + linger
+        while items[-1] is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+    def _process(self, batch, pre_fire_hook):
+        try:
+            self.context._process(batch, pre_fire_hook)
+            self._count('sent', len(batch))
+        except Exception:
+            self._count('errors', len(batch))
+            self.log.exception("Failed to publish queued messages")
+
+    def _process_many(self, batches):
+        """ Like :meth:`_process`, but sends several batches together. """
+        envelopes, count = [], 0
+        for batch, pre_fire_hook in batches:
+            try:
+                envelopes.extend(self.context._prepare(batch, pre_fire_hook))
+            except Exception:
+                self._count('errors', len(batch))
+                self.log.exception("Failed to publish queued messages")
+
+        try:
+            count = len(envelopes)
+            if count:
+                self.context._send_all(envelopes)
+                self._count('sent', count)
+        except Exception:
+            self._count('errors', count)
+            self.log.exception("Failed to publish queued messages")
+
+    def flush(self):
+        """ Block until everything queued so far has been handled. """
+        self.queue.join()
+
+    def close(self):
+        """ Drain the queue and stop the worker thread. """
+        self.queue.put(None)
+        self.worker.join()
+
+    def stats(self):
+        """ Return a copy of the counters, plus the current queue length. """
+        with self._lock:
+            result = dict(self.counters)
+        result['queued'] = self.queue.qsize()
+        return result
+
+
+class PreparedPublisher(object):
+    """
+    A publisher bound to a single ``modname`` of a :class:`FedMsgContext`.
+
+    Use :meth:`FedMsgContext.publisher_for` to get one.  The topic prefix,
+    the encoded topics, the username and the current year are computed once
+    and reused for every message, and the signing identity is resolved before
+    the first message is built.  Signing, the ``persistent_store`` and the
+    socket are still those of the context.
+    """
+
+    # Cap the number of encoded topics we keep around, in case a caller
+    # builds topic suffixes out of unbounded data.
+    _topic_cache_size = 1024
+
+    def __init__(self, context, modname):
+        self.context = context
+        self.modname = modname
+        self.username = getpass.getuser()
+        self.hostname = context.hostname
+        self._topics = {}
+        self._year, self._year_ends = None, 0
+
+        msg_id_format = context.c.get('msg_id_format', 'random')
+        if msg_id_format not in ('random', 'time-ordered'):
+            raise ValueError("msg_id_format must be 'random' or "
+                             "'time-ordered', not %r" % msg_id_format)
+        self._time_ordered = msg_id_format == 'time-ordered'
+
+        if context.c.get('sign_messages', False):
+            context._crypto_config()
+
+    def topic(self, topic):
+        """ Return the fully qualified topic for ``topic``, as bytes. """
+        try:
+            return self._topics[topic]
+        except KeyError:
+            if len(self._topics) >= self._topic_cache_size:
+                self._topics.clear()
+            result = self._topics[topic] = \
+                self.context._build_topic(topic, self.modname)
+            return result
+
+    def envelope(self, topic=None, msg=None):
+        """ Wrap ``msg`` in the standard fedmsg envelope.
+
+        Returns a ``(topic, message)`` tuple where ``topic`` is the fully
+        qualified topic as bytes and ``message`` is the unsigned message dict.
+        """
+        with self.context._stats.time('topic'):
+            topic = self.topic(topic or 'unspecified')
+
+        now = time.time()
+        if now >= self._year_ends:
+            # Only ask the calendar once a year, not once a message.
+            self._year = time.localtime(now).tm_year
+            self._year_ends = time.mktime(
+                (self._year + 1, 1, 1, 0, 0, 0, 0, 0, -1))
+
+        if self._time_ordered:
+            ident = time_ordered_uuid(now)
+        else:
+            ident = str(uuid.uuid4())
+
+        sender, i = self.context._next_i(topic)
+        return topic, dict(
+            topic=topic.decode('utf-8'),
+            msg=msg or dict(),
+            timestamp=int(now),
+            msg_id=str(self._year) + '-' + ident,
+            i=i,
+            sender=sender,
+            username=self.username,
+        )
+
+    def publish(self, topic=None, msg=None, pre_fire_hook=None):
+        """ Publish ``msg`` on ``topic``.
+
+        This is :meth:`FedMsgContext.publish` with ``modname`` already bound.
+        """
+        batch = []
+        if self.context._admit(self.topic(topic or 'unspecified')):
+            batch.append(self.envelope(topic, msg))
+        return self.context._dispatch(batch, pre_fire_hook)
+
+    def publish_many(self, messages, pre_fire_hook=None):
+        """ Publish an iterable of ``(topic, msg)`` tuples.
+
+        This is :meth:`FedMsgContext.publish_many` with ``modname`` already
+        bound.
+        """
+        return self.context.publish_many(
+            [(topic, msg, self.modname) for topic, msg in messages],
+            pre_fire_hook=pre_fire_hook,
+        )
+
+
 class FedMsgContext(object):
     # A counter for messages sent.
     _i = 0
@@ -64,9 +597,36 @@ class FedMsgContext(object):
         self.c = config
         self.hostname = socket.gethostname().split('.', 1)[0]
 
-        # Prepare our context and publisher
-        self.context = zmq.Context(config['io_threads'])
-        method = ['bind', 'connect'][config['active']]
+        # Prepared publishers, by modname, and the resolved signing config.
+        self._prepared = {}
+        self._signing_config = None
+
+        # The background publishing queue, if publish_async is enabled.
+        self._queue = None
+
+        # What tail_messages sees go missing, and how long it took to come.
+        self._loss = fedmsg.stats.LossStats()
+        self._latency = fedmsg.stats.LatencyStats()
+
+        self._trace = config.get('publish_trace', False)
+
+        self._limiter = None
+        self._send_lock, self._summary_timer = None, None
+        if config.get('publish_rate_limits'):
+            self._limiter = fedmsg.ratelimit.RateLimiter(
+                config['publish_rate_limits'])
+            if self._limiter.summarizes():
+                # Summaries fall due whether or not anyone publishes, and
+                # then a timer thread sends them, so the sockets need a lock.
+                self._send_lock = threading.Lock()
+
+        if config.get('publish_stats', False):
+            self._stats = fedmsg.stats.PublishStats(
+                callback=config.get('publish_stats_callback'),
+                interval=config.get('publish_stats_interval', 60),
+            )
+        else:
+            self._stats = fedmsg.stats.NullStats()
 
         # If no name is provided, use the calling module's __name__ to decide
         # which publishing endpoint to use (unless active=True, in which case
@@ -91,98 +651,449 @@ class FedMsgContext(object):
                 raise KeyError("Could not find endpoint for fedmsg-relay."
                                " Try installing fedmsg-relay.")
 
+        # Cleanup.  See https://bit.ly/SaGeOr for discussion.
+        # arg signature - weakref.ref(object [, callback])
+        weakref.ref(threading.current_thread(), self.destroy)
+
+        # Where to keep what the fedmsg-relay can't take right now.
+        self._spool, self._flusher = None, None
+        if config.get('spool_directory') and config.get('active', False):
+            self._spool = fedmsg.spool.Spool(config['spool_directory'])
+
+        self._pid = _getpid()
+        # Tells our ``i`` counter apart from every other one.
+        self._sender = uuid.uuid4().hex
+        self._lease = None
+        self._shared = None
+        self._subscriptions = None
+        self._lanes = []
+        # The byte budgets of our sockets, if high_water_mark_bytes is set.
+        self._budgets = {}
+        # Who's who behind the SUB sockets shared by several endpoints.
+        self._peers = {}
+        self._send_flags = zmq.NOBLOCK
+        self._init_sockets()
+
+    def _init_sockets(self):
+        """ Prepare our zeromq context and publisher. """
+        method = ['bind', 'connect'][self.c['active']]
+
+        if (
+            self.c.get('shared_publisher', False) and
+            self.c.get('zmq_enabled', True) and
+            not self.c.get('mute', False)
+        ):
+            # Borrow the process-wide publisher; it is already set up.
+            self._shared = _get_shared_publisher(self.c)
+            self.context = self._shared.context
+            self.publisher = self._shared.connect()
+            self._start_queue()
+            return
+
+        self.context = zmq.Context(self.c['io_threads'])
+        monitor = self._setup_publisher(method)
+        self._setup_lanes(method)
+
+        self._start_queue()
+        if self._spool is not None and getattr(self, 'publisher', None):
+            self._flusher = fedmsg.spool.SpoolFlusher(
+                self.context, self._spool,
+                list(iterate(self.c['endpoints'][self.c['name']]))[0], self.c)
+
+        # Wait to make sure that the socket gets set up before anyone tries
+        # anything.  This is a documented zmq 'feature'.
+        if getattr(self, 'publisher', None):
+            self._wait_for_peer(monitor, self.c['post_init_sleep'])
+
+    def _setup_publisher(self, method):
+        """ Create the publishing socket and bind or connect it.
+
+        Returns the socket monitor to wait on, if there is one.
+        """
+        monitor = None
+
         # Actually set up our publisher, but only if we're configured for zmq.
         if (
-            config.get('zmq_enabled', True) and
-            not config.get("mute", False) and
-            config.get("name", None) and
-            config.get("endpoints", None) and
-            config['endpoints'].get(config['name'])
+            self.c.get('zmq_enabled', True) and
+            not self.c.get("mute", False) and
+            self.c.get("name", None) and
+            self.c.get("endpoints", None) and
+            self.c['endpoints'].get(self.c['name'])
         ):
+            policy = self.c.get('high_water_mark_policy', 'drop')
+            if policy not in ('drop', 'block'):
+                raise ValueError("high_water_mark_policy must be 'drop' or "
+                                 "'block', not %r" % policy)
+
             # Construct it.
-            self.publisher = self.context.socket(zmq.PUB)
+            socket_type = self._publisher_type(method)
+            self.publisher = self.context.socket(socket_type)
+            if socket_type == zmq.XPUB:
+                self._subscriptions = set()
+                self._wanted = {}
+
+            if policy == 'block':
+                self.publisher.setsockopt(zmq.XPUB_NODROP, 1)
+                self._send_flags = 0
 
-            set_high_water_mark(self.publisher, config)
-            set_tcp_keepalive(self.publisher, config)
+            self._add_budget(
+                self.publisher, set_high_water_mark(self.publisher, self.c))
+            set_tcp_keepalive(self.publisher, self.c)
 
             # Set a zmq_linger, thus doing a little bit more to ensure that our
             # message gets to the fedmsg-relay (*if* we're talking to the relay
             # which is the case when method == 'connect').
             if method == 'connect':
-                self.publisher.setsockopt(zmq.LINGER, config['zmq_linger'])
-
-            # "Listify" our endpoints.  If we're given a list, good.  If we're
-            # given a single item, turn it into a list of length 1.
-            config['endpoints'][config['name']] = list(iterate(
-                config['endpoints'][config['name']]))
-
-            # Try endpoint after endpoint in the list of endpoints.  If we
-            # succeed in establishing one, then stop.  *That* is our publishing
-            # endpoint.
-            _established = False
-            for endpoint in config['endpoints'][config['name']]:
-                self.log.debug("Trying to %s to %s" % (method, endpoint))
-                if method == 'bind':
-                    endpoint = "tcp://*:{port}".format(
-                        port=endpoint.rsplit(':')[-1]
-                    )
+                self.publisher.setsockopt(zmq.LINGER, self.c['zmq_linger'])
 
-                try:
-                    # Call either bind or connect on the new publisher.
-                    # This will raise an exception if there's another process
-                    # already using the endpoint.
-                    getattr(self.publisher, method)(endpoint)
-                    # If we can do this successfully, then stop trying.
-                    _established = True
-                    break
-                except zmq.ZMQError:
-                    # If we fail to bind or connect, there's probably another
-                    # process already using that endpoint port.  Try the next
-                    # one.
-                    pass
-
-            # If we make it through the loop without establishing our
-            # connection, then there are not enough endpoints listed in the
-            # config for the number of processes attempting to use fedmsg.
-            if not _established:
-                raise IOError(
-                    "Couldn't find an available endpoint "
-                    "for name %r" % config.get("name", None))
-
-        elif config.get('mute', False):
+            # Watch the socket so we know when a peer shows up.  This has to
+            # be set up before we bind or connect, or we'd miss the event.
+            # An XPUB socket gets told about subscriptions instead.
+            if self._subscriptions is None:
+                monitor = self._monitor_publisher()
+
+            try:
+                self._lease = self._claim_endpoint(
+                    self.publisher, self.c['name'], method)
+            except IOError:
+                self._close_monitor(monitor)
+                raise
+
+        elif self.c.get('mute', False):
             # Our caller doesn't intend to send any messages.  Pass silently.
             pass
-        elif config.get('zmq_enabled', True):
+        elif self.c.get('zmq_enabled', True):
             # Something is wrong.
             warnings.warn(
                 "fedmsg is not configured to send any zmq messages "
-                "for name %r" % config.get("name", None))
+                "for name %r" % self.c.get("name", None))
         else:
             # We're not configured to send zmq messages, but zmq_enabled is
             # False, so no need to warn the user.
             pass
 
-        # Cleanup.  See https://bit.ly/SaGeOr for discussion.
-        # arg signature - weakref.ref(object [, callback])
-        weakref.ref(threading.current_thread(), self.destroy)
+        return monitor
+
+    def _publisher_type(self, method):
+        """ Return the type of socket to publish with. """
+        # An XPUB socket tells us what its subscribers want, so that we can
+        # skip building messages nobody will get.  It is also the only kind
+        # that can wait for a slow subscriber instead of dropping its
+        # messages, and the only kind that can tell whether the fedmsg-relay
+        # is there.  Its first subscription is also the moment messages stop
+        # being dropped.
+        if self.c.get('publish_lazy', False) or \
+                self.c.get('high_water_mark_policy', 'drop') == 'block' or \
+                method == 'connect' or self._spool is not None:
+            return zmq.XPUB
+        return zmq.PUB
+
+    def _claim_endpoint(self, sock, name, method):
+        """ Bind or connect ``sock`` to the first free endpoint of ``name``.
+
+        Returns the lease on the endpoint, if we took one.
+        """
+        # "Listify" our endpoints.  If we're given a list, good.  If we're
+        # given a single item, turn it into a list of length 1.
+        endpoints = self.c['endpoints'][name] = list(iterate(
+            self.c['endpoints'][name]))
+
+        # Try endpoint after endpoint in the list of endpoints.  If we
+        # succeed in establishing one, then stop.  *That* is our publishing
+        # endpoint.  With a lease directory, skip straight to endpoints
+        # that no other process on this host has claimed.
+        lease_dir = self.c.get('endpoint_lease_dir')
+        if method == 'bind' and lease_dir:
+            candidates = leased_endpoints(lease_dir, name, endpoints)
+        else:
+            candidates = ((endpoint, None) for endpoint in endpoints)
+
+        for endpoint, lease in candidates:
+            self.log.debug("Trying to %s to %s" % (method, endpoint))
+            twin = ipc_endpoint(self.c, name, endpoint)
+            if method == 'bind':
+                endpoint = "tcp://*:{port}".format(
+                    port=endpoint.rsplit(':')[-1]
+                )
+
+            try:
+                # Call either bind or connect on the new publisher.
+                # This will raise an exception if there's another process
+                # already using the endpoint.
+                getattr(sock, method)(endpoint)
+                # If we can do this successfully, then stop trying.
+                if method == 'bind' and twin:
+                    self._bind_ipc(sock, twin)
+                return lease
+            except zmq.ZMQError:
+                # If we fail to bind or connect, there's probably another
+                # process already using that endpoint port.  Try the next
+                # one.
+                if lease is not None:
+                    os.close(lease)
+
+        # If we make it through the loop without establishing our
+        # connection, then there are not enough endpoints listed in the
+        # config for the number of processes attempting to use fedmsg.
+        raise IOError(
+            "Couldn't find an available endpoint for name %r" % name)
+
+    def _bind_ipc(self, sock, endpoint):
+        """ Also bind ``sock`` to ``endpoint``, for subscribers on this host.
+
+        The TCP endpoint is what counts, so failing here only costs the
+        local subscribers a detour through TCP.
+        """
+        try:
+            sock.bind(endpoint)
+        except zmq.ZMQError as e:
+            self.log.warning("Couldn't bind to %s: %s" % (endpoint, e))
+
+    def _setup_lanes(self, method):
+        """ Create a publishing socket for each of our priority lanes.
+
+        Only lanes with endpoints listed for our name get one; see
+        :ref:`conf-priority-lanes`.
+        """
+        self._lanes, self._lane_cache = [], {}
+        if method != 'bind' or not getattr(self, 'publisher', None):
+            return
+
+        lanes = sorted(
+            self.c.get('priority_lanes', None) or {},
+            key=lambda lane: -self._lane_priority(lane))
+        for lane in lanes:
+            name = "%s@%s" % (self.c['name'], lane)
+            if not self.c['endpoints'].get(name):
+                continue
+
+            settings = self.c['priority_lanes'][lane]
+            sock = self.context.socket(zmq.PUB)
+            self._add_budget(sock, set_high_water_mark(sock, dict(
+                self.c,
+                high_water_mark=settings.get(
+                    'high_water_mark', self.c.get('high_water_mark', 0)),
+                high_water_mark_bytes=settings.get(
+                    'high_water_mark_bytes',
+                    self.c.get('high_water_mark_bytes', None)),
+            )))
+            set_tcp_keepalive(sock, self.c)
+            try:
+                lease = self._claim_endpoint(sock, name, method)
+            except IOError:
+                sock.close()
+                raise
+            self._lanes.append(_Lane(lane, settings.get('topics', []), sock, lease))
+
+    def _add_budget(self, sock, budget):
+        """ Remember the byte budget of ``sock``, if it has one. """
+        if budget is not None:
+            self._budgets[sock] = budget
+
+    def _lane_priority(self, lane):
+        """ Return the priority of ``lane``; anything else has priority 0. """
+        if lane is None:
+            return 0
+        settings = (self.c.get('priority_lanes', None) or {}).get(lane, {})
+        return settings.get('priority', 1)
+
+    def _lane_for(self, topic):
+        """ Return the lane of messages on ``topic``, or ``None``. """
+        if not self._lanes:
+            return None
+
+        try:
+            return self._lane_cache[topic]
+        except KeyError:
+            if len(self._lane_cache) >= 1024:
+                self._lane_cache.clear()
+            decoded = topic.decode('utf-8')
+            lane = self._lane_cache[topic] = next(
+                (lane for lane in self._lanes if lane.matches(decoded)), None)
+            return lane
+
+    def _socket_for(self, topic):
+        """ Return the publishing socket for messages on ``topic``. """
+        lane = self._lane_for(topic)
+        return lane.socket if lane else self.publisher
+
+    def _start_queue(self):
+        """ Start the background publishing queue, if we're configured to. """
+        # Hand signing, storing and sending off to a background thread.  It
+        # becomes the only user of the publisher socket.
+        if self.c.get('publish_async', False) and \
+                getattr(self, 'publisher', None):
+            linger = None
+            if self.c.get('publish_coalesce', False):
+                linger = self.c.get('publish_coalesce_linger', 0.005)
+            self._queue = PublishQueue(
+                self,
+                maxsize=self.c.get('publish_queue_size', 1000),
+                overflow=self.c.get('publish_queue_overflow', 'block'),
+                linger=linger,
+            )
+
+    def _monitor_publisher(self):
+        """ Return a socket reporting when the publisher meets a peer.
+
+        Returns ``None`` if :ref:`conf-post-init-handshake` is disabled or if
+        our zeromq can't do it.
+        """
+        if not self.c.get('post_init_handshake', True) or \
+                not hasattr(self.publisher, 'get_monitor_socket'):
+            return None
+
+        # Prefer the end of the zmtp handshake, which is as close as we can
+        # get to "the subscriber is there", but take plain TCP events from
+        # versions of libzmq that don't report it.
+        events = getattr(zmq, 'EVENT_HANDSHAKE_SUCCEEDED', None) or \
+            zmq.EVENT_CONNECTED | zmq.EVENT_ACCEPTED
+        try:
+            return self.publisher.get_monitor_socket(events)
+        except zmq.ZMQError:
+            return None
+
+    def _close_monitor(self, monitor):
+        if monitor is not None:
+            self.publisher.disable_monitor()
+            monitor.close()
+
+    def _waits_for_subscription(self):
+        """ Return whether init waits for a subscription to our publisher.
+
+        The end of the handshake comes before the peer's subscription does,
+        and a PUB socket drops whatever it is given in between.  An XPUB
+        socket can wait for the subscription itself.
+        """
+        return self._subscriptions is not None and \
+            self.c.get('post_init_handshake', True)
+
+    def _wait_for_peer(self, monitor, timeout):
+        """ Wait up to ``timeout`` seconds for a peer to reach our publisher.
+
+        Without a monitor or an XPUB socket this sleeps the whole
+        ``timeout``, which is what fedmsg has always done.
+        """
+        if self._waits_for_subscription():
+            sock = zmq.Socket.shadow(self.publisher.underlying)
+            if sock.poll(timeout * 1000):
+                self.log.debug("publisher has a subscriber")
+            else:
+                self.log.debug("nobody subscribed to the publisher in %ss" % timeout)
+            self._read_subscriptions()
+            return
 
-        # Sleep just to make sure that the socket gets set up before anyone
-        # tries anything.  This is a documented zmq 'feature'.
-        time.sleep(config['post_init_sleep'])
+        if monitor is None:
+            time.sleep(timeout)
+            return
+
+        try:
+            if monitor.poll(timeout * 1000):
+                self.log.debug("publisher has a peer")
+            else:
+                self.log.debug("no peer reached the publisher in %ss" % timeout)
+        finally:
+            self._close_monitor(monitor)
 
     def destroy(self):
         """ Destroy a fedmsg context """
 
+        if getattr(self, '_summary_timer', None) is not None:
+            self._summary_timer.cancel()
+            self._summary_timer = None
+
+        if getattr(self, '_limiter', None) and getattr(self, 'publisher', None):
+            # Report what the rate limits held back, however recently.
+            try:
+                self._flush_summaries(force=True)
+            except Exception:
+                self.log.exception("Failed to send the rate limit summaries")
+
+        if getattr(self, '_queue', None):
+            # Send whatever is still queued before the socket goes away.
+            self._queue.close()
+            self._queue = None
+
+        if getattr(self, '_spool', None):
+            # If the fedmsg-relay is there after all, send what we spooled
+            # while the publisher can still linger on it.  Otherwise, let
+            # other processes drain it.
+            self._spool.seal()
+            if getattr(self, 'publisher', None) and self._relay_ready():
+                publisher = self.publisher
+                self._spool.drain(
+                    lambda payloads: fedmsg.spool.send_spooled(
+                        publisher, payloads),
+                    max(1, self.c.get('spool_batch_size', 100)))
+
+        if getattr(self, '_flusher', None):
+            self._flusher.close()
+            self._flusher = None
+
         if getattr(self, 'publisher', None):
             self.log.debug("closing fedmsg publisher")
             self.log.debug("sent %i messages" % self._i)
             self.publisher.close()
             self.publisher = None
 
+        for lane in getattr(self, '_lanes', []):
+            lane.close()
+        self._lanes = []
+        self._budgets = {}
+
+        if getattr(self, '_shared', None):
+            # The zeromq context belongs to the shared publisher, which goes
+            # away with its last user.
+            self.context = None
+            _release_shared_publisher(self._shared)
+            self._shared = None
+
         if getattr(self, 'context', None):
             self.context.term()
             self.context = None
 
+        if getattr(self, '_lease', None) is not None:
+            os.close(self._lease)
+            self._lease = None
+
+    def _check_fork(self):
+        """ Start over with fresh sockets if we were forked since init.
+
+        zeromq contexts and sockets can't be shared between a parent and its
+        child.  A context created before a prefork server forks its workers
+        would otherwise silently publish nothing.
+        """
+        if self._pid == _getpid():
+            return
+
+        self.log.debug("fork detected, re-initializing the fedmsg context")
+        self._pid = _getpid()
+        # Our parent keeps counting too.
+        self._sender = uuid.uuid4().hex
+
+        # Everything below belongs to our parent; drop it without closing it.
+        # Our copy of the lease fd can go, the parent's copy keeps the lock.
+        self.publisher, self._queue, self._shared = None, None, None
+        self._summary_timer = None
+        if self._send_lock is not None:
+            # The timer thread that may have held it didn't come along.
+            self._send_lock = threading.Lock()
+        self._flusher = None
+        if self._spool is not None:
+            # The segment our parent is writing stays its own.
+            self._spool = fedmsg.spool.Spool(self._spool.directory)
+        if self._lease is not None:
+            os.close(self._lease)
+            self._lease = None
+        for lane in self._lanes:
+            if lane.lease is not None:
+                os.close(lane.lease)
+        self._lanes = []
+        self._budgets = {}
+        self._peers = {}
+
+        self._init_sockets()
+
     def send_message(self, topic=None, msg=None, modname=None):
         warnings.warn(
             ".send_message is deprecated. Use .publish", DeprecationWarning)
@@ -254,9 +1165,10 @@ class FedMsgContext(object):
             string JSON serialization will be applied to that string.
         :type msg: dict
         :param modname: The module name that is publishing the message. If this
-            is omitted, ``fedmsg`` will try to guess the name of the module
-            that called it and use that to produce an intelligent topic.
-            Specifying ``modname`` explicitly overrides this behavior.
+            is omitted, the :ref:`conf-default-modname` setting is used.  If
+            that is not set either, ``fedmsg`` will try to guess the name of
+            the module that called it and use that to produce an intelligent
+            topic. Specifying ``modname`` explicitly overrides this behavior.
         :type modname: unicode
         :param pre_fire_hook: A callable that will be called with a single
             argument -- the dict of the constructed message -- just before it
@@ -264,11 +1176,176 @@ class FedMsgContext(object):
         :type pre_fire_hook: function
         """
 
-        topic = topic or 'unspecified'
-        msg = msg or dict()
+        # If no modname is supplied, then use the configured default or guess
+        # it from the call stack.
+        modname = modname or self.c.get('default_modname') or \
+            guess_calling_module(default="fedmsg")
+
+        return self.publisher_for(modname).publish(topic, msg, pre_fire_hook)
+
+    def publish_many(self, messages, pre_fire_hook=None, **kw):
+        """
+        Send a batch of messages over the publishing zeromq socket.
+
+            >>> import fedmsg
+            >>> fedmsg.publish_many([
+            ...     ('repo.update', {'repo': 'fedmsg'}, 'git'),
+            ...     ('repo.update', {'repo': 'datanommer'}, 'git'),
+            ... ])
+
+        This behaves exactly like calling :meth:`publish` once for each item,
+        but the work that does not depend on the individual message is done
+        only once per batch: the calling module is guessed at most once and
+        each message is built by the :class:`PreparedPublisher` for its
+        ``modname``.  If the ``persistent_store`` provides an ``add_many``
+        method, sequence ids for the whole batch are assigned with a single
+        call.
+
+        :param messages: An iterable of ``(topic, msg)`` or
+            ``(topic, msg, modname)`` tuples, with the same meaning as the
+            arguments of :meth:`publish`.
+        :type messages: iterable
+        :param pre_fire_hook: A callable that will be called with the dict of
+            each constructed message just before it is handed off to ZeroMQ.
+        :type pre_fire_hook: function
+        :returns: The number of messages published, not counting those held
+            back by :ref:`conf-publish-rate-limits`.
+        :rtype: int
+        """
+
+        batch = self._envelopes(messages)
+        self._dispatch(batch, pre_fire_hook)
+        return len(batch)
+
+    def _envelopes(self, messages):
+        """ Build the ``(topic, msg)`` envelopes for :meth:`publish_many`. """
+        default_modname = self.c.get('default_modname')
+        batch = []
+        for item in messages:
+            modname = item[2] if len(item) > 2 else None
+
+            if not modname:
+                if default_modname is None:
+                    default_modname = guess_calling_module(default="fedmsg")
+                modname = default_modname
+
+            publisher = self.publisher_for(modname)
+            if self._admit(publisher.topic(item[0] or 'unspecified')):
+                batch.append(publisher.envelope(item[0], item[1]))
+
+        return batch
+
+    def _admit(self, topic):
+        """ Return whether :ref:`conf-publish-rate-limits` let ``topic`` through.
+        """
+        if self._limiter is None or self._limiter.admit(topic.decode('utf-8')):
+            return True
+        self._schedule_summaries()
+        return False
+
+    def _with_summaries(self, batch, force=False):
+        """ Put the rate limit summaries that are due in front of ``batch``. """
+        if self._limiter is None:
+            return batch
+
+        publisher = self.publisher_for('fedmsg')
+        return [
+            publisher.envelope('rate_limit.summary', body)
+            for body in self._limiter.summaries(force)
+        ] + batch
+
+    def _schedule_summaries(self):
+        """ Have the next rate limit summary sent when it falls due, even if
+        nothing else is published by then.
+        """
+        if self._summary_timer is not None:
+            return
+        due = self._limiter.next_summary()
+        if due is None:
+            return
+
+        self._summary_timer = threading.Timer(
+            max(0, due - self._limiter.clock()), self._send_summaries)
+        self._summary_timer.daemon = True
+        self._summary_timer.start()
+
+    def _send_summaries(self):
+        self._summary_timer = None
+        if not getattr(self, 'publisher', None):
+            return
+        try:
+            self._flush_summaries()
+        except Exception:
+            self.log.exception("Failed to send the rate limit summaries")
+        # The rules may have started holding messages back again since.
+        self._schedule_summaries()
+
+    def _flush_summaries(self, force=False):
+        """ Send the rate limit summaries that are due, or all of them with
+        ``force``, without waiting for another message.
+        """
+        batch = self._with_summaries([], force)
+        if not batch:
+            return
+
+        if self._queue is not None:
+            self._queue.put(batch)
+        else:
+            self._process_locked(batch)
+
+    def rate_limit_stats(self):
+        """
+        Return what :ref:`conf-publish-rate-limits` did to our messages.
+
+        This returns ``None`` if no rate limits are configured.  Otherwise, it
+        maps each pattern to a dict with these counters:
+
+        ``passed``
+            Messages published within the rate.
+        ``dropped``
+            Messages over the rate that were discarded.
+        ``sampled``
+            Messages over the rate that were published anyway, as samples.
+        ``summarized``
+            Messages over the rate that were counted in a summary message.
+        ``summaries``
+            Summary messages sent.
+
+        :rtype: dict
+        """
+        if self._limiter is None:
+            return None
+        return self._limiter.stats()
+
+    def publisher_for(self, modname):
+        """
+        Return a :class:`PreparedPublisher` bound to ``modname``.
+
+        Everything about a message that doesn't change from one message to the
+        next (the topic prefix, the username, the signing identity, ...) is
+        worked out once, when the prepared publisher is created.  Callers that
+        publish a lot of messages can hold on to it and skip that work::
+
+            >>> import fedmsg
+            >>> bodhi = fedmsg.init().publisher_for('bodhi')
+            >>> bodhi.publish('update.request.testing', msg={'update': update})
+
+        Prepared publishers are cached, so calling this repeatedly with the
+        same ``modname`` returns the same object.
+
+        :param modname: The module name used to build the topics of messages
+            sent with the returned publisher.
+        :type modname: unicode
+        :rtype: PreparedPublisher
+        """
+        try:
+            return self._prepared[modname]
+        except KeyError:
+            publisher = self._prepared[modname] = PreparedPublisher(self, modname)
+            return publisher
 
-        # If no modname is supplied, then guess it from the call stack.
-        modname = modname or guess_calling_module(default="fedmsg")
+    def _build_topic(self, topic, modname):
+        """ Return the fully qualified topic, as utf-8 encoded bytes. """
         topic = '.'.join([modname, topic])
 
         if topic[:len(self.c['topic_prefix'])] != self.c['topic_prefix']:
@@ -281,53 +1358,354 @@ class FedMsgContext(object):
         if isinstance(topic, six.text_type):
             topic = to_bytes(topic, encoding='utf8', nonstring="passthru")
 
-        year = datetime.datetime.now().year
+        return topic
 
-        self._i += 1
-        msg = dict(
-            topic=topic.decode('utf-8'),
-            msg=msg,
-            timestamp=int(time.time()),
-            msg_id=str(year) + '-' + str(uuid.uuid4()),
-            i=self._i,
-            username=getpass.getuser(),
-        )
+    def _crypto_config(self):
+        """ Return the config to sign with, with our signing identity resolved.
+
+        This is computed once and cached; the context's own config is not
+        modified.
+        """
+        if self._signing_config is not None:
+            return self._signing_config
 
         # Find my message-signing cert if I need one.
-        if self.c.get('sign_messages', False):
-            if not self.c.get("crypto_backend") == "gpg":
-                if 'cert_prefix' in self.c:
-                    cert_index = "%s.%s" % (self.c['cert_prefix'],
-                                            self.hostname)
-                else:
-                    cert_index = self.c['name']
-                    if cert_index == 'relay_inbound':
-                        cert_index = "shell.%s" % self.hostname
+        config = dict(self.c)
+        if not config.get("crypto_backend") == "gpg":
+            if 'cert_prefix' in config:
+                cert_index = "%s.%s" % (config['cert_prefix'],
+                                        self.hostname)
+            else:
+                cert_index = config['name']
+                if cert_index == 'relay_inbound':
+                    cert_index = "shell.%s" % self.hostname
+
+            config['certname'] = config['certnames'][cert_index]
+        else:
+            if 'gpg_signing_key' not in config:
+                config['gpg_signing_key'] = config['gpg_keys'][self.hostname]
+
+        self._signing_config = config
+        return config
+
+    def flush(self):
+        """
+        Block until every message handed to :meth:`publish` has been sent.
+
+        This only matters when :ref:`conf-publish-async` is enabled;
+        otherwise messages are sent before :meth:`publish` returns.
+        """
+        if self._queue is not None:
+            self._queue.flush()
+
+    def queue_stats(self):
+        """
+        Return the counters of the background publishing queue.
+
+        See :ref:`conf-publish-async`.  When it is disabled, this returns
+        ``None``.
+
+        :rtype: dict
+        """
+        if self._queue is not None:
+            return self._queue.stats()
+
+    def stats(self):
+        """
+        Return counters and timings for the messages published so far.
+
+        This returns ``None`` unless :ref:`conf-publish-stats` is enabled.
+        Otherwise, it is a dict with these keys:
+
+        ``messages``, ``bytes``
+            The number of messages sent and the size of their encoded bodies.
+        ``topics``
+            The same two counters, by topic.
+        ``again``
+            The number of sends zeromq refused because its queue was full.
+            Note that PUB sockets silently drop messages at the high water mark
+            instead, so this only counts what zeromq reports.
+        ``skipped``
+            The number of messages dropped because no subscriber wanted them,
+            when :ref:`conf-publish-lazy` is enabled.
+        ``stages``
+            For each of ``topic``, ``sign``, ``store``, ``encode`` and
+            ``send``: the number of times the stage ran, the total and
+            maximum time spent in it, in seconds, and a histogram of those
+            durations as ``(upper_bound, count)`` pairs.
+
+        :rtype: dict
+        """
+        return self._stats.as_dict()
+
+    def loss_stats(self):
+        """
+        Return how many messages :meth:`tail_messages` saw go missing.
+
+        This is worked out from the ``i`` counter of each message (see
+        :class:`fedmsg.stats.LossStats`), and only while subscribed to every
+        topic.  The result maps each endpoint to a dict with these keys:
+
+        ``received``
+            The number of messages received.
+        ``lost``
+            The number of messages that never arrived.
+        ``loss_rate``
+            ``lost`` as a fraction of the messages sent.
+        ``restarts``
+            The number of times a publisher started counting over.
+        ``reordered``
+            The number of messages that arrived out of order.
+
+        :rtype: dict
+        """
+        return self._loss.as_dict()
+
+    def latency_stats(self):
+        """
+        Return how long the messages :meth:`tail_messages` got took to come.
+
+        Only messages of publishers with :ref:`conf-publish-trace` enabled
+        count.  The result maps each pair of hops, like
+        ``"publish->receive"``, to a histogram of the time it took in seconds
+        (see :class:`fedmsg.stats.LatencyStats`).
+
+        :rtype: dict
+        """
+        return self._latency.as_dict()
 
-                self.c['certname'] = self.c['certnames'][cert_index]
+    def _next_i(self, topic):
+        """ Return the sender id and the next value of the message counter
+        of the socket messages on ``topic`` go out on.
+        """
+        if self._shared is not None:
+            # One counter for everything sent over the shared socket.
+            self._i = next(self._shared.counter)
+            return self._shared.sender, self._i
+
+        lane = self._lane_for(topic)
+        if lane is not None:
+            lane.i += 1
+            return lane.sender, lane.i
+
+        self._i += 1
+        return self._sender, self._i
+
+    def _dispatch(self, batch, pre_fire_hook=None):
+        """ Send a list of ``(topic, msg)`` envelopes, now or in the background.
+        """
+        self._check_fork()
+        batch = self._with_summaries(batch)
+        if not batch:
+            return
+
+        if self._queue is not None:
+            self._queue.put(batch, pre_fire_hook)
+        else:
+            self._process_locked(batch, pre_fire_hook)
+
+    def _process_locked(self, batch, pre_fire_hook=None):
+        """ :meth:`_process` ``batch``, taking turns with the summary timer.
+        """
+        if self._send_lock is None:
+            self._process(batch, pre_fire_hook)
+            return
+
+        with self._send_lock:
+            self._process(batch, pre_fire_hook)
+
+    def _process(self, batch, pre_fire_hook=None):
+        """ Sign, store and send a list of ``(topic, msg)`` envelopes. """
+        self._send_all(self._prepare(batch, pre_fire_hook))
+
+    def _prepare(self, batch, pre_fire_hook=None):
+        """ Sign and store a list of ``(topic, msg)`` envelopes.
+
+        Returns the envelopes of the finished messages, after calling
+        ``pre_fire_hook`` on each of them.
+        """
+        batch = self._filter(batch)
+        if not batch:
+            return []
+
+        if len(batch) == 1:
+            msgs = [self._sign_and_store(batch[0][1])]
+        else:
+            msgs = self._sign_and_store_many([msg for _, msg in batch])
+
+        if pre_fire_hook:
+            for msg in msgs:
+                pre_fire_hook(msg)
+
+        return [(topic, msg) for (topic, _), msg in zip(batch, msgs)]
+
+    def _send_all(self, envelopes):
+        """ Send finished envelopes, coalescing them if configured to. """
+        if len(envelopes) == 1 or not self.c.get('publish_coalesce', False):
+            for topic, msg in envelopes:
+                self._send(topic, msg)
+            return
+
+        # Group the messages by topic, keeping the order within each topic.
+        groups, topics = {}, []
+        for topic, msg in envelopes:
+            if topic not in groups:
+                groups[topic] = []
+                topics.append(topic)
+            groups[topic].append(msg)
+
+        for topic in topics:
+            self._send_group(topic, groups[topic])
+
+    def _filter(self, batch):
+        """ Drop the envelopes no subscriber wants, if we know what they want.
+        """
+        if self._subscriptions is None:
+            return batch
+
+        self._read_subscriptions()
+        if not self.c.get('publish_lazy', False):
+            return batch
+
+        wanted = [envelope for envelope in batch if self._is_wanted(envelope[0])]
+        if len(wanted) != len(batch):
+            self._stats.add_skipped(len(batch) - len(wanted))
+        return wanted
+
+    def _read_subscriptions(self):
+        """ Apply the (un)subscriptions waiting on our XPUB socket. """
+        # A plain socket sharing the publisher's zeromq socket, so that this
+        # also works for the asyncio flavour of the context.
+        sock = zmq.Socket.shadow(self.publisher.underlying)
+        while True:
+            try:
+                frame = sock.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+
+            # The first byte is 1 for a subscription, 0 for its removal.  The
+            # socket only tells us about the first and the last subscriber to
+            # a prefix, so a set is enough to keep track.  Removals caused by
+            # a disconnection may show up a call late, which at worst means
+            # building one message for nobody.
+            if frame[:1] == b'\x01':
+                self._subscriptions.add(frame[1:])
+            elif frame[:1] == b'\x00':
+                self._subscriptions.discard(frame[1:])
             else:
-                if 'gpg_signing_key' not in self.c:
-                    self.c['gpg_signing_key'] = self.c['gpg_keys'][self.hostname]
+                continue
+            self._wanted.clear()
+
+    def _relay_ready(self):
+        """ Return whether the fedmsg-relay is subscribed to our publisher.
 
+        Once it is, the segment of the spool we were writing can be drained.
+        """
+        self._read_subscriptions()
+        if not self._subscriptions:
+            return False
+        self._spool.seal()
+        return True
+
+    def _is_wanted(self, topic):
+        try:
+            return self._wanted[topic]
+        except KeyError:
+            if len(self._wanted) >= 1024:
+                self._wanted.clear()
+            result = self._wanted[topic] = any(
+                topic.startswith(prefix) for prefix in self._subscriptions)
+            return result
+
+    def _offload(self, msg):
+        """ Move the big fields of ``msg`` to the blob store, if configured.
+
+        This comes before signing, so that the signature covers the digests.
+        """
+        store = self.c.get('blob_store', None)
+        if not store:
+            return msg
+
+        body = fedmsg.blobs.offload(
+            msg['msg'], store, self.c.get('blob_threshold', 65536))
+        if body is not msg['msg']:
+            msg = dict(msg, msg=body)
+        return msg
+
+    def _sign_and_store(self, msg):
+        """ Sign ``msg`` and add it to the persistent store, if configured. """
+        msg = self._offload(msg)
         if self.c.get('sign_messages', False):
-            msg = fedmsg.crypto.sign(msg, **self.c)
+            with self._stats.time('sign'):
+                msg = fedmsg.crypto.sign(msg, **self._crypto_config())
 
         store = self.c.get('persistent_store', None)
         if store:
             # Add the seq_id field
-            msg = store.add(msg)
+            with self._stats.time('store'):
+                msg = store.add(msg)
 
-        if pre_fire_hook:
-            pre_fire_hook(msg)
+        return msg
+
+    def _sign_and_store_many(self, msgs):
+        """ Like :meth:`_sign_and_store`, but for a list of messages. """
+        msgs = [self._offload(msg) for msg in msgs]
+        if self.c.get('sign_messages', False):
+            config = self._crypto_config()
+            with self._stats.time('sign'):
+                msgs = [fedmsg.crypto.sign(msg, **config) for msg in msgs]
+
+        store = self.c.get('persistent_store', None)
+        if store:
+            # Add the seq_id fields, in one go if the store knows how.
+            with self._stats.time('store'):
+                if hasattr(store, 'add_many'):
+                    msgs = store.add_many(msgs)
+                else:
+                    msgs = [store.add(msg) for msg in msgs]
+
+        return msgs
+
+    def _send(self, topic, msg):
+        """ Hand a fully constructed message off to the transport. """
+        self._send_group(topic, [msg])
+
+    def _send_group(self, topic, msgs):
+        """ Hand messages sharing a topic off to the transport.
+
+        Over zeromq, they go out as one multipart message: the topic frame
+        followed by a frame for each message body.
+        """
+        with self._stats.time('encode'):
+            payloads = [
+                fedmsg.encoding.dumps(msg).encode('utf-8') for msg in msgs]
+
+        if self._spool is not None and not self._relay_ready():
+            # Keep them until the fedmsg-relay is back.
+            self._spool.append(payloads)
 
         # We handle zeromq publishing ourselves.  But, if that is disabled,
         # defer to the moksha' hub's twisted reactor to send messages (if
         # available).
-        if self.c.get('zmq_enabled', True):
-            self.publisher.send_multipart(
-                [topic, fedmsg.encoding.dumps(msg).encode('utf-8')],
-                flags=zmq.NOBLOCK,
-            )
+        elif self.c.get('zmq_enabled', True):
+            sock = self._socket_for(topic)
+            frames = [topic] + payloads
+            if self._trace:
+                trace = _trace_frame([['publish', self.hostname, _time_ns()]])
+                frames = [topic]
+                for payload in payloads:
+                    frames.extend((payload, trace))
+            try:
+                with self._stats.time('send'):
+                    sock.send_multipart(frames, flags=self._send_flags)
+            except zmq.Again:
+                self._stats.add_again()
+                raise
+
+            budget = self._budgets.get(sock)
+            if budget is not None:
+                for payload in payloads:
+                    budget.add(len(payload))
         else:
             # Perhaps we're using STOMP or AMQP?  Let moksha handle it.
             import moksha.hub
@@ -336,21 +1714,32 @@ class FedMsgContext(object):
                 raise AttributeError("Unable to publish non-zeromq msg "
                                      "without moksha-hub initialization.")
             # Let moksha.hub do our work.
-            moksha.hub._hub.send_message(
-                topic=topic,
-                message=fedmsg.encoding.dumps(msg).encode('utf-8'),
-                jsonify=False,
-            )
+            with self._stats.time('send'):
+                for payload in payloads:
+                    moksha.hub._hub.send_message(
+                        topic=topic,
+                        message=payload,
+                        jsonify=False,
+                    )
+
+        for msg, payload in zip(msgs, payloads):
+            self._stats.add_message(msg['topic'], len(payload))
 
-    def tail_messages(self, topic="", passive=False, **kw):
+    def tail_messages(self, topic="", passive=False, lazy=False, **kw):
         """
         Subscribe to messages published on the sockets listed in :ref:`conf-endpoints`.
 
         Args:
-            topic (six.text_type): The topic to subscribe to. The default is to
-                subscribe to all topics.
+            topic (six.text_type or list): The topic prefix to subscribe to, or
+                a list of them.  The publishers drop the rest before it goes
+                on the wire.  The default is to subscribe to all topics.
             passive (bool): If ``True``, bind to the :ref:`conf-endpoints` sockets
                 instead of connecting to them. Defaults to ``False``.
+            lazy (bool): If ``True``, yield messages as
+                :class:`fedmsg.encoding.LazyMessage` objects, decoded only once
+                they are looked at, when neither signature validation nor
+                replay needs them first.  This pays off for tools that pass on
+                most of the traffic.  :meth:`loss_stats` doesn't count them.
             **kw: Additional keyword arguments. Currently none are used.
 
         Yields:
@@ -364,12 +1753,72 @@ class FedMsgContext(object):
 
         poller, subs = self._create_poller(topic=topic, passive=False, **kw)
         try:
-            for msg in self._poll(poller, subs):
+            for msg in self._poll(
+                    poller, subs, track_loss='' in _prefixes(topic) and not lazy,
+                    lazy=lazy):
                 yield msg
         finally:
             self._close_subs(subs)
 
+    def tail_batches(self, topic="", passive=False, max_batch=100,
+                     max_latency=0.1, lazy=False, **kw):
+        """
+        Like :meth:`tail_messages`, but yield lists of messages.
+
+        Every socket that is ready is drained of up to ``max_batch`` messages
+        without going back to the poller, which is much cheaper under load.
+        This suits consumers that do their work in bulk, like writing to a
+        database.
+
+        Args:
+            topic (six.text_type or list): The topic prefix to subscribe to, or
+                a list of them.  The publishers drop the rest before it goes
+                on the wire.  The default is to subscribe to all topics.
+            passive (bool): If ``True``, bind to the :ref:`conf-endpoints` sockets
+                instead of connecting to them. Defaults to ``False``.
+            max_batch (int): The most messages in a batch.
+            max_latency (float): The most seconds the first message of a batch
+                waits for the batch to fill up.
+            lazy (bool): See :meth:`tail_messages`.
+            **kw: Additional keyword arguments. Currently none are used.
+
+        Yields:
+            list: Lists of one to ``max_batch`` 4-tuples in the form
+            (name, endpoint, topic, message).
+        """
+
+        if not self.c.get('zmq_enabled', True):
+            raise ValueError("fedmsg.tail_batches() is only available for "
+                             "zeromq.  Use the hub-consumer approach for "
+                             "STOMP or AMQP support.")
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1, not %r" % max_batch)
+
+        poller, subs = self._create_poller(topic=topic, passive=False, **kw)
+        try:
+            for batch in self._poll_batches(
+                    poller, subs, max_batch, max_latency,
+                    track_loss='' in _prefixes(topic) and not lazy, lazy=lazy):
+                yield batch
+        finally:
+            self._close_subs(subs)
+
     def _create_poller(self, topic="", passive=False, **kw):
+        subs = self._create_subs(topic=topic, passive=passive, **kw)
+
+        # Register the sockets we just built with a zmq Poller.
+        poller = zmq.Poller()
+        for subscriber in subs:
+            poller.register(subscriber, zmq.POLLIN)
+
+        return (poller, subs)
+
+    def _create_subs(self, topic="", passive=False, **kw):
+        """ Return a dict mapping new SUB sockets to ``(name, endpoint)``.
+
+        Sockets shared by several endpoints, see :ref:`conf-subscriber-sockets`,
+        map to ``(None, None)``; :meth:`_attribute` sorts out who sent what.
+        """
         # TODO -- do the zmq_strict logic dance with "topic" here.
         # It is buried in moksha.hub, but we need it to work the same way
         # here.
@@ -378,8 +1827,7 @@ class FedMsgContext(object):
         # don't actually mean the same thing.  This should be resolved.
         method = (passive and 'bind') or 'connect'
 
-        failed_hostnames = []
-        subs = {}
+        endpoints = []
         for _name, endpoint_list in six.iteritems(self.c['endpoints']):
 
             # You never want to actually subscribe to this thing, but sometimes
@@ -389,68 +1837,231 @@ class FedMsgContext(object):
                 continue
 
             # Listify endpoint_list in case it is a single string
-            endpoint_list = iterate(endpoint_list)
-            for endpoint in endpoint_list:
-                # First, some sanity checking.  zeromq will potentially
-                # segfault if we don't do this check.
-                hostname = endpoint.split(':')[1][2:]
-                if hostname in failed_hostnames:
-                    continue
-
-                if hostname != '*':
-                    try:
-                        socket.gethostbyname_ex(hostname)
-                    except:  # noqa: E722
-                        failed_hostnames.append(hostname)
-                        self.log.warn("Couldn't resolve %r" % hostname)
-                        continue
+            for endpoint in iterate(endpoint_list):
+                endpoints.append((_name, endpoint, endpoint.split(':')[1][2:]))
+
+        # First, some sanity checking.  zeromq will potentially segfault if
+        # we don't do this check.  Look every host up at once, since dead
+        # ones can take a while to fail.
+        hostnames = set(hostname for _, _, hostname in endpoints)
+        hostnames.discard('*')
+        own = set()
+        if method == 'connect' and self.c.get('ipc_endpoints'):
+            # For the ipc:// shortcut, see subscription_endpoint.
+            own.add(socket.gethostname())
+        addresses = resolve_hostnames(hostnames | own, self.c)
+        resolved = set(hostname for hostname in hostnames if addresses[hostname])
+        resolved.add('*')
+        for hostname in sorted(hostnames - resolved):
+            self.log.warn("Couldn't resolve %r" % hostname)
+
+        # Peers can only be told apart by their address when we connect to
+        # them over TCP, and lanes need sockets of their own to come first.
+        shards = self.c.get('subscriber_sockets', None)
+        shared = []
 
-                # OK, sanity checks pass.  Create the subscriber and connect.
-                subscriber = self.context.socket(zmq.SUB)
-                subscriber.setsockopt(zmq.SUBSCRIBE, topic.encode('utf-8'))
+        subs = {}
+        for _name, endpoint, hostname in endpoints:
+            if hostname not in resolved:
+                continue
 
-                set_high_water_mark(subscriber, self.c)
-                set_tcp_keepalive(subscriber, self.c)
-                set_tcp_reconnect(subscriber, self.c)
+            # Take the ipc:// shortcut to publishers on this host.
+            if method == 'connect':
+                endpoint = subscription_endpoint(
+                    self.c, _name, endpoint, addresses)
 
-                getattr(subscriber, method)(endpoint)
-                subs[subscriber] = (_name, endpoint)
+            if shards and method == 'connect' and hostname != '*' and \
+                    endpoint.startswith('tcp://') and '@' not in _name:
+                shared.append((_name, endpoint, hostname))
+                continue
 
-        # Register the sockets we just built with a zmq Poller.
-        poller = zmq.Poller()
-        for subscriber in subs:
-            poller.register(subscriber, zmq.POLLIN)
+            # OK, sanity checks pass.  Create the subscriber and connect.
+            subscriber = self._create_sub(topic)
+            getattr(subscriber, method)(endpoint)
+            subs[subscriber] = (_name, endpoint)
+
+        for peers, group in _shard_endpoints(shared, addresses, shards or 1):
+            subscriber = self._create_sub(topic)
+            for endpoint in group:
+                subscriber.connect(endpoint)
+            self._peers[subscriber] = peers
+            subs[subscriber] = (None, None)
+
+        return subs
+
+    def _create_sub(self, topic):
+        subscriber = self.context.socket(zmq.SUB)
+        for prefix in _prefixes(topic):
+            subscriber.setsockopt(zmq.SUBSCRIBE, prefix.encode('utf-8'))
+
+        self._add_budget(
+            subscriber, set_high_water_mark(subscriber, self.c))
+        set_tcp_keepalive(subscriber, self.c)
+        set_tcp_reconnect(subscriber, self.c)
+        return subscriber
+
+    def _attribute(self, sock, frames, name, ep):
+        """ Return ``(name, endpoint)`` for ``frames``, received on ``sock``.
+
+        For sockets of our own that's ``name``, less its lane, and ``ep``.
+        Shared ones receive zero-copy frames, which know the address of the
+        publisher.
+        """
+        peers = self._peers.get(sock)
+        if peers is None:
+            return _lane_base(name), ep
 
-        return (poller, subs)
+        try:
+            address = frames[0].get('Peer-Address')
+        except (zmq.ZMQError, AttributeError):
+            address = None
+        if address and address.startswith('::ffff:'):
+            # An IPv4 address, seen through an IPv6 socket.
+            address = address[len('::ffff:'):]
+        return peers.get(address, (None, None))
+
+    def _watched_names(self, subs):
+        """ Return the sequence numbers to check, by name, for replay. """
+        names = set(_lane_base(name) for name, _ in subs.values())
+        for sub in subs:
+            names.update(name for name, _ in self._peers.get(sub, {}).values())
 
-    def _poll(self, poller, subs):
         watched_names = {}
-        for name, _ in subs.values():
+        for name in names:
             if name in self.c.get("replay_endpoints", {}):
                 # At first we don't know where the sequence is at.
                 watched_names[name] = -1
+        return watched_names
+
+    def _poll(self, poller, subs, track_loss=False, lazy=False):
+        watched_names = self._watched_names(subs)
+
+        # Messages of high priority lanes go first.
+        priorities = self._priorities(subs)
 
         # Poll that poller.  This is much more efficient than it used to be.
         while True:
             sockets = dict(poller.poll())
-            for s in sockets:
+            for s in sorted(sockets, key=priorities.get, reverse=True):
                 name, ep = subs[s]
-                try:
-                    yield self._run_socket(s, name, ep, watched_names)
-                except ValidationError as e:
-                    warnings.warn("!! invalid message received: %r" % e.msg)
+                for result in self._run_socket(
+                        s, name, ep, watched_names, lazy=lazy):
+                    if track_loss and result[1]:
+                        self._loss.add(result[1], result[3])
+                    yield result
+
+    def _poll_batches(self, poller, subs, max_batch, max_latency,
+                      track_loss=False, lazy=False):
+        watched_names = self._watched_names(subs)
+        priorities = self._priorities(subs)
+
+        batch, deadline = [], None
+        while True:
+            if batch:
+                timeout = max(0, deadline - time.time()) * 1000
+            else:
+                timeout = None
+            sockets = dict(poller.poll(timeout))
+
+            for s in sorted(sockets, key=priorities.get, reverse=True):
+                name, ep = subs[s]
+                # Take what's queued on this socket, but leave the others
+                # their turn.
+                for _ in range(max_batch):
+                    try:
+                        results = list(self._run_socket(
+                            s, name, ep, watched_names, zmq.NOBLOCK, lazy))
+                    except zmq.Again:
+                        break
+                    for result in results:
+                        if track_loss and result[1]:
+                            self._loss.add(result[1], result[3])
+                    batch.extend(results)
+
+            if batch and deadline is None:
+                deadline = time.time() + max_latency
+
+            while len(batch) >= max_batch:
+                yield batch[:max_batch]
+                batch = batch[max_batch:]
+            if batch and time.time() >= deadline:
+                yield batch
+                batch = []
+            if not batch:
+                deadline = None
+
+    def _priorities(self, subs):
+        """ Map each subscriber in ``subs`` to the priority of its lane. """
+        priorities = {}
+        for sub, (name, _) in subs.items():
+            lane = name.rsplit('@', 1)[1] if name and '@' in name else None
+            priorities[sub] = self._lane_priority(lane)
+        return priorities
+
+    def _run_socket(self, sock, name, ep, watched_names=None, flags=0,
+                    lazy=False):
+        """ Receive from ``sock`` and yield each message that came with it.
+
+        With ``lazy``, message bodies stay in zero-copy frames until they are
+        decoded, if ever.
+        """
+        # Grab the data off the zeromq internal queue
+        if lazy or sock in self._peers:
+            frames = sock.recv_multipart(flags, copy=False)
+        else:
+            frames = sock.recv_multipart(flags)
+        name, ep = self._attribute(sock, frames, name, ep)
+        if not isinstance(frames[0], bytes):
+            frames = [frames[0].bytes] + [
+                frame if lazy else frame.bytes for frame in frames[1:]]
+        self._count_received(sock, frames)
+        for pair in self._unpack_traced(frames):
+            try:
+                yield self._handle_frames(pair, name, ep, watched_names, lazy)
+            except ValidationError as e:
+                warnings.warn("!! invalid message received: %r" % e.msg)
+
+    def _unpack_traced(self, frames):
+        """ Like :func:`_unpack`, but keep the latencies of traced messages.
+
+        Returns ``(topic, body)`` pairs.
+        """
+        triples = _unpack(frames)
+        now = None
+        for _, _, trace in triples:
+            if trace:
+                now = now or _time_ns()
+                self._latency.add(trace + [['receive', self.hostname, now]])
+        return [(topic, body) for topic, body, _ in triples]
+
+    def _count_received(self, sock, frames):
+        """ Charge the message bodies in ``frames`` to the budget of ``sock``.
+        """
+        budget = self._budgets.get(sock)
+        if budget is not None:
+            for frame in frames[1:]:
+                budget.add(len(frame))
 
-    def _run_socket(self, sock, name, ep, watched_names=None):
+    def _handle_frames(self, frames, name, ep, watched_names=None, lazy=False):
+        """ Decode, validate and check for replay a message off the wire.
+
+        With ``lazy``, the message is a :class:`fedmsg.encoding.LazyMessage`
+        unless validation or replay need to look at it right away.
+        """
         if watched_names is None:
             watched_names = {}
 
         validate = self.c.get('validate_signatures', False)
 
-        # Grab the data off the zeromq internal queue
-        _topic, message = sock.recv_multipart()
+        _topic, message = frames
 
         # zmq hands us byte strings, so let's convert to unicode asap
-        _topic, message = _topic.decode('utf-8'), message.decode('utf-8')
+        _topic = _topic.decode('utf-8')
+        if lazy and not validate and \
+                name not in self.c.get('replay_endpoints', {}):
+            return name, ep, _topic, fedmsg.encoding.LazyMessage(
+                message, self._lazy_blobs)
+        message = getattr(message, 'bytes', message).decode('utf-8')
 
         # Now, decode the JSON body into a dict.
         msg = fedmsg.encoding.loads(message)
@@ -461,19 +2072,41 @@ class FedMsgContext(object):
             if len(self.c.get('replay_endpoints', {})) > 0:
                 for m in check_for_replay(
                         name, watched_names,
-                        msg, self.c, self.context):
+                        msg, self.c, self._replay_context()):
 
                     # Revalidate all the replayed messages.
                     if not validate or \
                             fedmsg.crypto.validate(m, **self.c):
-                        return name, ep, m['topic'], m
+                        return name, ep, m['topic'], self._lazy_blobs(m)
                     else:
                         raise ValidationError(msg)
             else:
-                return (name, ep, _topic, msg)
+                return (name, ep, _topic, self._lazy_blobs(msg))
         else:
             raise ValidationError(msg)
 
+    def _lazy_blobs(self, msg):
+        """ Have the offloaded fields of ``msg`` fetched when they're used. """
+        store = self.c.get('blob_store', None)
+        if store:
+            fedmsg.blobs.wrap(msg, store)
+        return msg
+
+    def _replay_context(self):
+        """ Return the zeromq context to query replay endpoints with. """
+        return self.context
+
     def _close_subs(self, subs):
         for subscriber in subs:
+            self._budgets.pop(subscriber, None)
+            self._peers.pop(subscriber, None)
             subscriber.close()
+
+
+class _SharedPublisherOwner(FedMsgContext):
+    """ The context behind a :class:`SharedPublisher`. """
+
+    def _publisher_type(self, method):
+        # Subscriptions would flow back into the PULL socket, which can't
+        # take them, so there's no waiting for the relay's.
+        return zmq.PUB
@@ -36,6 +36,10 @@ following exceptions to normal JSON serialization are observed.
    this, as you might expose information to the bus that you do not want to.
    See :ref:`api-crypto` for considerations.
 
+Subscribers that pass on most of what they receive can ask
+:func:`fedmsg.tail_messages` for :class:`LazyMessage` objects, which are only
+decoded once they are looked at.
+
 """
 
 import time
@@ -49,6 +53,14 @@ except ImportError:
 
 import json
 import json.encoder
+import re
+
+import six
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
 
 class FedMsgEncoder(json.encoder.JSONEncoder):
@@ -83,8 +95,102 @@ pretty_dumps = pretty_encoder.encode
 
 loads = json.loads
 
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+class LazyMessage(MutableMapping):
+    """ A message that isn't decoded from its JSON ``data`` until it is used.
+
+    ``data`` is the encoded message as bytes, or anything with a ``bytes``
+    attribute holding them, like a :class:`zmq.Frame` received with
+    ``copy=False``.  That way, messages that nobody looks at are never even
+    copied out of zeromq's buffers.  Once it is decoded, ``hook``, if given,
+    is called with it.
+
+    It is a mapping, but not a ``dict``: use ``dict(msg)`` for that.
+    :func:`dumps` encodes it like the message it stands for; :func:`json.dumps`
+    can't.
+    """
+
+    def __init__(self, data, hook=None):
+        self._data = data
+        self._hook = hook
+        self._dict = None
+
+    def _text(self):
+        if not isinstance(self._data, six.text_type):
+            self._data = getattr(self._data, 'bytes', self._data).decode('utf-8')
+        return self._data
+
+    def _parse(self):
+        if self._dict is None:
+            self._dict = loads(self._text())
+            self._data = None
+            if self._hook is not None:
+                self._hook(self)
+        return self._dict
+
+    def peek(self, key, default=None):
+        """ Return the value of ``key`` with as little decoding as can be.
+
+        Until the message is decoded, this decodes its top-level values one at
+        a time up to ``key``.  :func:`dumps` sorts keys, so ``i``, ``crypto``
+        and ``certificate`` come without decoding ``msg``.
+        """
+        if self._dict is not None:
+            return self._dict.get(key, default)
+
+        text = self._text()
+        i = _whitespace.match(text).end()
+        if text[i:i + 1] != '{':
+            raise ValueError("not a JSON object")
+        i += 1
+        while True:
+            i = _whitespace.match(text, i).end()
+            if text[i:i + 1] == '}':
+                return default
+            name, i = _decoder.raw_decode(text, i)
+            i = _whitespace.match(text, i).end()
+            if text[i:i + 1] != ':':
+                raise ValueError("expected ':' at %i" % i)
+            i = _whitespace.match(text, i + 1).end()
+            value, i = _decoder.raw_decode(text, i)
+            if name == key:
+                return value
+            i = _whitespace.match(text, i).end()
+            if text[i:i + 1] == ',':
+                i += 1
+
+    def __getitem__(self, key):
+        return self._parse()[key]
+
+    def __setitem__(self, key, value):
+        self._parse()[key] = value
+
+    def __delitem__(self, key):
+        del self._parse()[key]
+
+    def __iter__(self):
+        return iter(self._parse())
+
+    def __len__(self):
+        return len(self._parse())
+
+    def __repr__(self):
+        return repr(self._parse())
+
+    def __json__(self):
+        return self._parse()
+
+    def __reduce__(self):
+        # Frames can't be copied or pickled, so make that a dict.
+        return (dict, (self._parse(),))
+
+
 __all__ = [
     'pretty_dumps',
     'dumps',
     'loads',
+    'LazyMessage',
 ]
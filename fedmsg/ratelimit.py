@@ -0,0 +1,157 @@
+# This file is part of fedmsg.
+# Copyright (C) 2012 - 2014 Red Hat, Inc.
+#
+# fedmsg is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# fedmsg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with fedmsg; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+""" Publisher-side rate limits, configured with :ref:`conf-publish-rate-limits`.
+"""
+
+import fnmatch
+import threading
+import time
+
+
+class _Rule(object):
+    """ A token bucket for the topics matching one pattern. """
+
+    actions = ('drop', 'sample', 'summarize')
+
+    def __init__(self, pattern, rate, burst=None, action='drop', sample=10,
+                 interval=60, now=None):
+        if action not in self.actions:
+            raise ValueError("the action of rate limit %r must be one of %r, "
+                             "not %r" % (pattern, self.actions, action))
+
+        self.pattern = pattern
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.action = action
+        self.sample = int(sample)
+        self.interval = interval
+
+        self.tokens = self.burst
+        self.updated = now
+        self.excess = 0
+        self.suppressed = {}
+        self.since = None
+        self.counters = dict(
+            passed=0, dropped=0, sampled=0, summarized=0, summaries=0)
+
+    def admit(self, topic, now):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.counters['passed'] += 1
+            return True
+
+        self.excess += 1
+        if self.action == 'sample' and (self.excess - 1) % self.sample == 0:
+            # Let the first of every ``sample`` excess messages through.
+            self.counters['sampled'] += 1
+            return True
+        elif self.action == 'summarize':
+            self.counters['summarized'] += 1
+            self.suppressed[topic] = self.suppressed.get(topic, 0) + 1
+            if self.since is None:
+                self.since = now
+        else:
+            self.counters['dropped'] += 1
+        return False
+
+    def summary(self, now, force=False):
+        """ Return the body of a summary message, if one is due. """
+        if self.since is None or (not force and now - self.since < self.interval):
+            return None
+
+        body = dict(
+            pattern=self.pattern,
+            suppressed=self.suppressed,
+            since=int(self.since),
+            until=int(now),
+        )
+        self.suppressed, self.since = {}, None
+        self.counters['summaries'] += 1
+        return body
+
+
+class RateLimiter(object):
+    """
+    Token-bucket rate limits on the topics a context publishes.
+
+    ``rules`` maps topic patterns, matched with :func:`fnmatch.fnmatchcase`, to
+    dicts of settings; see :ref:`conf-publish-rate-limits`.  When several
+    patterns match a topic, the longest one applies.
+    """
+
+    def __init__(self, rules, clock=time.time):
+        self.clock = clock
+        now = clock()
+        self.rules = [
+            _Rule(pattern, now=now, **settings)
+            for pattern, settings in sorted(
+                rules.items(), key=lambda item: -len(item[0]))
+        ]
+        self._rule_cache = {}
+        self._lock = threading.Lock()
+
+    def _rule_for(self, topic):
+        try:
+            return self._rule_cache[topic]
+        except KeyError:
+            if len(self._rule_cache) >= 1024:
+                self._rule_cache.clear()
+            rule = self._rule_cache[topic] = next(
+                (rule for rule in self.rules
+                 if fnmatch.fnmatchcase(topic, rule.pattern)), None)
+            return rule
+
+    def admit(self, topic):
+        """ Return whether a message on ``topic`` may be published now. """
+        rule = self._rule_for(topic)
+        if rule is None:
+            return True
+        with self._lock:
+            return rule.admit(topic, self.clock())
+
+    def summarizes(self):
+        """ Return whether any rule summarizes what it holds back. """
+        return any(rule.action == 'summarize' for rule in self.rules)
+
+    def next_summary(self):
+        """ Return when the next summary falls due, or ``None`` if none will.
+        """
+        with self._lock:
+            due = [rule.since + rule.interval
+                   for rule in self.rules if rule.since is not None]
+        return min(due) if due else None
+
+    def summaries(self, force=False):
+        """ Return the bodies of the summary messages that are due.
+
+        With ``force``, return a summary for every rule that suppressed
+        something, however recently.
+        """
+        now = self.clock()
+        with self._lock:
+            bodies = [rule.summary(now, force) for rule in self.rules]
+        return [body for body in bodies if body is not None]
+
+    def stats(self):
+        """ Return the counters of each rule, by pattern. """
+        with self._lock:
+            return dict(
+                (rule.pattern, dict(rule.counters)) for rule in self.rules)
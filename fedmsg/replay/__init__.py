@@ -109,6 +109,9 @@ def get_replay(name, query, config, context=None):
 
             * 'msg_id': A single UUID for the msg_id attribute.
 
+            * 'msg_id_range': A two-tuple of msg_ids.  With time-ordered
+              msg_ids (see :ref:`conf-msg-id-format`), this is a time range.
+
             * 'time': A tuple of two timestamps. It will return all messages emitted in between.
         config (dict): A configuration dictionary. This dictionary should contain, at a
             minimum, two keys. The first key, 'replay_endpoints', should be a dictionary
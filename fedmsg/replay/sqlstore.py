@@ -20,7 +20,7 @@
 
 from sqlalchemy.ext.declarative import declarative_base
 
-from sqlalchemy import Column, Integer, String, Text, DateTime, or_
+from sqlalchemy import Column, Integer, String, Text, DateTime, inspect, or_
 from sqlalchemy.orm import sessionmaker
 
 from datetime import datetime
@@ -35,7 +35,9 @@ class SqlMessage(Base):
     __tablename__ = "fedmsg_messages"
 
     seq_id = Column(Integer, primary_key=True)
-    uuid = Column(String(36))
+    # Indexed for msg_id lookups; with time-ordered msg_ids, new rows go to
+    # the end of the index and msg_id ranges are time ranges.
+    uuid = Column(String(36), index=True)
     topic = Column(String)
     timestamp = Column(DateTime)
     # The raw message, including the metadata (signature, topic, etc)
@@ -47,6 +49,16 @@ class SqlStore(object):
         self.engine = engine
         self.session_class = sessionmaker(bind=engine)
         Base.metadata.create_all(engine)
+        self._create_indexes()
+
+    def _create_indexes(self):
+        """ Add the indexes a table created by an older fedmsg lacks. """
+        table = SqlMessage.__table__
+        existing = set(
+            index['name'] for index in inspect(self.engine).get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(self.engine)
 
     def add(self, msg):
         session = self.session_class()
@@ -65,6 +77,24 @@ class SqlStore(object):
         session.close()
         return msg
 
+    def add_many(self, msgs):
+        """ Add a list of messages, using two commits for the whole batch. """
+        session = self.session_class()
+        msg_objects = [SqlMessage(
+            uuid=msg['msg_id'],
+            timestamp=datetime.fromtimestamp(msg['timestamp']),
+            topic=msg['topic'],
+            msg=""
+        ) for msg in msgs]
+        session.add_all(msg_objects)
+        session.commit()
+        for msg, msg_object in zip(msgs, msg_objects):
+            msg['seq_id'] = msg_object.seq_id
+            msg_object.msg = json.dumps(msg)
+        session.commit()
+        session.close()
+        return msgs
+
     def _query_seq_ids(self, arg):
         return SqlMessage.seq_id.in_(arg)
 
@@ -84,6 +114,13 @@ class SqlStore(object):
     def _query_msg_id(self, arg):
         return SqlMessage.uuid == arg
 
+    def _query_msg_id_range(self, arg):
+        try:
+            id_beg, id_end = arg
+        except (TypeError, ValueError):
+            raise ValueError('Ill-format "msg_id_range" field')
+        return SqlMessage.uuid.between(id_beg, id_end)
+
     def _query_time(self, arg):
         try:
             time_beg, time_end = arg
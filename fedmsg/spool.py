@@ -0,0 +1,214 @@
+# This file is part of fedmsg.
+# Copyright (C) 2012 - 2014 Red Hat, Inc.
+#
+# fedmsg is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# fedmsg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with fedmsg; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+""" An on-disk spool for messages the ``fedmsg-relay`` can't take right now.
+
+See :ref:`conf-spool-directory`.  A :class:`Spool` is a directory of
+append-only segment files, one encoded message per line.  Each process
+writes to a segment of its own and holds an exclusive :func:`fcntl.flock`
+on it until it is sealed; sealed segments are fair game for the
+:class:`SpoolFlusher` of any process using the same directory, so messages
+spooled by a short-lived ``fedmsg-logger`` go out with the next one.
+"""
+
+import errno
+import fcntl
+import glob
+import logging
+import os
+import threading
+import time
+
+import zmq
+
+import fedmsg.encoding
+from fedmsg.utils import set_tcp_keepalive
+
+
+class Spool(object):
+    """ An append-only queue of encoded messages in ``directory``. """
+
+    suffix = '.spool'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.log = logging.getLogger(__name__)
+        self._segment = None
+        self._lock = threading.Lock()
+
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def append(self, payloads):
+        """ Write the encoded messages in ``payloads`` to disk, for good. """
+        with self._lock:
+            if self._segment is None:
+                # The time first, so that segments sort oldest first.
+                path = os.path.join(self.directory, 'segment-%020d-%d%s' % (
+                    int(time.time() * 1e6), os.getpid(), self.suffix))
+                self._segment = open(path, 'ab')
+                fcntl.flock(self._segment.fileno(), fcntl.LOCK_EX)
+
+            self._segment.write(b''.join(payload + b'\n' for payload in payloads))
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+
+    def seal(self):
+        """ Close the segment being written, so that it can be drained. """
+        with self._lock:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+
+    def segments(self):
+        """ Return the paths of every segment, oldest first. """
+        return sorted(glob.glob(os.path.join(self.directory, '*' + self.suffix)))
+
+    def drain(self, send, batch_size=100):
+        """ Hand every sealed segment to ``send`` and delete it.
+
+        ``send`` is called with lists of up to ``batch_size`` encoded
+        messages and returns how many of them it sent.  If that's not all of
+        them, draining stops and the rest stays in the spool.  Returns the
+        number of messages sent.
+        """
+        sent = 0
+        for path in self.segments():
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                # Drained by someone else in the meantime.
+                continue
+
+            with f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # Still being written, or drained right now.
+                    continue
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    # Someone drained it while we waited for the lock.
+                    continue
+
+                payloads = [line.rstrip(b'\n') for line in f if line.strip()]
+                done = 0
+                while done < len(payloads):
+                    batch = payloads[done:done + batch_size]
+                    count = send(batch)
+                    done += count
+                    if count < len(batch):
+                        break
+                sent += done
+
+                if done < len(payloads):
+                    self._rewrite(path, payloads[done:])
+                    return sent
+                os.unlink(path)
+
+        return sent
+
+    def _rewrite(self, path, payloads):
+        """ Replace the segment at ``path`` with what's left of it. """
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(b''.join(payload + b'\n' for payload in payloads))
+            f.flush()
+            os.fsync(f.fileno())
+        # The rename doesn't change the name, so the order is kept, and
+        # anyone holding the old file sees it has no link left.
+        os.rename(tmp, path)
+
+
+def send_spooled(sock, payloads):
+    """ Send the encoded messages in ``payloads`` on ``sock``, each on its
+    own topic, until zeromq pushes back.
+
+    Returns how many of them went out.
+    """
+    for count, payload in enumerate(payloads):
+        msg = fedmsg.encoding.loads(payload.decode('utf-8'))
+        try:
+            sock.send_multipart(
+                [msg['topic'].encode('utf-8'), payload], flags=zmq.NOBLOCK)
+        except zmq.Again:
+            return count
+    return len(payloads)
+
+
+class SpoolFlusher(object):
+    """
+    A thread sending what's in a :class:`Spool` to ``endpoint``, the
+    ``fedmsg-relay``, whenever it is there to take it.
+
+    It has an XPUB socket of its own, connected to ``endpoint``, which tells
+    it when the relay subscribes (it is there) and unsubscribes (it is gone).
+    """
+
+    #: How often, in seconds, to look for segments to drain.
+    interval = 1.0
+
+    def __init__(self, context, spool, endpoint, config):
+        self.spool = spool
+        self.batch_size = max(1, config.get('spool_batch_size', 100))
+        self.log = logging.getLogger(__name__)
+
+        self.socket = context.socket(zmq.XPUB)
+        # Wait for the relay rather than drop what it can't take yet.
+        self.socket.setsockopt(zmq.XPUB_NODROP, 1)
+        self.socket.setsockopt(zmq.LINGER, config.get('zmq_linger', 1000))
+        set_tcp_keepalive(self.socket, config)
+        self.socket.connect(endpoint)
+
+        self._stop = threading.Event()
+        self.worker = threading.Thread(
+            target=self._run, name="fedmsg-spool-flusher")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _run(self):
+        subscribed, next_drain = False, 0
+        try:
+            while not self._stop.is_set():
+                # Short polls, so that close() doesn't wait long.
+                if self.socket.poll(100):
+                    frame = self.socket.recv()
+                    if frame[:1] in (b'\x00', b'\x01'):
+                        subscribed = frame[:1] == b'\x01'
+                    continue
+
+                if subscribed and time.time() >= next_drain:
+                    next_drain = time.time() + self.interval
+                    try:
+                        sent = self.spool.drain(self._send, self.batch_size)
+                    except Exception:
+                        self.log.exception("Failed to drain the fedmsg spool")
+                    else:
+                        if sent:
+                            self.log.info("Sent %i spooled messages" % sent)
+        finally:
+            self.socket.close()
+
+    def _send(self, payloads):
+        return send_spooled(self.socket, payloads)
+
+    def close(self):
+        """ Stop the thread, which closes its socket. """
+        self._stop.set()
+        self.worker.join()
@@ -0,0 +1,321 @@
+# This file is part of fedmsg.
+# Copyright (C) 2012 - 2014 Red Hat, Inc.
+#
+# fedmsg is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# fedmsg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with fedmsg; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+""" Counters and timers for fedmsg publishers and subscribers.
+
+:class:`fedmsg.core.FedMsgContext` records what it publishes into a
+:class:`PublishStats` object when :ref:`conf-publish-stats` is enabled.  The
+numbers are available from :meth:`fedmsg.core.FedMsgContext.stats`.
+
+On the subscribing side, :class:`LossStats` works out how many messages went
+missing on the way; see :meth:`fedmsg.core.FedMsgContext.loss_stats`.
+:class:`LatencyStats` keeps the time traced messages spent between hops; see
+:meth:`fedmsg.core.FedMsgContext.latency_stats`.
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+# Use the most precise clock we have for measuring durations.
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class Histogram(object):
+    """ A fixed-bucket histogram of durations, in seconds. """
+
+    #: The upper bound of each bucket.  Anything slower lands in a final
+    #: overflow bucket.
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    def as_dict(self):
+        return dict(
+            count=self.count,
+            total=self.total,
+            max=self.max,
+            histogram=list(zip(self.buckets + (float('inf'),), self.counts)),
+        )
+
+
+class _Timer(object):
+    """ Context manager adding the time spent in its block to a stage. """
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = clock()
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.stage, clock() - self.start)
+
+
+class PublishStats(object):
+    """
+    Message counters and per-stage timings for a publisher.
+
+    The stages are ``topic`` (building the topic and envelope), ``sign``,
+    ``store`` (the ``persistent_store``), ``encode`` (JSON serialization) and
+    ``send`` (handing the frames to zeromq).
+
+    If a ``callback`` is given, it is called with the output of
+    :meth:`as_dict` after a message is sent, at most once every ``interval``
+    seconds.
+    """
+
+    stages = ('topic', 'sign', 'store', 'encode', 'send')
+
+    def __init__(self, callback=None, interval=60):
+        self.log = logging.getLogger(__name__)
+        self.callback = callback
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last_export = time.time()
+        self.reset()
+
+    def reset(self):
+        """ Zero every counter and timer. """
+        with self._lock:
+            self.messages = 0
+            self.bytes = 0
+            self.again = 0
+            self.skipped = 0
+            self.topics = {}
+            self.timings = dict((stage, Histogram()) for stage in self.stages)
+
+    def time(self, stage):
+        """ Return a context manager timing the ``stage`` it wraps. """
+        return _Timer(self, stage)
+
+    def add_time(self, stage, duration):
+        with self._lock:
+            self.timings[stage].add(duration)
+
+    def add_again(self):
+        """ Count a send that zeromq refused with ``EAGAIN``. """
+        with self._lock:
+            self.again += 1
+
+    def add_skipped(self, count=1):
+        """ Count messages dropped because nobody subscribed to them. """
+        with self._lock:
+            self.skipped += count
+
+    def add_message(self, topic, size):
+        """ Count one sent message of ``size`` bytes on ``topic``. """
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+            counts = self.topics.get(topic)
+            if counts is None:
+                counts = self.topics[topic] = [0, 0]
+            counts[0] += 1
+            counts[1] += size
+
+        if self.callback and time.time() - self._last_export >= self.interval:
+            self._last_export = time.time()
+            try:
+                self.callback(self.as_dict())
+            except Exception:
+                self.log.exception("fedmsg stats callback failed")
+
+    def as_dict(self):
+        """ Return a snapshot of the statistics as plain python types. """
+        with self._lock:
+            return dict(
+                messages=self.messages,
+                bytes=self.bytes,
+                again=self.again,
+                skipped=self.skipped,
+                topics=dict(
+                    (topic, dict(messages=counts[0], bytes=counts[1]))
+                    for topic, counts in self.topics.items()
+                ),
+                stages=dict(
+                    (stage, histogram.as_dict())
+                    for stage, histogram in self.timings.items()
+                ),
+            )
+
+
+class LossStats(object):
+    """
+    Message loss seen by a subscriber, worked out from the ``i`` counter.
+
+    Every message carries ``i``, the number of messages its publishing
+    context had sent so far, and ``sender``, an id unique to that counter.
+    A jump in ``i`` between two messages of one sender means the messages in
+    between were lost on the way (at a high water mark, or before the
+    subscription reached the publisher).  Messages without a ``sender``, from
+    older publishers, can't be told apart from those of other processes
+    sharing their endpoint and are left out.
+
+    When ``i`` falls back to 1, or by more than ``window``, the publisher
+    restarted.  A smaller step back to a message that was counted as lost is
+    that message arriving late, and it is taken off the loss count; a message
+    seen before (sent twice, or replayed) is only counted as received.
+
+    This only makes sense for subscribers that get every message of their
+    publishers, that is, that subscribe to every topic.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forget every publisher and zero every counter. """
+        with self._lock:
+            # The last ``i`` of each sender and what's missing before it.
+            self._last = {}
+            self._missing = {}
+            self.endpoints = {}
+
+    def add(self, endpoint, msg):
+        """ Account for ``msg``, received from ``endpoint``. """
+        i, sender = msg.get('i'), msg.get('sender')
+        if not isinstance(i, int) or not sender:
+            # Not sent by a fedmsg context; there's nothing to go by.
+            return
+
+        key = (endpoint, sender)
+        with self._lock:
+            counts = self.endpoints.get(endpoint)
+            if counts is None:
+                counts = self.endpoints[endpoint] = dict(
+                    received=0, lost=0, restarts=0, reordered=0)
+            counts['received'] += 1
+
+            last = self._last.get(key)
+            missing = self._missing.setdefault(key, set())
+            if last is None or i > last:
+                if last is not None:
+                    counts['lost'] += i - last - 1
+                    # Remember the gap, within the window, in case the
+                    # messages in it turn up late.
+                    missing.update(range(max(last + 1, i - self.window), i))
+                    missing.difference_update(
+                        [j for j in missing if j <= i - self.window])
+                self._last[key] = i
+            elif i == 1 or last - i > self.window:
+                counts['restarts'] += 1
+                self._last[key] = i
+                missing.clear()
+            elif i in missing:
+                counts['reordered'] += 1
+                counts['lost'] -= 1
+                missing.discard(i)
+
+    def as_dict(self):
+        """ Return the counters of every endpoint, with their loss rate. """
+        with self._lock:
+            result = {}
+            for endpoint, counts in self.endpoints.items():
+                result[endpoint] = counts = dict(counts)
+                total = counts['received'] + counts['lost']
+                counts['loss_rate'] = \
+                    float(counts['lost']) / total if total else 0.0
+            return result
+
+
+class LatencyStats(object):
+    """
+    How long traced messages took from one hop to the next.
+
+    A trace is a list of ``[hop, host, nanoseconds]`` stamps in the order the
+    message went through them, e.g. ``publish`` and then ``receive``; see
+    :ref:`conf-publish-trace`.  Each pair of consecutive stamps feeds the
+    :class:`Histogram` of ``"publish->receive"``.  Hops on different hosts
+    are only as comparable as their clocks; negative times count as zero.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forget every hop. """
+        with self._lock:
+            self.hops = {}
+
+    def add(self, trace):
+        """ Account for the stamps of one message. """
+        with self._lock:
+            for (first, _, start), (second, _, end) in zip(trace, trace[1:]):
+                key = '%s->%s' % (first, second)
+                histogram = self.hops.get(key)
+                if histogram is None:
+                    histogram = self.hops[key] = Histogram()
+                histogram.add(max(0, end - start) / 1e9)
+
+    def as_dict(self):
+        """ Return the histogram of each pair of hops, in seconds. """
+        with self._lock:
+            return dict(
+                (key, histogram.as_dict())
+                for key, histogram in self.hops.items())
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullStats(object):
+    """ Stand-in for :class:`PublishStats` that records nothing. """
+
+    _timer = _NullTimer()
+
+    def time(self, stage):
+        return self._timer
+
+    def add_time(self, stage, duration):
+        pass
+
+    def add_again(self):
+        pass
+
+    def add_skipped(self, count=1):
+        pass
+
+    def add_message(self, topic, size):
+        pass
+
+    def reset(self):
+        pass
+
+    def as_dict(self):
+        return None
@@ -59,6 +59,16 @@ class RelayCommandTests(unittest.TestCase):
         result = self.command.run()
         self.assertTrue(result is mock_main.return_value)
 
+    @mock.patch('fedmsg.commands.relay.install')
+    def test_trace(self, mock_install, mock_main):
+        """Assert the tracing hub extension is only installed with publish_trace."""
+        self.command.run()
+        self.assertFalse(mock_install.called)
+
+        self.command.config['publish_trace'] = True
+        self.command.run()
+        mock_install.assert_called_once_with()
+
     def test_main(self, mock_main):
         """Assert the command creates a monitoring producer and a relay consumer."""
         self.command.run()
@@ -0,0 +1,6 @@
+import sys
+
+# The asyncio API uses syntax python2 can't even compile.
+collect_ignore = []
+if sys.version_info < (3, 7):
+    collect_ignore.append('test_aio.py')
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of fedmsg.
+# Copyright (C) 2017 Red Hat, Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Tests for the :mod:`fedmsg.consumers.zeromq` module."""
+from __future__ import absolute_import
+
+import json
+import unittest
+
+# In Python 3 the mock is part of unittest
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+import moksha.hub.hub
+import txzmq
+
+from fedmsg.consumers import gateway, relay, zeromq
+from fedmsg.core import FedMsgContext
+from fedmsg.tests.common import load_config
+
+
+def _hops(trace_frame):
+    return [hop for hop, _, _ in json.loads(trace_frame[1:].decode('utf-8'))]
+
+
+class TestTracingZMQHubExtension(unittest.TestCase):
+    """Tests for :class:`fedmsg.consumers.zeromq.TracingZMQHubExtension`."""
+
+    def setUp(self):
+        config = load_config()
+        config['io_threads'] = 1
+        config['publish_trace'] = True
+        config['replay_endpoints'] = {}
+        config['validate_signatures'] = False
+        self.ctx = FedMsgContext(**config)
+        self.ctx.publisher = mock.Mock()
+
+        # An extension without the sockets and the sleep of its __init__.
+        ext = self.ext = zeromq.TracingZMQHubExtension.__new__(
+            zeromq.TracingZMQHubExtension)
+        ext.strict = False
+        ext.subscriber_factories = {}
+        ext.twisted_zmq_factory = txzmq.ZmqFactory()
+        ext.sub_endpoints = [
+            txzmq.ZmqEndpoint('bind', 'inproc://test-tracing-hub')]
+        ext.connection_cls = ext._connect
+        ext.pub_socket = mock.Mock()
+        ext._trace = None
+        ext._callbacks = {}
+
+        self.hub = mock.Mock()
+        self.hub.extensions = [ext]
+        self.hub.subscribe.side_effect = ext.subscribe
+        self.hub.config = {
+            'fedmsg.consumers.relay.enabled': True,
+            'moksha.blocking_mode': True,
+            'publish_trace': True,
+            'validate_signatures': False,
+        }
+
+    def tearDown(self):
+        self.ctx.destroy()
+        self.ext.twisted_zmq_factory.shutdown()
+
+    def publish(self):
+        """ Publish a traced message and return its frames. """
+        self.ctx.publish(topic='foo', msg={'a': 1}, modname='bar')
+        return self.ctx.publisher.send_multipart.call_args[0][0]
+
+    def receive(self, frames):
+        connection, = self.ext.subscriber_factories.values()
+        connection.messageReceived(frames)
+
+    @mock.patch.object(moksha.hub.hub, 'ZMQHubExtension')
+    def test_install(self, original):
+        """hubs created after install() use the tracing extension"""
+        zeromq.install()
+        assert moksha.hub.hub.ZMQHubExtension is zeromq.TracingZMQHubExtension
+
+    def test_relay_two_hops(self):
+        """the relay stamps the trace and sends it on to the subscriber"""
+        consumer = relay.RelayConsumer(self.hub)
+        self.receive(self.publish())
+
+        frames = self.ext.pub_socket.send_multipart.call_args[0][0]
+        assert len(frames) == 3
+        assert _hops(frames[2]) == ['publish', 'relay']
+        assert list(consumer.latency_stats.as_dict()) == ['publish->relay']
+
+        sock = mock.Mock()
+        sock.recv_multipart.return_value = frames
+        results = list(self.ctx._run_socket(sock, 'relay_outbound', 'ep'))
+        assert results[0][3]['msg'] == {'a': 1}
+        stats = self.ctx.latency_stats()
+        assert sorted(stats) == ['publish->relay', 'relay->receive']
+
+    def test_coalesced(self):
+        """the relay sends the messages of a coalesced group one by one"""
+        relay.RelayConsumer(self.hub)
+        self.ctx.c['publish_coalesce'] = True
+        self.ctx.publish_many([('foo', {'a': 1}, 'bar'), ('foo', {'b': 2}, 'bar')])
+        self.receive(self.ctx.publisher.send_multipart.call_args[0][0])
+
+        sent = [c[0][0] for c in self.ext.pub_socket.send_multipart.call_args_list]
+        assert [json.loads(frames[1])['msg'] for frames in sent] == [
+            {'a': 1}, {'b': 2}]
+
+    def test_untraced(self):
+        """two-frame messages go through the relay as they did"""
+        relay.RelayConsumer(self.hub)
+        frames = self.publish()
+        self.receive(frames[:2])
+        assert not self.ext.pub_socket.send_multipart.called
+        self.hub.send_message.assert_called_once_with(
+            topic=frames[0].decode('utf-8'), message=json.loads(frames[1]))
+
+    def test_unsubscribe(self):
+        callback = mock.Mock()
+        self.ext.subscribe('', callback)
+        self.ext.unsubscribe(callback)
+        self.receive(self.publish())
+        assert not callback.called
+        assert self.ext._callbacks == {}
+
+    def test_gateway(self):
+        """the gateway stamps the trace and adds it to what it sends"""
+        consumer = gateway.GatewayConsumer.__new__(gateway.GatewayConsumer)
+        consumer.hub = self.hub
+        consumer.hostname = 'gateway-host'
+        consumer.log = mock.Mock()
+        consumer.latency_stats = mock.Mock()
+        consumer.gateway_socket = mock.Mock()
+        consumer._budget = None
+        msg = mock.Mock(
+            topic=u'foo', body=u'{}', trace=[['publish', 'host', 1]])
+
+        consumer._stamp(msg)
+        consumer.consume(msg)
+        frames = consumer.gateway_socket.send_multipart.call_args[0][0]
+        assert frames[:2] == [b'foo', b'{}']
+        assert _hops(frames[2]) == ['publish', 'gateway']
@@ -18,10 +18,13 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 """Tests for the :mod:`fedmsg.encoding` module."""
 
+import copy
 import json
 import unittest
 
-from fedmsg.encoding import FedMsgEncoder
+import zmq
+
+from fedmsg.encoding import FedMsgEncoder, LazyMessage, dumps
 
 
 class FedMsgEncoderTests(unittest.TestCase):
@@ -44,3 +47,38 @@ class FedMsgEncoderTests(unittest.TestCase):
                 return {'my': 'json'}
 
         self.assertEqual({'my': 'json'}, FedMsgEncoder().default(JsonClass()))
+
+
+class LazyMessageTests(unittest.TestCase):
+    """Tests for the :class:`fedmsg.encoding.LazyMessage`."""
+
+    def setUp(self):
+        self.msg = {'i': 3, 'msg': {'big': ['x'] * 100}, 'topic': 'a.b', 'username': 'me'}
+        self.hooked = []
+        self.lazy = LazyMessage(zmq.Frame(dumps(self.msg).encode('utf-8')), self.hooked.append)
+
+    def test_decoded_on_use(self):
+        """Assert the message is decoded, once, the first time it is looked at."""
+        self.assertIsNone(self.lazy._dict)
+        self.assertEqual(self.lazy['topic'], 'a.b')
+        self.assertEqual(self.lazy, self.msg)
+        self.assertEqual(self.hooked, [self.lazy])
+
+    def test_peek(self):
+        """Assert fields can be had without decoding the whole message."""
+        self.assertEqual(self.lazy.peek('i'), 3)
+        self.assertEqual(self.lazy.peek('username'), 'me')
+        self.assertEqual(self.lazy.peek('nope', 'default'), 'default')
+        self.assertIsNone(self.lazy._dict)
+        self.assertEqual(self.hooked, [])
+
+        self.lazy['i'] = 4
+        self.assertEqual(self.lazy.peek('i'), 4)
+
+    def test_like_a_dict(self):
+        """Assert the message encodes, copies and changes like a dict."""
+        self.assertEqual(json.loads(dumps(self.lazy)), self.msg)
+        self.assertEqual(copy.deepcopy(LazyMessage(dumps(self.msg).encode('utf-8'))), self.msg)
+        self.assertEqual(dict(self.lazy), self.msg)
+        del self.lazy['msg']
+        self.assertEqual(sorted(self.lazy), ['i', 'topic', 'username'])
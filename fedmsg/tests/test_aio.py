@@ -0,0 +1,188 @@
+import asyncio
+import json
+import unittest
+# In Python 3 the mock is part of unittest
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+import warnings
+
+import zmq
+
+import fedmsg.aio
+from fedmsg.aio import AioFedMsgContext
+from fedmsg.tests.common import load_config
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestAioPublish(unittest.TestCase):
+    def setUp(self):
+        self.config = load_config()
+        self.config['io_threads'] = 1
+        self.config['name'] = 'aiotest'
+        self.config['endpoints'] = {'aiotest': ['tcp://127.0.0.1:0']}
+        self.config['post_init_sleep'] = 0
+        self.ctx = None
+        self.zmq_context = zmq.Context()
+        self.subscriber = None
+
+    def tearDown(self):
+        if self.ctx:
+            self.ctx.destroy()
+        fedmsg.aio.destroy()
+        if self.subscriber:
+            self.subscriber.close()
+        self.zmq_context.term()
+
+    async def connect(self, ctx=None):
+        self.ctx = ctx or AioFedMsgContext(**self.config)
+        endpoint = self.ctx.publisher.getsockopt(zmq.LAST_ENDPOINT)
+        self.subscriber = self.zmq_context.socket(zmq.SUB)
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, b'')
+        self.subscriber.connect(
+            endpoint.decode('utf-8').replace('0.0.0.0', '127.0.0.1'))
+        await asyncio.sleep(0.2)
+
+    def received(self):
+        msgs = []
+        while self.subscriber.poll(1000):
+            _, body = self.subscriber.recv_multipart()
+            msgs.append(json.loads(body.decode('utf-8')))
+        return msgs
+
+    def test_publish(self):
+        """messages are awaited onto the wire with the usual envelope"""
+        async def main():
+            await self.connect()
+            await self.ctx.publish(topic='foo', msg={'a': 1}, modname='bar')
+            count = await self.ctx.publish_many([
+                ('baz', {'b': 2}, 'bar'),
+                ('qux', {'c': 3}, 'bar'),
+            ])
+            assert count == 2
+
+        run(main())
+        msgs = self.received()
+        assert [m['topic'] for m in msgs] == [
+            'org.fedoraproject.dev.bar.foo',
+            'org.fedoraproject.dev.bar.baz',
+            'org.fedoraproject.dev.bar.qux',
+        ]
+        assert [m['i'] for m in msgs] == [1, 2, 3]
+
+    def test_signing_runs_in_executor(self):
+        """signing is handed to the executor, not run on the loop"""
+        async def main():
+            await self.connect()
+            self.ctx.c['sign_messages'] = True
+            self.ctx.c['certnames'] = {'aiotest': 'test'}
+            self.ctx.executor = mock.Mock()
+            with mock.patch.object(asyncio.get_event_loop(), 'run_in_executor') as rie:
+                future = asyncio.get_event_loop().create_future()
+                future.set_result({'topic': 'x', 'msg': {}})
+                rie.return_value = future
+                await self.ctx.publish(topic='foo', msg={}, modname='bar')
+            assert rie.call_args[0][:2] == (
+                self.ctx.executor, self.ctx._sign_and_store)
+
+        run(main())
+
+    def test_module_api(self):
+        """the module API publishes through one shared context"""
+        async def main():
+            await self.connect(await fedmsg.aio.init(**self.config))
+            self.ctx = None
+            await fedmsg.aio.publish(topic='foo', msg={}, modname='bar')
+            assert isinstance(fedmsg.aio._context, AioFedMsgContext)
+
+        run(main())
+        assert len(self.received()) == 1
+
+    def test_zmq_disabled(self):
+        self.config['zmq_enabled'] = False
+        self.assertRaises(ValueError, AioFedMsgContext, **self.config)
+
+
+class TestAioTail(unittest.TestCase):
+    def setUp(self):
+        self.zmq_context = zmq.Context()
+        self.pub = self.zmq_context.socket(zmq.PUB)
+        port = self.pub.bind_to_random_port('tcp://127.0.0.1')
+
+        self.config = load_config()
+        self.config['io_threads'] = 1
+        self.config['mute'] = True
+        self.config['endpoints'] = {'test': ['tcp://127.0.0.1:%i' % port]}
+        self.ctx = AioFedMsgContext(**self.config)
+
+    def tearDown(self):
+        self.ctx.destroy()
+        self.pub.close()
+        self.zmq_context.term()
+
+    def tail(self, count, frames, method='tail_messages', **kw):
+        async def send():
+            # Give the subscription time to reach the publisher.
+            await asyncio.sleep(0.3)
+            for frame in frames:
+                self.pub.send_multipart(frame)
+
+        async def main():
+            sender = asyncio.ensure_future(send())
+            received = []
+            tail = getattr(self.ctx, method)(**kw)
+            async for item in tail:
+                received.append(item)
+                if len(received) == count:
+                    break
+            await tail.aclose()
+            await sender
+            return received
+
+        return run(asyncio.wait_for(main(), 5))
+
+    def test_tail_messages(self):
+        """messages are yielded as (name, endpoint, topic, msg)"""
+        body = json.dumps({'topic': 'foo', 'msg': {'a': 1}}).encode('utf-8')
+        received = self.tail(2, [[b'foo', body], [b'foo', body]])
+        assert len(received) == 2
+        name, ep, topic, msg = received[0]
+        assert name == 'test'
+        assert topic == 'foo'
+        assert msg['msg'] == {'a': 1}
+
+    def test_tail_batches(self):
+        """batches are lists of (name, endpoint, topic, msg), up to max_batch"""
+        frames = [
+            [b'foo', json.dumps({'topic': 'foo', 'i': i}).encode('utf-8')]
+            for i in range(5)]
+        received = self.tail(
+            2, frames, 'tail_batches', max_batch=3, max_latency=0.2)
+        assert [[msg['i'] for _, _, _, msg in batch] for batch in received] \
+            == [[0, 1, 2], [3, 4]]
+        assert received[0][0][:3] == ('test', self.config['endpoints']['test'][0], 'foo')
+
+    def test_invalid_messages_warn(self):
+        """messages that fail validation are skipped with a warning"""
+        self.ctx.c['validate_signatures'] = True
+        bad = json.dumps({'topic': 'foo', 'msg': {}}).encode('utf-8')
+        good = json.dumps({'topic': 'foo', 'msg': {'ok': 1}}).encode('utf-8')
+
+        def validate(msg, **config):
+            return 'ok' in msg['msg']
+
+        with mock.patch('fedmsg.crypto.validate', side_effect=validate):
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter("always")
+                received = self.tail(1, [[b'foo', bad], [b'foo', good]])
+        assert len(received) == 1
+        assert received[0][3]['msg'] == {'ok': 1}
+        assert any('invalid message' in str(m.message) for m in w)
@@ -0,0 +1,131 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+# In Python 3 the mock is part of unittest
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+import fedmsg.blobs
+import fedmsg.encoding
+from fedmsg.blobs import DirectoryBlobStore, LazyBody
+from fedmsg.core import FedMsgContext
+from fedmsg.tests.common import load_config
+
+
+class TestDirectoryBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = DirectoryBlobStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        digest = self.store.put(b'hello world')
+        self.assertTrue(digest.startswith('sha256:b94d27b9'))
+        self.assertEqual(self.store.get(digest), b'hello world')
+        self.assertEqual(self.store.put(b'hello world'), digest)
+
+    def test_missing(self):
+        digest = self.store.put(b'hello world')
+        os.unlink(self.store._path(digest))
+        self.assertRaises(KeyError, self.store.get, digest)
+
+    def test_corrupt(self):
+        digest = self.store.put(b'hello world')
+        with open(self.store._path(digest), 'wb') as f:
+            f.write(b'goodbye world')
+        self.assertRaises(ValueError, self.store.get, digest)
+
+    def test_bad_digest(self):
+        self.assertRaises(ValueError, self.store.get, 'sha256:../../etc')
+        self.assertRaises(ValueError, self.store.get, 'md5:abcdef')
+
+
+class TestOffload(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = DirectoryBlobStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_offload(self):
+        body = {'log': 'x' * 1000, 'build': 42}
+        result = fedmsg.blobs.offload(body, self.store, 100)
+        self.assertEqual(body['log'], 'x' * 1000)
+        self.assertEqual(result['build'], 42)
+        self.assertEqual(result['log']['size'], 1002)
+        self.assertEqual(fedmsg.blobs.fetch(self.store, result['log']), 'x' * 1000)
+
+    def test_small_bodies_are_untouched(self):
+        body = {'build': 42}
+        self.assertIs(fedmsg.blobs.offload(body, self.store, 100), body)
+        self.assertEqual(fedmsg.blobs.offload('x' * 1000, self.store, 100), 'x' * 1000)
+
+    def test_small_bodies_are_encoded_once(self):
+        body = {'build': 42, 'owner': 'ralph', 'tags': ['f30', 'f31']}
+        with mock.patch('fedmsg.encoding.dumps', wraps=fedmsg.encoding.dumps) as dumps:
+            self.assertIs(fedmsg.blobs.offload(body, self.store, 100), body)
+        self.assertEqual(dumps.call_count, 1)
+
+    def test_lazy_body(self):
+        body = fedmsg.blobs.offload(
+            {'log': ['x'] * 100, 'build': 42}, self.store, 100)
+        lazy = LazyBody(body, self.store)
+        self.assertEqual(lazy['build'], 42)
+        self.assertEqual(lazy.get('log'), ['x'] * 100)
+        self.assertEqual(lazy.get('nope', 'default'), 'default')
+        self.assertEqual(lazy.resolve(), {'log': ['x'] * 100, 'build': 42})
+
+        # Encoding sees what was signed.
+        self.assertEqual(json.loads(fedmsg.encoding.dumps(lazy)), body)
+
+    def test_lazy_body_fetches_once(self):
+        body = fedmsg.blobs.offload({'log': 'x' * 1000}, self.store, 100)
+        lazy = LazyBody(body, self.store)
+        self.assertEqual(lazy['log'], 'x' * 1000)
+        shutil.rmtree(self.directory)
+        os.mkdir(self.directory)
+        self.assertEqual(lazy['log'], 'x' * 1000)
+
+
+class TestContextBlobs(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = load_config()
+        config['io_threads'] = 1
+        config['blob_store'] = DirectoryBlobStore(self.directory)
+        config['blob_threshold'] = 100
+        self.ctx = FedMsgContext(**config)
+
+    def tearDown(self):
+        self.ctx.destroy()
+        shutil.rmtree(self.directory)
+
+    def test_offload_before_sending(self):
+        """big fields go to the store before the message is finished"""
+        body = {'log': 'x' * 1000}
+        seen = []
+        envelopes = self.ctx._prepare(
+            [(b'topic', {'topic': 'topic', 'msg': body})], seen.append)
+        _, msg = envelopes[0]
+        self.assertEqual(body, {'log': 'x' * 1000})
+        self.assertTrue(fedmsg.blobs.is_reference(msg['msg']['log']))
+        self.assertEqual(seen, [msg])
+
+    def test_lazy_on_receipt(self):
+        """received messages fetch their big fields on demand"""
+        _, msg = self.ctx._prepare(
+            [(b'topic', {'topic': 'topic', 'msg': {'log': 'x' * 1000}})])[0]
+        frames = (b'topic', fedmsg.encoding.dumps(msg).encode('utf-8'))
+        _, _, _, received = self.ctx._handle_frames(frames, 'name', 'ep')
+        self.assertIsInstance(received['msg'], LazyBody)
+        self.assertEqual(received['msg']['log'], 'x' * 1000)
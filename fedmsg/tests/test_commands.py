@@ -27,6 +27,7 @@ import unittest
 import time
 import json
 import os
+import re
 # In Python 3 the mock is part of unittest
 try:
     import mock
@@ -141,6 +142,38 @@ class TestCommands(unittest.TestCase):
         expected = "{'topic': 'topic'}\n"
         assert output.endswith(expected)
 
+    @mock.patch("sys.argv", new_callable=lambda: [
+        "fedmsg-tail", "--include", r"^org\.fp\.prod\.(bodhi|koji)\.",
+        "--topic", "org.fp.prod.bodhi.update", "--topic", "org.fp.prod.koji"])
+    @mock.patch("sys.stdout", new_callable=six.StringIO)
+    def test_tail_topic_prefixes(self, stdout, argv):
+        topics = []
+
+        def mock_tail(self, topic="", passive=False, **kw):
+            topics.append(topic)
+            return iter([])
+
+        config = {}
+        with mock.patch("fedmsg.__local", self.local):
+            with mock.patch("fedmsg.config.__cache", config):
+                with mock.patch(
+                        "fedmsg.core.FedMsgContext.tail_messages", mock_tail):
+                    command = TailCommand()
+                    command.execute()
+
+        assert topics == [['org.fp.prod.bodhi.update', 'org.fp.prod.koji.']]
+
+    @mock.patch("sys.argv", new_callable=lambda: [
+        "fedmsg-tail", "--include", r"^(?:org"])
+    @mock.patch("sys.stdout", new_callable=six.StringIO)
+    def test_tail_bad_include(self, stdout, argv):
+        config = {}
+        with mock.patch("fedmsg.__local", self.local):
+            with mock.patch("fedmsg.config.__cache", config):
+                command = TailCommand()
+                with self.assertRaises(re.error):
+                    command.execute()
+
     @mock.patch("sys.argv", new_callable=lambda: ["fedmsg-tail", "--pretty"])
     @mock.patch("sys.stdout", new_callable=six.StringIO)
     def test_tail_pretty(self, stdout, argv):
@@ -133,11 +133,15 @@ class FedmsgConfigTests(unittest.TestCase):
     defaults = {
         'topic_prefix': 'com.example',
         'environment': 'dev',
+        'default_modname': None,
         'io_threads': 1,
         'post_init_sleep': 0.5,
+        'post_init_handshake': True,
         'timeout': 2,
         'print_config': False,
         'high_water_mark': 0,
+        'high_water_mark_bytes': None,
+        'high_water_mark_policy': 'drop',
         # milliseconds
         'zmq_linger': 1000,
         'zmq_enabled': True,
@@ -154,8 +158,18 @@ class FedmsgConfigTests(unittest.TestCase):
             ]
         },
         'relay_inbound': 'tcp://127.0.0.1:2001',
+        'spool_directory': None,
+        'spool_batch_size': 100,
+        'ipc_endpoints': {},
+        'endpoint_lease_dir': None,
+        'dns_cache': None,
+        'dns_cache_expiry': 300,
+        'subscriber_sockets': None,
+        'shared_publisher': False,
+        'priority_lanes': {},
         'fedmsg.consumers.gateway.port': 9940,
         'fedmsg.consumers.gateway.high_water_mark': 1000,
+        'fedmsg.consumers.gateway.high_water_mark_bytes': None,
         'sign_messages': False,
         'validate_signatures': True,
         'crypto_backend': 'x509',
@@ -239,6 +253,20 @@ class FedmsgConfigTests(unittest.TestCase):
         'stomp_ssl_key': None,
         'datagrepper_url': None,
         'skip_last_message': False,
+        'publish_async': False,
+        'publish_queue_size': 1000,
+        'publish_queue_overflow': 'block',
+        'publish_stats': False,
+        'publish_stats_callback': None,
+        'publish_stats_interval': 60,
+        'publish_coalesce': False,
+        'publish_coalesce_linger': 0.005,
+        'publish_trace': False,
+        'publish_lazy': False,
+        'blob_store': None,
+        'blob_threshold': 65536,
+        'msg_id_format': 'random',
+        'publish_rate_limits': {},
     }
 
     def test_defaults(self):
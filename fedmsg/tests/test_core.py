@@ -4,9 +4,21 @@ try:
     import mock
 except ImportError:
     from unittest import mock
+import copy
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import warnings
 
-from fedmsg.core import FedMsgContext
+import zmq
+
+import fedmsg.core
+import fedmsg.ratelimit
+from fedmsg.core import FedMsgContext, PublishQueue
 from fedmsg.tests.common import load_config
 
 
@@ -16,6 +28,9 @@ class TestCore(unittest.TestCase):
         config['io_threads'] = 1
         self.ctx = FedMsgContext(**config)
 
+    def tearDown(self):
+        self.ctx.destroy()
+
     def test_send_message(self):
         """send_message is deprecated
 
@@ -36,3 +51,957 @@ class TestCore(unittest.TestCase):
             assert topic == fake_topic
             assert msg == fake_msg
             assert modname is None
+
+    def test_publish_many(self):
+        """publish_many sends every message with a fully qualified topic"""
+        self.ctx.publisher = mock.Mock()
+        count = self.ctx.publish_many([
+            ('foo', {'a': 1}, 'bar'),
+            ('baz', {'b': 2}, 'bar'),
+        ])
+        assert count == 2
+        calls = self.ctx.publisher.send_multipart.call_args_list
+        assert len(calls) == 2
+        topics = [c[0][0][0] for c in calls]
+        assert topics == [
+            b'org.fedoraproject.dev.bar.foo',
+            b'org.fedoraproject.dev.bar.baz',
+        ]
+        assert self.ctx._i == 2
+
+    def test_publish_many_uses_store_add_many(self):
+        """publish_many assigns seq_ids through the store in one call"""
+        self.ctx.publisher = mock.Mock()
+        store = mock.Mock()
+        store.add_many.side_effect = lambda msgs: msgs
+        self.ctx.c['persistent_store'] = store
+        self.ctx.publish_many([('foo', {}, 'bar'), ('foo', {}, 'bar')])
+        assert store.add_many.call_count == 1
+        assert not store.add.called
+
+    def test_publish_many_empty(self):
+        """publish_many with nothing to send does nothing"""
+        self.ctx.publisher = mock.Mock()
+        assert self.ctx.publish_many([]) == 0
+        assert not self.ctx.publisher.send_multipart.called
+
+    def test_publish_default_modname(self):
+        """publish uses the configured default_modname when none is given"""
+        self.ctx.publisher = mock.Mock()
+        self.ctx.c['default_modname'] = 'koji'
+        self.ctx.publish(topic='foo', msg={})
+        topic = self.ctx.publisher.send_multipart.call_args[0][0][0]
+        assert topic == b'org.fedoraproject.dev.koji.foo'
+
+    def test_stats_disabled(self):
+        """stats are off unless publish_stats is set"""
+        assert self.ctx.stats() is None
+
+    def test_fork_reinitializes(self):
+        """a context used in a forked child gets fresh sockets"""
+        parent_context = self.ctx.context
+        self.ctx.publisher.close()
+        self.ctx.c['post_init_sleep'] = 0
+        with mock.patch('fedmsg.core._getpid', return_value=-1):
+            self.ctx.publish(topic='foo', msg={}, modname='bar')
+            assert self.ctx._pid == -1
+        assert self.ctx.context is not parent_context
+        assert self.ctx.publisher is not None
+        parent_context.term()
+
+    def test_rate_limits(self):
+        """messages over the rate are held back and summarized"""
+        self.ctx.publisher = mock.Mock()
+        self.ctx._limiter = fedmsg.ratelimit.RateLimiter({
+            '*.bar.*': {'rate': 1, 'action': 'summarize'},
+        })
+        self.ctx.publish(topic='foo', msg={}, modname='bar')
+        assert self.ctx.publish_many([('foo', {}, 'bar'), ('foo', {}, 'bar')]) == 0
+        assert self.ctx.publisher.send_multipart.call_count == 1
+
+        # A minute later, the summary goes out with the next message.
+        self.ctx._limiter.rules[0].since -= 60
+        self.ctx.publish(topic='foo', msg={}, modname='baz')
+        calls = self.ctx.publisher.send_multipart.call_args_list
+        assert [c[0][0][0] for c in calls[1:]] == [
+            b'org.fedoraproject.dev.fedmsg.rate_limit.summary',
+            b'org.fedoraproject.dev.baz.foo',
+        ]
+        summary = json.loads(calls[1][0][0][1].decode('utf-8'))
+        assert summary['msg']['suppressed'] == {
+            'org.fedoraproject.dev.bar.foo': 2}
+        assert self.ctx.rate_limit_stats()['*.bar.*']['summarized'] == 2
+
+    def test_rate_limit_summary_timer(self):
+        """summaries go out when due, even if nothing else is published"""
+        self.ctx.publisher = mock.Mock()
+        self.ctx._limiter = fedmsg.ratelimit.RateLimiter({
+            '*.bar.*': {'rate': 1, 'action': 'summarize', 'interval': 0.5},
+        })
+        self.ctx.publish_many([('foo', {}, 'bar')] * 3)
+        assert self.ctx.publisher.send_multipart.call_count == 1
+        self.ctx._summary_timer.join(2)
+        calls = self.ctx.publisher.send_multipart.call_args_list
+        assert [c[0][0][0] for c in calls[1:]] == [
+            b'org.fedoraproject.dev.fedmsg.rate_limit.summary']
+        assert self.ctx._summary_timer is None
+
+    def test_rate_limit_summary_on_destroy(self):
+        """destroy sends the summaries that aren't due yet"""
+        publisher = self.ctx.publisher
+        self.ctx._limiter = fedmsg.ratelimit.RateLimiter({
+            '*.bar.*': {'rate': 1, 'action': 'summarize'},
+        })
+        self.ctx.publish_many([('foo', {}, 'bar')] * 2)
+        timer = self.ctx._summary_timer
+        with mock.patch.object(publisher, 'send_multipart') as send:
+            self.ctx.destroy()
+        assert not timer.is_alive()
+        topic, body = send.call_args[0][0]
+        assert topic == b'org.fedoraproject.dev.fedmsg.rate_limit.summary'
+        assert json.loads(body.decode('utf-8'))['msg']['suppressed'] == {
+            'org.fedoraproject.dev.bar.foo': 1}
+
+    def test_publisher_for_is_cached(self):
+        """publisher_for returns the same prepared publisher for a modname"""
+        assert self.ctx.publisher_for('bar') is self.ctx.publisher_for('bar')
+        assert self.ctx.publisher_for('bar') is not self.ctx.publisher_for('baz')
+
+    def test_prepared_publisher_envelope(self):
+        """prepared publishers build the usual message envelope"""
+        topic, msg = self.ctx.publisher_for('bar').envelope('foo', {'a': 1})
+        assert topic == b'org.fedoraproject.dev.bar.foo'
+        assert msg['topic'] == u'org.fedoraproject.dev.bar.foo'
+        assert msg['msg'] == {'a': 1}
+        assert msg['i'] == self.ctx._i == 1
+        assert msg['msg_id'].startswith(time.strftime('%Y-'))
+
+    def test_time_ordered_msg_id(self):
+        """time-ordered msg_ids sort in the order messages were made"""
+        self.ctx.c['msg_id_format'] = 'time-ordered'
+        publisher = fedmsg.core.PreparedPublisher(self.ctx, 'bar')
+        ids = [publisher.envelope('foo')[1]['msg_id'] for _ in range(5000)]
+        assert ids == sorted(ids)
+        assert len(set(ids)) == len(ids)
+        assert ids[0].startswith(time.strftime('%Y-'))
+        assert len(ids[0]) == len(time.strftime('%Y-')) + 36
+        assert ids[0][len(time.strftime('%Y-')):][14] == '7'
+
+        self.ctx.c['msg_id_format'] = 'sequential'
+        self.assertRaises(
+            ValueError, fedmsg.core.PreparedPublisher, self.ctx, 'bar')
+
+    def test_prepared_publisher_publish(self):
+        """prepared publishers send over the context's socket"""
+        self.ctx.publisher = mock.Mock()
+        self.ctx.publisher_for('bar').publish('foo', {'a': 1})
+        topic = self.ctx.publisher.send_multipart.call_args[0][0][0]
+        assert topic == b'org.fedoraproject.dev.bar.foo'
+
+    def test_signing_config_does_not_mutate_config(self):
+        """resolving the signing cert leaves the context config alone"""
+        self.ctx.c['certnames'] = {self.ctx.c['name']: 'shell-app01'}
+        config = self.ctx._crypto_config()
+        assert config['certname'] == 'shell-app01'
+        assert 'certname' not in self.ctx.c
+
+
+class TestEndpointLeases(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = load_config()
+        self.config['io_threads'] = 1
+        self.config['post_init_sleep'] = 0
+        self.config['endpoint_lease_dir'] = self.directory
+        self.contexts = []
+
+    def tearDown(self):
+        for ctx in self.contexts:
+            ctx.destroy()
+        shutil.rmtree(self.directory)
+
+    def test_leases(self):
+        """each context binds the endpoint it holds the lease for"""
+        for _ in range(2):
+            self.contexts.append(FedMsgContext(**copy.deepcopy(self.config)))
+        leases = [ctx._lease for ctx in self.contexts]
+        assert None not in leases
+        assert len(set(leases)) == 2
+        with self.assertRaises(IOError):
+            self.contexts.append(FedMsgContext(**copy.deepcopy(self.config)))
+
+    def test_destroy_releases_lease(self):
+        """destroying a context gives its endpoint back"""
+        ctx = FedMsgContext(**copy.deepcopy(self.config))
+        ctx.destroy()
+        assert ctx._lease is None
+        self.contexts.append(FedMsgContext(**copy.deepcopy(self.config)))
+
+
+class TestPublishQueue(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.context = mock.Mock()
+        self.context._process.side_effect = lambda *a: self.release.wait(5)
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            PublishQueue(self.context, overflow='explode')
+
+    def test_drop_newest(self):
+        """when full, drop-newest discards the message being published"""
+        q = PublishQueue(self.context, maxsize=1, overflow='drop-newest')
+        q.put([('a', 1)])
+        while q.queue.qsize():  # wait for the worker to pick it up
+            time.sleep(0.01)
+        q.put([('b', 2)])
+        q.put([('c', 3)])
+        self.release.set()
+        q.close()
+        assert q.stats() == dict(
+            enqueued=2, sent=2, dropped=1, errors=0, queued=0)
+        batches = [c[0][0] for c in self.context._process.call_args_list]
+        assert batches == [[('a', 1)], [('b', 2)]]
+
+    def test_drop_oldest(self):
+        """when full, drop-oldest discards the oldest queued message"""
+        q = PublishQueue(self.context, maxsize=1, overflow='drop-oldest')
+        q.put([('a', 1)])
+        while q.queue.qsize():
+            time.sleep(0.01)
+        q.put([('b', 2)])
+        q.put([('c', 3)])
+        self.release.set()
+        q.close()
+        assert q.stats()['dropped'] == 1
+        batches = [c[0][0] for c in self.context._process.call_args_list]
+        assert batches == [[('a', 1)], [('c', 3)]]
+
+    def test_errors_are_counted(self):
+        self.context._process.side_effect = ValueError
+        q = PublishQueue(self.context)
+        q.put([('a', 1)])
+        q.close()
+        assert q.stats()['errors'] == 1
+
+
+class TestAsyncPublish(unittest.TestCase):
+    def setUp(self):
+        config = load_config()
+        config['io_threads'] = 1
+        config['publish_async'] = True
+        self.ctx = FedMsgContext(**config)
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def test_publish_async(self):
+        """publish hands messages to the background worker"""
+        publisher = self.ctx.publisher = mock.Mock()
+        self.ctx.publish(topic='foo', msg={'a': 1}, modname='bar')
+        self.ctx.publish_many([('foo', {}, 'bar'), ('baz', {}, 'bar')])
+        self.ctx.flush()
+        assert publisher.send_multipart.call_count == 3
+        assert self.ctx.queue_stats()['sent'] == 3
+
+
+class TestCoalesce(unittest.TestCase):
+    def setUp(self):
+        config = load_config()
+        config['io_threads'] = 1
+        config['publish_coalesce'] = True
+        self.ctx = FedMsgContext(**config)
+        self.publisher = self.ctx.publisher = mock.Mock()
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def test_publish_many_coalesces_by_topic(self):
+        """a batch goes out as one multipart message per topic"""
+        self.ctx.publish_many([
+            ('foo', {'a': 1}, 'bar'),
+            ('baz', {'b': 2}, 'bar'),
+            ('foo', {'c': 3}, 'bar'),
+        ])
+        calls = self.publisher.send_multipart.call_args_list
+        assert len(calls) == 2
+        frames = calls[0][0][0]
+        assert frames[0] == b'org.fedoraproject.dev.bar.foo'
+        bodies = [json.loads(f.decode('utf-8'))['msg'] for f in frames[1:]]
+        assert bodies == [{'a': 1}, {'c': 3}]
+        assert len(calls[1][0][0]) == 2
+
+    def test_queue_linger_coalesces(self):
+        """the background queue groups messages published close together"""
+        self.ctx._queue = PublishQueue(self.ctx, linger=0.2)
+        for i in range(3):
+            self.ctx.publish(topic='foo', msg={'i': i}, modname='bar')
+        self.ctx.flush()
+        assert self.publisher.send_multipart.call_count == 1
+        assert len(self.publisher.send_multipart.call_args[0][0]) == 4
+        assert self.ctx.queue_stats()['sent'] == 3
+
+    def test_run_socket_unpacks(self):
+        """subscribers yield each message of a coalesced group"""
+        self.ctx.c['replay_endpoints'] = {}
+        bodies = [json.dumps({'topic': 'foo', 'i': i}).encode('utf-8')
+                  for i in range(3)]
+        sock = mock.Mock()
+        sock.recv_multipart.return_value = [b'foo'] + bodies
+        results = list(self.ctx._run_socket(sock, 'name', 'ep'))
+        assert [r[3]['i'] for r in results] == [0, 1, 2]
+        assert all(r[2] == 'foo' for r in results)
+
+
+class TestReceive(unittest.TestCase):
+    def setUp(self):
+        config = load_config()
+        config['io_threads'] = 1
+        config['replay_endpoints'] = {}
+        config['validate_signatures'] = False
+        self.ctx = FedMsgContext(**config)
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def test_envelope_sender(self):
+        """each context numbers its messages under an id of its own"""
+        _, first = self.ctx.publisher_for('bar').envelope('foo', {})
+        other = FedMsgContext(**dict(self.ctx.c, mute=True))
+        try:
+            _, second = other.publisher_for('bar').envelope('foo', {})
+        finally:
+            other.destroy()
+        assert first['i'] == second['i'] == 1
+        assert first['sender'] != second['sender']
+
+    def test_run_socket_lazy(self):
+        """lazy subscribers decode bodies only when they're looked at"""
+        body = json.dumps({'topic': 'foo', 'i': 1}).encode('utf-8')
+        sock = mock.Mock()
+        sock.recv_multipart.return_value = [zmq.Frame(b'foo'), zmq.Frame(body)]
+        (_, _, topic, msg), = self.ctx._run_socket(sock, 'name', 'ep', lazy=True)
+        sock.recv_multipart.assert_called_with(0, copy=False)
+        assert topic == 'foo'
+        assert isinstance(msg, fedmsg.encoding.LazyMessage)
+        assert msg._dict is None
+        assert msg['i'] == 1
+
+        # Validation needs the whole message right away.
+        self.ctx.c['validate_signatures'] = True
+        with mock.patch('fedmsg.crypto.validate', return_value=True):
+            (_, _, _, msg), = self.ctx._run_socket(sock, 'name', 'ep', lazy=True)
+        assert type(msg) is dict
+
+    def test_poll_tracks_loss(self):
+        """tail_messages on every topic counts the messages that went missing"""
+        sock = mock.Mock()
+        sock.recv_multipart.return_value = [b'foo'] + [
+            json.dumps({'topic': 'foo', 'i': i, 'sender': 's'}).encode('utf-8')
+            for i in (1, 2, 5)]
+        poller = mock.Mock()
+        poller.poll.return_value = [(sock, zmq.POLLIN)]
+        results = self.ctx._poll(poller, {sock: ('name', 'ep')}, track_loss=True)
+        for _ in range(3):
+            next(results)
+        stats = self.ctx.loss_stats()['ep']
+        assert stats['received'] == 3
+        assert stats['lost'] == 2
+
+
+class TestBatches(unittest.TestCase):
+    def setUp(self):
+        config = load_config()
+        config['io_threads'] = 1
+        config['replay_endpoints'] = {}
+        self.ctx = FedMsgContext(**config)
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def test_poll_batches(self):
+        """tail_batches drains ready sockets and yields bounded lists"""
+        sock = mock.Mock()
+        sock.recv_multipart.side_effect = [
+            [b'foo', json.dumps({'topic': 'foo', 'i': i}).encode('utf-8')]
+            for i in range(5)] + [zmq.Again()]
+        poller = mock.Mock()
+        poller.poll.return_value = [(sock, zmq.POLLIN)]
+        batches = self.ctx._poll_batches(
+            poller, {sock: ('name', 'ep')}, max_batch=3, max_latency=0)
+
+        assert [r[3]['i'] for r in next(batches)] == [0, 1, 2]
+        assert [r[3]['i'] for r in next(batches)] == [3, 4]
+        assert poller.poll.call_count == 2
+        sock.recv_multipart.assert_called_with(zmq.NOBLOCK)
+
+    def test_poll_batches_latency(self):
+        """a batch that isn't full waits at most max_latency"""
+        sock = mock.Mock()
+        sock.recv_multipart.side_effect = [
+            [b'foo', json.dumps({'topic': 'foo'}).encode('utf-8')],
+            zmq.Again()]
+        polls = [[(sock, zmq.POLLIN)]]
+
+        def poll(timeout=None):
+            if polls:
+                return polls.pop()
+            time.sleep(timeout / 1000.0)
+            return []
+
+        poller = mock.Mock()
+        poller.poll.side_effect = poll
+        batches = self.ctx._poll_batches(
+            poller, {sock: ('name', 'ep')}, max_batch=10, max_latency=0.05)
+
+        assert len(next(batches)) == 1
+        assert poller.poll.call_count == 2
+        assert 0 < poller.poll.call_args[0][0] <= 50
+
+    def test_tail_batches_max_batch(self):
+        with self.assertRaises(ValueError):
+            next(self.ctx.tail_batches(max_batch=0))
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        config = load_config()
+        config['io_threads'] = 1
+        config['publish_coalesce'] = True
+        config['publish_trace'] = True
+        config['replay_endpoints'] = {}
+        self.ctx = FedMsgContext(**config)
+        self.publisher = self.ctx.publisher = mock.Mock()
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def test_trace_frames(self):
+        """each body is followed by a trace frame, which subscribers time"""
+        self.ctx.publish_many([('foo', {'a': 1}, 'bar'), ('foo', {'b': 2}, 'bar')])
+        frames = self.publisher.send_multipart.call_args[0][0]
+        assert len(frames) == 5
+        assert frames[2] == frames[4]
+        assert frames[2].startswith(b'\x00')
+        trace = json.loads(frames[2][1:].decode('utf-8'))
+        assert [hop for hop, _, _ in trace] == ['publish']
+
+        sock = mock.Mock()
+        sock.recv_multipart.return_value = frames
+        results = list(self.ctx._run_socket(sock, 'name', 'ep'))
+        assert [r[3]['msg'] for r in results] == [{'a': 1}, {'b': 2}]
+        stats = self.ctx.latency_stats()
+        assert list(stats) == ['publish->receive']
+        assert stats['publish->receive']['count'] == 2
+
+    def test_untraced_messages(self):
+        """messages without a trace frame don't count"""
+        body = json.dumps({'topic': 'foo', 'i': 1}).encode('utf-8')
+        assert fedmsg.core._unpack([b'foo', body]) == [(b'foo', body, None)]
+        sock = mock.Mock()
+        sock.recv_multipart.return_value = [b'foo', body]
+        assert len(list(self.ctx._run_socket(sock, 'name', 'ep'))) == 1
+        assert self.ctx.latency_stats() == {}
+
+
+class TestLazyPublish(unittest.TestCase):
+    def setUp(self):
+        config = load_config()
+        config['io_threads'] = 1
+        config['name'] = 'lazytest'
+        config['endpoints'] = {'lazytest': ['tcp://127.0.0.1:0']}
+        config['post_init_sleep'] = 0
+        config['publish_lazy'] = True
+        config['publish_stats'] = True
+        self.store = config['persistent_store'] = mock.Mock()
+        self.store.add.side_effect = lambda msg: msg
+        self.ctx = FedMsgContext(**config)
+        self.subscriber = None
+
+    def tearDown(self):
+        if self.subscriber:
+            self.subscriber.close()
+        self.ctx.destroy()
+
+    def subscribe(self, prefix):
+        endpoint = self.ctx.publisher.getsockopt(zmq.LAST_ENDPOINT)
+        self.subscriber = self.ctx.context.socket(zmq.SUB)
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, prefix)
+        self.subscriber.connect(
+            endpoint.decode('utf-8').replace('0.0.0.0', '127.0.0.1'))
+        time.sleep(0.2)
+
+    def test_nobody_listening(self):
+        """messages without subscribers are neither stored nor sent"""
+        assert self.ctx.publisher.type == zmq.XPUB
+        self.ctx.publish(topic='foo', msg={}, modname='bar')
+        assert not self.store.add.called
+        assert self.ctx.stats()['skipped'] == 1
+        assert self.ctx.stats()['messages'] == 0
+
+    def test_only_subscribed_topics_are_built(self):
+        """messages go out once a subscriber's prefix matches their topic"""
+        self.subscribe(b'org.fedoraproject.dev.bar.foo')
+        self.ctx.publish_many([('foo', {}, 'bar'), ('baz', {}, 'bar')])
+        assert self.subscriber.poll(1000)
+        topic, _ = self.subscriber.recv_multipart()
+        assert topic == b'org.fedoraproject.dev.bar.foo'
+        assert self.store.add.call_count == 1
+        assert self.ctx.stats()['skipped'] == 1
+
+        # Once the subscriber is gone, we're back to skipping.  zeromq may
+        # take one more call to notice the disconnection.
+        self.subscriber.close()
+        self.subscriber = None
+        time.sleep(0.2)
+        self.ctx.publish(topic='foo', msg={}, modname='bar')
+        time.sleep(0.2)
+        self.ctx.publish(topic='foo', msg={}, modname='bar')
+        assert self.ctx.stats()['skipped'] >= 2
+
+
+class TestByteBudget(unittest.TestCase):
+    def setUp(self):
+        config = load_config()
+        config['io_threads'] = 1
+        config['name'] = 'budgettest'
+        config['endpoints'] = {'budgettest': ['tcp://127.0.0.1:0']}
+        config['post_init_sleep'] = 0
+        config['high_water_mark_bytes'] = 1024 * 1024
+        self.config = config
+        self.ctx = None
+
+    def tearDown(self):
+        if self.ctx:
+            self.ctx.destroy()
+
+    def test_publisher_budget(self):
+        """the publisher's high water mark follows the size of its messages"""
+        self.ctx = FedMsgContext(**self.config)
+        budget = self.ctx._budgets[self.ctx.publisher]
+        assert self.ctx.publisher.getsockopt(zmq.SNDHWM) == 1024
+
+        body = {'data': 'x' * 16 * 1024}
+        self.ctx.publish_many([('foo', body, 'bar')] * budget.interval)
+        assert budget.count == budget.interval
+        assert self.ctx.publisher.getsockopt(zmq.SNDHWM) < 100
+
+    def test_subscriber_budget(self):
+        """subscribers get a budget for as long as they're around"""
+        self.ctx = FedMsgContext(**self.config)
+        subs = self.ctx._create_subs()
+        assert all(sub in self.ctx._budgets for sub in subs)
+        self.ctx._close_subs(subs)
+        assert list(self.ctx._budgets) == [self.ctx.publisher]
+
+    def test_block_policy(self):
+        """the block policy waits for subscribers instead of dropping"""
+        self.config['high_water_mark_policy'] = 'block'
+        self.ctx = FedMsgContext(**self.config)
+        assert self.ctx.publisher.type == zmq.XPUB
+        assert self.ctx._send_flags == 0
+
+        # Unlike with publish_lazy, everything is still built.
+        self.ctx._read_subscriptions = mock.Mock()
+        batch = [(b'foo', {})]
+        assert self.ctx._filter(batch) == batch
+        assert self.ctx._read_subscriptions.called
+
+    def test_bad_policy(self):
+        self.config['high_water_mark_policy'] = 'explode'
+        self.assertRaises(ValueError, FedMsgContext, **self.config)
+
+
+class TestPriorityLanes(unittest.TestCase):
+    def setUp(self):
+        config = load_config()
+        config['io_threads'] = 1
+        config['name'] = 'lanetest'
+        config['endpoints'] = {
+            'lanetest': ['tcp://127.0.0.1:0'],
+            'lanetest@critical': ['tcp://127.0.0.1:0'],
+        }
+        config['post_init_sleep'] = 0
+        config['priority_lanes'] = {
+            'critical': {'topics': ['*.announce.*'], 'priority': 5},
+            'unused': {'topics': ['*']},
+        }
+        self.ctx = FedMsgContext(**config)
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def test_lane_socket(self):
+        """topics of a lane go out on the lane's own socket"""
+        assert [lane.name for lane in self.ctx._lanes] == ['critical']
+        lane = self.ctx._lanes[0]
+        endpoint = lane.socket.getsockopt(zmq.LAST_ENDPOINT).decode('utf-8')
+        subscriber = self.ctx.context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.SUBSCRIBE, b'')
+        subscriber.connect(endpoint.replace('0.0.0.0', '127.0.0.1'))
+        time.sleep(0.2)
+        try:
+            self.ctx.publish(topic='fedora', msg={}, modname='bar')
+            self.ctx.publish(topic='announce.new', msg={}, modname='bar')
+            assert subscriber.poll(1000)
+            topic, _ = subscriber.recv_multipart()
+            assert topic == b'org.fedoraproject.dev.bar.announce.new'
+            assert not subscriber.poll(100)
+        finally:
+            subscriber.close()
+
+    def test_priorities(self):
+        """subscribers rank endpoints by the priority of their lane"""
+        subs = {'a': ('bodhi.app01', 'ep'), 'b': ('bodhi.app01@critical', 'ep'),
+                'c': ('bodhi.app01@other', 'ep')}
+        assert self.ctx._priorities(subs) == {'a': 0, 'b': 5, 'c': 1}
+
+    def test_lane_counters(self):
+        """each socket numbers its own messages, without holes"""
+        publisher = self.ctx.publisher_for('bar')
+        envelopes = [publisher.envelope(topic, {})[1] for topic in (
+            'fedora', 'announce.new', 'fedora', 'announce.new')]
+        assert [msg['i'] for msg in envelopes] == [1, 1, 2, 2]
+        assert envelopes[0]['sender'] == envelopes[2]['sender']
+        assert envelopes[1]['sender'] == envelopes[3]['sender']
+        assert envelopes[0]['sender'] != envelopes[1]['sender']
+
+    def test_lane_names(self):
+        """messages of a lane are yielded under the name of their publisher"""
+        self.ctx.c['replay_endpoints'] = {'bodhi.app01': 'tcp://replay:1'}
+        subs = {'a': ('bodhi.app01@critical', 'ep')}
+        assert self.ctx._watched_names(subs) == {'bodhi.app01': -1}
+
+        body = json.dumps({'topic': 'foo', 'i': 1}).encode('utf-8')
+        sock = mock.Mock()
+        sock.recv_multipart.return_value = [b'foo', body]
+        self.ctx.c['replay_endpoints'] = {}
+        (name, ep, _, _), = self.ctx._run_socket(
+            sock, 'bodhi.app01@critical', 'ep')
+        assert (name, ep) == ('bodhi.app01', 'ep')
+
+
+class TestIpcEndpoints(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ipc = 'ipc://' + os.path.join(self.directory, 'ipctest')
+        config = load_config()
+        config['io_threads'] = 1
+        config['name'] = 'ipctest'
+        config['endpoints'] = {'ipctest': ['tcp://127.0.0.1:0']}
+        config['ipc_endpoints'] = {'ipctest': [self.ipc]}
+        config['post_init_sleep'] = 0
+        self.ctx = FedMsgContext(**config)
+
+    def tearDown(self):
+        self.ctx.destroy()
+        shutil.rmtree(self.directory)
+
+    def test_local_subscribers_use_ipc(self):
+        """the publisher binds the ipc:// twin and local subscribers use it"""
+        assert os.path.exists(self.ipc[len('ipc://'):])
+
+        subs = self.ctx._create_subs()
+        try:
+            assert list(subs.values()) == [('ipctest', self.ipc)]
+            time.sleep(0.2)
+            self.ctx.publish(topic='foo', msg={}, modname='bar')
+            sub, = subs
+            assert sub.poll(1000)
+            topic, _ = sub.recv_multipart()
+            assert topic == b'org.fedoraproject.dev.bar.foo'
+        finally:
+            self.ctx._close_subs(subs)
+
+    def test_hosts_looked_up_once(self):
+        """the ipc:// shortcut goes by what resolve_hostnames found"""
+        own = socket.gethostname()
+        with mock.patch('fedmsg.core.resolve_hostnames') as resolve, \
+                mock.patch('socket.gethostbyname_ex') as lookup:
+            resolve.return_value = {'127.0.0.1': ['127.0.0.1'], own: []}
+            subs = self.ctx._create_subs()
+        try:
+            assert list(subs.values()) == [('ipctest', self.ipc)]
+            assert resolve.call_args[0][0] == set(['127.0.0.1', own])
+            assert not lookup.called
+        finally:
+            self.ctx._close_subs(subs)
+
+    def test_remote_subscribers_use_tcp(self):
+        with mock.patch('fedmsg.utils.is_local_host', return_value=False):
+            subs = self.ctx._create_subs()
+        try:
+            assert list(subs.values()) == [('ipctest', 'tcp://127.0.0.1:0')]
+        finally:
+            self.ctx._close_subs(subs)
+
+
+class TestSharedSubscribers(unittest.TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        self.publishers, endpoints = [], {}
+        for name, host in [('a.host', '127.0.0.1'), ('b.host', '127.0.0.2')]:
+            publisher = self.context.socket(zmq.PUB)
+            port = publisher.bind_to_random_port('tcp://' + host)
+            endpoints[name] = ['tcp://%s:%i' % (host, port)]
+            self.publishers.append(publisher)
+
+        config = load_config()
+        config['io_threads'] = 1
+        config['endpoints'] = endpoints
+        config['replay_endpoints'] = {}
+        config['subscriber_sockets'] = 1
+        self.ctx = FedMsgContext(**config)
+
+    def tearDown(self):
+        self.ctx.destroy()
+        for publisher in self.publishers:
+            publisher.close()
+        self.context.term()
+
+    def test_shard_endpoints(self):
+        """names on the same host never share a socket"""
+        endpoints = [
+            ('a', 'tcp://one:1', 'one'), ('a', 'tcp://one:2', 'one'),
+            ('b', 'tcp://one:3', 'one'), ('c', 'tcp://two:1', 'two')]
+        addresses = {'one': ['10.0.0.1'], 'two': ['10.0.0.2']}
+        groups = fedmsg.core._shard_endpoints(endpoints, addresses, 1)
+        assert groups == [
+            ({'10.0.0.1': ('a', None)}, ['tcp://one:1', 'tcp://one:2']),
+            ({'10.0.0.1': ('b', 'tcp://one:3'), '10.0.0.2': ('c', 'tcp://two:1')},
+             ['tcp://one:3', 'tcp://two:1']),
+        ]
+
+    def test_attribution(self):
+        """one socket, and messages still tell where they came from"""
+        subs = self.ctx._create_subs()
+        try:
+            assert list(subs.values()) == [(None, None)]
+            sub, = subs
+            time.sleep(0.3)
+            for publisher in self.publishers:
+                publisher.send_multipart(
+                    [b'foo', json.dumps({'topic': 'foo'}).encode('utf-8')])
+
+            results = []
+            while len(results) < 2 and sub.poll(1000):
+                results.extend(self.ctx._run_socket(sub, None, None))
+            assert sorted(r[:3] for r in results) == [
+                ('a.host', self.ctx.c['endpoints']['a.host'][0], 'foo'),
+                ('b.host', self.ctx.c['endpoints']['b.host'][0], 'foo'),
+            ]
+        finally:
+            self.ctx._close_subs(subs)
+        assert self.ctx._peers == {}
+
+    def test_topic_prefixes(self):
+        """only the topics subscribed to come through"""
+        subs = self.ctx._create_subs(topic=['foo', 'bar'])
+        try:
+            sub, = subs
+            time.sleep(0.3)
+            for topic in (b'foo.1', b'baz.1', b'bar.1'):
+                self.publishers[0].send_multipart(
+                    [topic, json.dumps({'topic': 'x'}).encode('utf-8')])
+
+            topics = []
+            while sub.poll(200):
+                topics.append(sub.recv_multipart()[0])
+            assert topics == [b'foo.1', b'bar.1']
+        finally:
+            self.ctx._close_subs(subs)
+
+    def test_prefixes(self):
+        assert fedmsg.core._prefixes('') == ['']
+        assert fedmsg.core._prefixes([]) == ['']
+        assert fedmsg.core._prefixes('foo') == ['foo']
+        assert fedmsg.core._prefixes(['foo', 'bar']) == ['foo', 'bar']
+
+
+class TestPublishStats(unittest.TestCase):
+    def setUp(self):
+        config = load_config()
+        config['io_threads'] = 1
+        config['publish_stats'] = True
+        self.ctx = FedMsgContext(**config)
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def test_stats(self):
+        """publish records counters and stage timings"""
+        self.ctx.publisher = mock.Mock()
+        self.ctx.publish(topic='foo', msg={'a': 1}, modname='bar')
+        stats = self.ctx.stats()
+        assert stats['messages'] == 1
+        assert stats['topics'][u'org.fedoraproject.dev.bar.foo']['messages'] == 1
+        for stage in ('topic', 'encode', 'send'):
+            assert stats['stages'][stage]['count'] == 1
+
+    def test_stats_again(self):
+        """sends refused by zmq are counted"""
+        self.ctx.publisher = mock.Mock()
+        self.ctx.publisher.send_multipart.side_effect = zmq.Again
+        with self.assertRaises(zmq.Again):
+            self.ctx.publish(topic='foo', msg={'a': 1}, modname='bar')
+        assert self.ctx.stats()['again'] == 1
+        assert self.ctx.stats()['messages'] == 0
+
+
+class TestPostInitHandshake(unittest.TestCase):
+    def setUp(self):
+        self.zmq_context = zmq.Context()
+        self.relay = self.zmq_context.socket(zmq.SUB)
+        self.relay.setsockopt(zmq.SUBSCRIBE, b'')
+        port = self.relay.bind_to_random_port('tcp://127.0.0.1')
+
+        self.config = load_config()
+        self.config['io_threads'] = 1
+        self.config['active'] = True
+        self.config['name'] = 'relay_inbound'
+        self.config['relay_inbound'] = 'tcp://127.0.0.1:%i' % port
+        self.config['post_init_sleep'] = 5
+        self.ctx = None
+
+    def tearDown(self):
+        if self.ctx:
+            self.ctx.destroy()
+        self.relay.close()
+        self.zmq_context.term()
+
+    def test_active_waits_for_subscription(self):
+        """in active mode, init waits for the relay's subscription"""
+        self.config['post_init_sleep'] = 0.2
+        self.ctx = FedMsgContext(**self.config)
+        assert self.ctx.publisher.type == zmq.XPUB
+        assert self.ctx._waits_for_subscription()
+
+    def test_first_message_arrives(self):
+        """init returns once subscribed, and the first message isn't dropped"""
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        subscriber = self.zmq_context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.SUBSCRIBE, b'')
+        subscriber.connect('tcp://127.0.0.1:%i' % port)
+
+        self.config['active'] = False
+        self.config['publish_lazy'] = True
+        self.config['name'] = 'handshaketest'
+        self.config['endpoints'] = {
+            'handshaketest': ['tcp://127.0.0.1:%i' % port]}
+        try:
+            start = time.time()
+            self.ctx = FedMsgContext(**self.config)
+            assert time.time() - start < 4
+            self.ctx.publish(topic='foo', msg={'a': 1}, modname='bar')
+            assert subscriber.poll(1000)
+            topic, body = subscriber.recv_multipart()
+            assert json.loads(body.decode('utf-8'))['msg'] == {'a': 1}
+        finally:
+            subscriber.close()
+
+    def test_handshake_disabled(self):
+        """without the handshake, init sleeps for post_init_sleep"""
+        self.config['post_init_handshake'] = False
+        self.config['post_init_sleep'] = 0.2
+        with mock.patch('fedmsg.core.time.sleep') as sleep:
+            self.ctx = FedMsgContext(**self.config)
+        sleep.assert_called_once_with(0.2)
+
+
+class TestSharedPublisher(unittest.TestCase):
+    def setUp(self):
+        self.config = load_config()
+        self.config['io_threads'] = 1
+        self.config['post_init_sleep'] = 0
+        self.config['shared_publisher'] = True
+        self.config['name'] = 'unittest2.%s' % socket.gethostname().split('.', 1)[0]
+        self.contexts = []
+
+    def tearDown(self):
+        for ctx in self.contexts:
+            ctx.destroy()
+        for shared in fedmsg.core._shared_publishers.values():
+            shared.close()
+        fedmsg.core._shared_publishers.clear()
+
+    def test_threads_share_one_endpoint(self):
+        """contexts in several threads publish through one PUB socket"""
+        def init():
+            self.contexts.append(FedMsgContext(**copy.deepcopy(self.config)))
+
+        threads = [threading.Thread(target=init) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(self.contexts) == 3
+        shared = fedmsg.core._shared_publishers[os.getpid()]
+        assert all(ctx._shared is shared for ctx in self.contexts)
+        assert all(ctx.publisher.type == zmq.PUSH for ctx in self.contexts)
+
+        endpoint = shared.owner.publisher.getsockopt(zmq.LAST_ENDPOINT)
+        subscriber = shared.context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.SUBSCRIBE, b'')
+        subscriber.connect(endpoint.decode('utf-8').replace('0.0.0.0', '127.0.0.1'))
+        time.sleep(0.2)
+
+        for ctx in self.contexts:
+            ctx.publish(topic='foo', msg={}, modname='bar')
+
+        ids = []
+        while subscriber.poll(1000):
+            _, body = subscriber.recv_multipart()
+            ids.append(json.loads(body.decode('utf-8'))['i'])
+        subscriber.close()
+        assert sorted(ids) == [1, 2, 3]
+
+    def test_active_owner_is_a_pub_socket(self):
+        """the forwarder can't take the relay's subscriptions, so no XPUB"""
+        self.config['active'] = True
+        self.config['name'] = 'relay_inbound'
+        self.config['relay_inbound'] = 'tcp://127.0.0.1:1'
+        self.contexts.append(FedMsgContext(**self.config))
+        shared = fedmsg.core._shared_publishers[os.getpid()]
+        assert shared.owner.publisher.type == zmq.PUB
+
+    def test_closed_with_last_user(self):
+        """the shared publisher goes away with the last context using it"""
+        first = FedMsgContext(**copy.deepcopy(self.config))
+        second = FedMsgContext(**copy.deepcopy(self.config))
+        shared = first._shared
+        assert shared.users == 2
+
+        first.destroy()
+        assert fedmsg.core._shared_publishers[os.getpid()] is shared
+        assert shared.forwarder.is_alive()
+
+        second.destroy()
+        assert os.getpid() not in fedmsg.core._shared_publishers
+        assert not shared.forwarder.is_alive()
+        assert shared.closed
+
+    def test_queued_messages_sent_at_exit(self):
+        """what's still queued goes out when the process exits"""
+        ctx = FedMsgContext(**copy.deepcopy(self.config))
+        self.contexts.append(ctx)
+        endpoint = ctx._shared.owner.publisher.getsockopt(zmq.LAST_ENDPOINT)
+        zmq_context = zmq.Context()
+        subscriber = zmq_context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.SUBSCRIBE, b'')
+        subscriber.connect(endpoint.decode('utf-8').replace('0.0.0.0', '127.0.0.1'))
+        time.sleep(0.2)
+        try:
+            ctx.publish_many([('foo', {'n': n}, 'bar') for n in range(100)])
+            fedmsg.core._close_shared_publishers()
+            received = 0
+            while subscriber.poll(1000):
+                subscriber.recv_multipart()
+                received += 1
+            assert received == 100
+        finally:
+            subscriber.close()
+            zmq_context.term()
@@ -0,0 +1,77 @@
+import unittest
+
+from fedmsg.ratelimit import RateLimiter
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def limiter(self, **settings):
+        settings.setdefault('rate', 1)
+        return RateLimiter({'*.logger.*': settings}, clock=self.clock)
+
+    def admitted(self, limiter, count, topic='a.logger.b'):
+        return sum(limiter.admit(topic) for _ in range(count))
+
+    def test_burst_then_rate(self):
+        limiter = self.limiter(rate=2, burst=5)
+        assert self.admitted(limiter, 10) == 5
+        self.clock.now += 1
+        assert self.admitted(limiter, 10) == 2
+        stats = limiter.stats()['*.logger.*']
+        assert stats['passed'] == 7
+        assert stats['dropped'] == 13
+
+    def test_other_topics_are_not_limited(self):
+        limiter = self.limiter()
+        assert self.admitted(limiter, 10, topic='a.bodhi.b') == 10
+
+    def test_longest_pattern_wins(self):
+        limiter = RateLimiter({
+            '*': {'rate': 1},
+            '*.logger.*': {'rate': 100},
+        }, clock=self.clock)
+        assert self.admitted(limiter, 10) == 10
+        assert self.admitted(limiter, 10, topic='a.bodhi.b') == 1
+
+    def test_sample(self):
+        limiter = self.limiter(burst=1, action='sample', sample=4)
+        assert self.admitted(limiter, 9) == 1 + 2
+        stats = limiter.stats()['*.logger.*']
+        assert stats['sampled'] == 2
+        assert stats['dropped'] == 6
+
+    def test_summarize(self):
+        limiter = self.limiter(burst=1, action='summarize', interval=10)
+        self.admitted(limiter, 3)
+        self.admitted(limiter, 2, topic='a.logger.c')
+        assert limiter.summaries() == []
+
+        self.clock.now += 10
+        summary, = limiter.summaries()
+        assert summary['suppressed'] == {'a.logger.b': 2, 'a.logger.c': 2}
+        assert summary['until'] - summary['since'] == 10
+        assert limiter.summaries(force=True) == []
+        assert limiter.stats()['*.logger.*']['summaries'] == 1
+
+    def test_next_summary(self):
+        limiter = self.limiter(burst=1, action='summarize', interval=10)
+        assert limiter.summarizes()
+        assert limiter.next_summary() is None
+        self.admitted(limiter, 2)
+        assert limiter.next_summary() == self.clock.now + 10
+        limiter.summaries(force=True)
+        assert limiter.next_summary() is None
+        assert not self.limiter().summarizes()
+
+    def test_invalid_action(self):
+        self.assertRaises(ValueError, self.limiter, action='explode')
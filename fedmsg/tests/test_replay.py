@@ -40,7 +40,7 @@ from fedmsg.tests.common import load_config, requires_network
 from fedmsg.replay import ReplayContext, get_replay
 
 from fedmsg.replay.sqlstore import SqlStore, SqlMessage
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 
 hostname = socket.gethostname().split('.', 1)[0]
 local_name = '{0}.{1}'.format(unittest.__name__, hostname)
@@ -178,6 +178,22 @@ class TestSqlStore(unittest.TestCase):
             .filter(SqlMessage.seq_id == 3).one()
         self.assertDictEqual(json.loads(sql_msg.msg), orig_msg)
 
+    def test_add_many(self):
+        orig_msgs = [{
+            "i": i,
+            "topic": "org.foo.bar",
+            "msg_id": "%i-3333-3333-3333-333333333333" % i,
+            "timestamp": 20 + i,
+            "msg": {"foo": "foo"}
+        } for i in (3, 4)]
+        ret = self.store.add_many([dict(m) for m in orig_msgs])
+
+        self.assertEqual([m['seq_id'] for m in ret], [3, 4])
+        session = self.store.session_class()
+        sql_msg = session.query(SqlMessage)\
+            .filter(SqlMessage.seq_id == 4).one()
+        self.assertDictEqual(json.loads(sql_msg.msg), ret[1])
+
     def test_get_seq_id(self):
         first = self.store.get({"seq_id": 1})
         assert len(first) == 1 and first[0]['i'] == 0
@@ -188,6 +204,12 @@ class TestSqlStore(unittest.TestCase):
             (first['i'] == 0 and second['i'] == 1) or
             (first['i'] == 1 and second['i'] == 0))
 
+    def test_get_msg_id_range(self):
+        first, = self.store.get({"msg_id_range": [
+            "11111111-1111-1111-1111-111111111111",
+            "1fffffff-ffff-ffff-ffff-ffffffffffff"]})
+        assert first['i'] == 0
+
     def test_get_wrong_seq_id(self):
         with self.assertRaises(ValueError):
             self.store.get({"seq_id": 18})
@@ -196,6 +218,18 @@ class TestSqlStore(unittest.TestCase):
         with self.assertRaises(ValueError):
             first, second = self.store.get({"time": [0, 15, 3]})
 
+    def test_index_added_to_old_tables(self):
+        """a table created before the msg_id index gets it at init"""
+        engine = create_engine('sqlite:///:memory:')
+        with engine.begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE fedmsg_messages (seq_id INTEGER PRIMARY KEY, "
+                "uuid VARCHAR(36), topic VARCHAR, timestamp DATETIME, msg TEXT)"))
+        SqlStore(engine)
+        SqlStore(engine)
+        indexes = inspect(engine).get_indexes('fedmsg_messages')
+        assert [index['column_names'] for index in indexes] == [['uuid']]
+
 
 class ReplayThread(Thread):
     def __init__(self, context):
@@ -0,0 +1,158 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+# In Python 3 the mock is part of unittest
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+import zmq
+
+import fedmsg.spool
+from fedmsg.core import FedMsgContext
+from fedmsg.spool import Spool, SpoolFlusher
+from fedmsg.tests.common import load_config
+
+
+def _payload(i):
+    return json.dumps({'topic': 'org.test.foo', 'i': i}).encode('utf-8')
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = Spool(self.directory)
+        self.sent = []
+
+    def tearDown(self):
+        self.spool.seal()
+        shutil.rmtree(self.directory)
+
+    def send(self, payloads):
+        self.sent.extend(payloads)
+        return len(payloads)
+
+    def test_drain_sealed_segments(self):
+        """sealed segments are sent in order and removed"""
+        self.spool.append([_payload(1), _payload(2)])
+        self.spool.seal()
+        self.spool.append([_payload(3)])
+        self.spool.seal()
+        assert len(self.spool.segments()) == 2
+
+        assert self.spool.drain(self.send, batch_size=1) == 3
+        assert self.sent == [_payload(1), _payload(2), _payload(3)]
+        assert self.spool.segments() == []
+
+    def test_open_segments_stay(self):
+        """the segment being written is left alone, even by other spools"""
+        self.spool.append([_payload(1)])
+        other = Spool(self.directory)
+        assert other.drain(self.send) == 0
+        assert len(self.spool.segments()) == 1
+
+        self.spool.seal()
+        assert other.drain(self.send) == 1
+
+    def test_partial_send(self):
+        """what couldn't be sent stays for next time"""
+        self.spool.append([_payload(i) for i in range(5)])
+        self.spool.seal()
+        assert self.spool.drain(lambda payloads: 1, batch_size=2) == 1
+        assert self.spool.drain(self.send) == 4
+        assert self.sent == [_payload(i) for i in range(1, 5)]
+
+
+class TestSpoolFlusher(unittest.TestCase):
+    def test_send(self):
+        """spooled messages go out on their own topic until zeromq pushes back"""
+        flusher = SpoolFlusher.__new__(SpoolFlusher)
+        flusher.socket = mock.Mock()
+        flusher.socket.send_multipart.side_effect = [None, zmq.Again()]
+        assert flusher._send([_payload(1), _payload(2), _payload(3)]) == 1
+        frames = flusher.socket.send_multipart.call_args_list[0][0][0]
+        assert frames == [b'org.test.foo', _payload(1)]
+
+
+class TestActiveSpool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = load_config()
+        config['io_threads'] = 1
+        config['active'] = True
+        config['name'] = 'relay_inbound'
+        config['relay_inbound'] = 'tcp://127.0.0.1:1'
+        config['post_init_sleep'] = 0
+        config['spool_directory'] = os.path.join(self.directory, 'spool')
+        self.ctx = FedMsgContext(**config)
+
+    def tearDown(self):
+        self.ctx.destroy()
+        shutil.rmtree(self.directory)
+
+    def test_spool_without_relay(self):
+        """with no relay around, messages go to the spool"""
+        assert self.ctx.publisher.type == zmq.XPUB
+        assert isinstance(self.ctx._flusher, SpoolFlusher)
+        self.ctx.publish(topic='foo', msg={'a': 1}, modname='bar')
+
+        segment, = self.ctx._spool.segments()
+        with open(segment, 'rb') as f:
+            msg = json.loads(f.read().decode('utf-8'))
+        assert msg['msg'] == {'a': 1}
+
+    def test_send_to_relay(self):
+        """once the relay subscribes, messages go out and the spool is sealed"""
+        self.ctx.publish(topic='foo', msg={'a': 1}, modname='bar')
+        self.ctx._subscriptions.add(b'')
+        with mock.patch.object(self.ctx, '_read_subscriptions'), \
+                mock.patch.object(self.ctx, 'publisher') as publisher:
+            self.ctx.publish(topic='foo', msg={'a': 2}, modname='bar')
+        assert publisher.send_multipart.called
+        assert self.ctx._spool._segment is None
+        assert len(self.ctx._spool.segments()) == 1
+
+    def test_destroy_drains(self):
+        """what was spooled goes out on destroy if the relay came back"""
+        self.ctx.publish(topic='foo', msg={'a': 1}, modname='bar')
+        assert len(self.ctx._spool.segments()) == 1
+        publisher = self.ctx.publisher
+        self.ctx._subscriptions.add(b'')
+        with mock.patch.object(self.ctx, '_read_subscriptions'), \
+                mock.patch('fedmsg.spool.send_spooled') as send:
+            send.side_effect = lambda sock, payloads: len(payloads)
+            self.ctx.destroy()
+        assert send.call_args[0][0] is publisher
+        assert len(send.call_args[0][1]) == 1
+        assert self.ctx._spool.segments() == []
+
+    def test_destroy_keeps_segment(self):
+        """without the relay, destroy leaves a sealed segment behind"""
+        self.ctx.publish(topic='foo', msg={'a': 1}, modname='bar')
+        self.ctx.destroy()
+        assert self.ctx._spool._segment is None
+        assert len(self.ctx._spool.segments()) == 1
+
+    def test_fork(self):
+        """a forked child writes a segment of its own"""
+        spool = self.ctx._spool
+        with mock.patch('fedmsg.core._getpid', return_value=-1):
+            self.ctx._check_fork()
+        assert self.ctx._spool is not spool
+        assert self.ctx._spool.directory == spool.directory
+        spool.seal()
+
+
+class TestSpoolModule(unittest.TestCase):
+    def test_inactive(self):
+        """only publishers sending to the relay spool"""
+        config = load_config()
+        config['io_threads'] = 1
+        config['spool_directory'] = '/nonexistent'
+        with mock.patch.object(fedmsg.spool, 'Spool') as spool:
+            ctx = FedMsgContext(**config)
+            ctx.destroy()
+        assert not spool.called
@@ -0,0 +1,135 @@
+import unittest
+# In Python 3 the mock is part of unittest
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+from fedmsg.stats import Histogram, LatencyStats, LossStats, PublishStats
+
+
+class TestHistogram(unittest.TestCase):
+    def test_add(self):
+        histogram = Histogram()
+        histogram.add(0.00005)
+        histogram.add(0.002)
+        histogram.add(10)
+        result = histogram.as_dict()
+        assert result['count'] == 3
+        assert result['max'] == 10
+        counts = dict(result['histogram'])
+        assert counts[0.0001] == 1
+        assert counts[0.005] == 1
+        assert counts[float('inf')] == 1
+
+
+class TestPublishStats(unittest.TestCase):
+    def test_add_message(self):
+        stats = PublishStats()
+        stats.add_message(u'a.b', 10)
+        stats.add_message(u'a.b', 5)
+        stats.add_message(u'a.c', 1)
+        result = stats.as_dict()
+        assert result['messages'] == 3
+        assert result['bytes'] == 16
+        assert result['topics'][u'a.b'] == dict(messages=2, bytes=15)
+
+    def test_time(self):
+        stats = PublishStats()
+        with stats.time('sign'):
+            pass
+        assert stats.as_dict()['stages']['sign']['count'] == 1
+        assert stats.as_dict()['stages']['send']['count'] == 0
+
+    def test_callback(self):
+        callback = mock.Mock()
+        stats = PublishStats(callback=callback, interval=0)
+        stats.add_message(u'a.b', 10)
+        assert callback.call_count == 1
+        assert callback.call_args[0][0]['messages'] == 1
+
+    def test_callback_interval(self):
+        callback = mock.Mock()
+        stats = PublishStats(callback=callback, interval=3600)
+        stats.add_message(u'a.b', 10)
+        assert not callback.called
+
+
+class TestLatencyStats(unittest.TestCase):
+
+    def test_hops(self):
+        stats = LatencyStats()
+        stats.add([['publish', 'a', 0], ['relay', 'b', 2000000],
+                   ['receive', 'c', 1000000]])
+        result = stats.as_dict()
+        assert sorted(result) == ['publish->relay', 'relay->receive']
+        assert result['publish->relay']['total'] == 0.002
+        assert result['relay->receive']['total'] == 0
+
+        stats.reset()
+        assert stats.as_dict() == {}
+
+
+class TestLossStats(unittest.TestCase):
+    def add(self, stats, *ids, **kw):
+        for i in ids:
+            stats.add(kw.get('endpoint', 'ep'), dict(i=i, sender=kw.get('sender', 's')))
+
+    def test_gaps(self):
+        stats = LossStats()
+        self.add(stats, 5, 6, 9, 10)
+        result = stats.as_dict()['ep']
+        assert result['received'] == 4
+        assert result['lost'] == 2
+        assert result['loss_rate'] == 2.0 / 6
+
+    def test_publishers_are_tracked_apart(self):
+        stats = LossStats()
+        self.add(stats, 1, 2, sender='a')
+        self.add(stats, 1, 2, sender='b')
+        assert stats.as_dict()['ep']['lost'] == 0
+
+    def test_interleaved_senders(self):
+        """processes sharing an endpoint and username don't hide each other's gaps"""
+        stats = LossStats()
+        for i in (1, 2, 3, 4):
+            self.add(stats, i, sender='a')
+            if i != 3:
+                self.add(stats, i, sender='b')
+        result = stats.as_dict()['ep']
+        assert result['lost'] == 1
+        assert result['reordered'] == 0
+
+    def test_restart(self):
+        stats = LossStats(window=10)
+        self.add(stats, 100, 101, 1, 2, 150, 120)
+        result = stats.as_dict()['ep']
+        assert result['restarts'] == 2
+        assert result['lost'] == 147
+
+    def test_reordered(self):
+        stats = LossStats()
+        self.add(stats, 1, 3, 2, 4)
+        result = stats.as_dict()['ep']
+        assert result['reordered'] == 1
+        assert result['lost'] == 0
+
+    def test_duplicates(self):
+        """a message seen twice doesn't make up for one that was lost"""
+        stats = LossStats()
+        self.add(stats, 1, 2, 4, 4, 2)
+        result = stats.as_dict()['ep']
+        assert result['received'] == 5
+        assert result['lost'] == 1
+        assert result['reordered'] == 0
+
+    def test_no_sender(self):
+        """streams that can't be told apart aren't tracked"""
+        stats = LossStats()
+        stats.add('ep', {'i': 1, 'username': 'u'})
+        assert stats.as_dict() == {}
+
+    def test_no_counter(self):
+        stats = LossStats()
+        stats.add('ep', {'msg': {}})
+        assert stats.as_dict() == {}
@@ -4,7 +4,23 @@ try:
 except ImportError:
     import unittest
 
-from fedmsg.utils import load_class, dict_query
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import zmq
+# In Python 3 the mock is part of unittest
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+import fedmsg.utils
+from fedmsg.utils import (
+    load_class, dict_query, guess_calling_module, leased_endpoints,
+    set_high_water_mark, ByteBudget, topic_prefixes)
 
 
 class LoadClassTests(unittest.TestCase):
@@ -23,6 +39,287 @@ class LoadClassTests(unittest.TestCase):
             load_class("shelve:ThisIsNotAClass")
 
 
+class GuessCallingModuleTests(unittest.TestCase):
+
+    def _call_from(self, module_name):
+        code = compile("result = guess(default='fedmsg')", module_name, 'exec')
+        namespace = {'__name__': module_name, 'guess': guess_calling_module}
+        exec(code, namespace)
+        return namespace['result'], code
+
+    def test_guess_calling_module(self):
+        result, _ = self._call_from('myapp.controllers.root')
+        self.assertEqual(result, 'myapp')
+
+    def test_guess_calling_module_skips_fedmsg(self):
+        # Our own frames belong to fedmsg.tests, so the first foreign module
+        # is whatever is running the test suite.
+        self.assertNotEqual(guess_calling_module(), 'fedmsg')
+
+    def test_guess_calling_module_caches_by_code(self):
+        result, code = self._call_from('myapp.controllers.root')
+        self.assertEqual(fedmsg.utils._modname_cache[code], 'myapp')
+
+
+class LeasedEndpointsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.endpoints = ['tcp://*:3000', 'tcp://*:3001', 'tcp://*:3002']
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_leases_are_exclusive(self):
+        first, first_lease = next(leased_endpoints(
+            self.directory, 'bodhi.app01', self.endpoints))
+        second, second_lease = next(leased_endpoints(
+            self.directory, 'bodhi.app01', self.endpoints))
+        self.assertNotEqual(first, second)
+        os.close(first_lease)
+        os.close(second_lease)
+
+    def test_starts_at_pid(self):
+        endpoint, lease = next(leased_endpoints(
+            self.directory, 'bodhi.app01', self.endpoints))
+        self.assertEqual(endpoint, self.endpoints[os.getpid() % 3])
+        os.close(lease)
+
+    def test_all_taken(self):
+        leases = [lease for _, lease in leased_endpoints(
+            self.directory, 'bodhi.app01', self.endpoints)]
+        self.assertEqual(len(leases), 3)
+        self.assertEqual(
+            list(leased_endpoints(self.directory, 'bodhi.app01', self.endpoints)), [])
+        for lease in leases:
+            os.close(lease)
+
+
+class ByteBudgetTests(unittest.TestCase):
+
+    def setUp(self):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.PUB)
+
+    def tearDown(self):
+        self.socket.close()
+        self.context.term()
+
+    def test_starts_from_the_initial_size(self):
+        budget = ByteBudget(self.socket, 1024 * 1024)
+        self.assertEqual(budget.hwm, 1024)
+        self.assertEqual(self.socket.getsockopt(zmq.SNDHWM), 1024)
+        self.assertEqual(self.socket.getsockopt(zmq.RCVHWM), 1024)
+
+    def test_follows_the_message_size(self):
+        budget = ByteBudget(self.socket, 1024 * 1024)
+        for _ in range(budget.interval):
+            budget.add(64 * 1024)
+        self.assertEqual(budget.hwm, 16)
+        self.assertEqual(self.socket.getsockopt(zmq.SNDHWM), 16)
+
+        for _ in range(budget.interval * 8):
+            budget.add(256)
+        self.assertTrue(budget.hwm > 3000)
+
+    def test_ignores_small_changes(self):
+        budget = ByteBudget(self.socket, 1024 * 1024)
+        for _ in range(budget.interval):
+            budget.add(1100)
+        self.assertEqual(budget.hwm, 1024)
+
+    def test_set_high_water_mark(self):
+        config = {'high_water_mark': 10}
+        self.assertIsNone(set_high_water_mark(self.socket, config))
+        self.assertEqual(self.socket.getsockopt(zmq.SNDHWM), 10)
+
+        config['high_water_mark_bytes'] = 4096
+        budget = set_high_water_mark(self.socket, config)
+        self.assertIsInstance(budget, ByteBudget)
+        self.assertEqual(self.socket.getsockopt(zmq.SNDHWM), 4)
+
+
+class TimeOrderedUUIDTests(unittest.TestCase):
+
+    def setUp(self):
+        fedmsg.utils._last_uuid[:] = [0, 0]
+
+    def test_version_and_time(self):
+        value = uuid.UUID(fedmsg.utils.time_ordered_uuid(1500000000.123))
+        self.assertEqual(value.version, 7)
+        self.assertEqual(value.variant, uuid.RFC_4122)
+        self.assertEqual(value.int >> 80, 1500000000123)
+
+    def test_clock_going_back(self):
+        later = fedmsg.utils.time_ordered_uuid(time.time() + 60)
+        self.assertTrue(fedmsg.utils.time_ordered_uuid() > later)
+
+
+class SubscriptionEndpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {
+            'endpoints': {
+                'bodhi.app01': ['tcp://localhost:3000', 'tcp://localhost:3001'],
+                'koji.builder01': 'tcp://builder01.example.com:3000',
+            },
+            'ipc_endpoints': {
+                'bodhi.app01': ['ipc:///tmp/bodhi.app01-3000'],
+                'koji.builder01': 'ipc:///tmp/koji.builder01-3000',
+            },
+        }
+
+    def test_is_local_host(self):
+        self.assertTrue(fedmsg.utils.is_local_host('localhost'))
+        self.assertTrue(fedmsg.utils.is_local_host('127.0.0.1'))
+        self.assertFalse(fedmsg.utils.is_local_host('host.invalid'))
+
+    def test_ipc_endpoint(self):
+        self.assertEqual(
+            fedmsg.utils.ipc_endpoint(
+                self.config, 'bodhi.app01', 'tcp://localhost:3000'),
+            'ipc:///tmp/bodhi.app01-3000')
+        self.assertIsNone(fedmsg.utils.ipc_endpoint(
+            self.config, 'bodhi.app01', 'tcp://localhost:3001'))
+        self.assertIsNone(fedmsg.utils.ipc_endpoint(
+            self.config, 'fas.app01', 'tcp://localhost:3001'))
+
+    @mock.patch('socket.gethostname', return_value='me.example.com')
+    @mock.patch('socket.gethostbyname_ex')
+    def test_is_local_host_addresses(self, lookup, gethostname):
+        """ What resolve_hostnames found isn't looked up again. """
+        addresses = {
+            'me.example.com': ['10.0.0.5'],
+            'alias.example.com': ['10.0.0.5'],
+            'other.example.com': ['10.0.0.6'],
+        }
+        self.assertTrue(fedmsg.utils.is_local_host('alias.example.com', addresses))
+        self.assertFalse(fedmsg.utils.is_local_host('other.example.com', addresses))
+        self.assertFalse(lookup.called)
+        self.assertNotIn('alias.example.com', fedmsg.utils._local_hosts)
+
+    @mock.patch('socket.gethostname', return_value='me.example.com')
+    @mock.patch('socket.gethostbyname_ex')
+    def test_subscription_endpoints(self, lookup, gethostname):
+        with mock.patch('fedmsg.utils.resolve_hostnames') as resolve:
+            resolve.return_value = {
+                'me.example.com': ['10.0.0.5'],
+                'builder01.example.com': ['10.0.0.6'],
+            }
+            self.assertEqual(
+                sorted(fedmsg.utils.subscription_endpoints(self.config)), [
+                    'ipc:///tmp/bodhi.app01-3000',
+                    'tcp://builder01.example.com:3000',
+                    'tcp://localhost:3001',
+                ])
+        resolve.assert_called_once_with(
+            set(['builder01.example.com', 'me.example.com']), self.config)
+        self.assertFalse(lookup.called)
+
+
+class ResolveHostnamesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = {
+            'dns_cache': os.path.join(self.directory, 'dns.json'),
+            'dns_cache_expiry': 300,
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _resolve(self, hostnames):
+        def gethostbyname_ex(hostname):
+            if not hostname.endswith('.com'):
+                raise fedmsg.utils.socket.gaierror()
+            return (hostname, [], ['10.0.0.1'])
+
+        with mock.patch('socket.gethostbyname_ex') as lookup:
+            lookup.side_effect = gethostbyname_ex
+            result = fedmsg.utils.resolve_hostnames(hostnames, self.config)
+        return result, sorted(call[0][0] for call in lookup.call_args_list)
+
+    def test_resolve(self):
+        result, looked_up = self._resolve(['a.example.com', 'b.invalid'])
+        self.assertEqual(result, {'a.example.com': ['10.0.0.1'], 'b.invalid': []})
+        self.assertEqual(looked_up, ['a.example.com', 'b.invalid'])
+
+    def test_cached(self):
+        """ Good and bad answers both come from the cache next time. """
+        self._resolve(['a.example.com', 'b.invalid'])
+        result, looked_up = self._resolve(['a.example.com', 'b.invalid', 'c.com'])
+        self.assertEqual(sorted(h for h in result if result[h]), ['a.example.com', 'c.com'])
+        self.assertEqual(looked_up, ['c.com'])
+
+    def test_expired(self):
+        self._resolve(['a.example.com'])
+        with mock.patch('time.time', return_value=time.time() + 301):
+            _, looked_up = self._resolve(['a.example.com'])
+        self.assertEqual(looked_up, ['a.example.com'])
+
+    def test_no_cache(self):
+        self.config['dns_cache'] = None
+        self._resolve(['a.example.com'])
+        _, looked_up = self._resolve(['a.example.com'])
+        self.assertEqual(looked_up, ['a.example.com'])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_broken_cache(self):
+        with open(self.config['dns_cache'], 'w') as f:
+            f.write('{not json')
+        result, _ = self._resolve(['a.example.com'])
+        self.assertEqual(result, {'a.example.com': ['10.0.0.1']})
+
+
+class TopicPrefixesTests(unittest.TestCase):
+
+    def test_anchored(self):
+        self.assertEqual(
+            topic_prefixes(r'^org\.fedoraproject\.prod\.bodhi\.'),
+            ['org.fedoraproject.prod.bodhi.'])
+        self.assertEqual(
+            topic_prefixes(r'^org\.fedoraproject\.prod\.(bodhi|koji)\.'),
+            ['org.fedoraproject.prod.bodhi.', 'org.fedoraproject.prod.koji.'])
+        self.assertEqual(
+            topic_prefixes(r'^org\.fp\.(?:prod|stg)\.|^com\.example'),
+            ['com.example', 'org.fp.prod.', 'org.fp.stg.'])
+
+    def test_after_groups(self):
+        self.assertEqual(
+            topic_prefixes(r'^org\.(fp|fo)\.(bodhi|koji)\.update'),
+            ['org.fo.bodhi.update', 'org.fo.koji.update',
+             'org.fp.bodhi.update', 'org.fp.koji.update'])
+        self.assertEqual(
+            topic_prefixes(r'^org\.(fp|f.o)\.koji'), ['org.f'])
+        self.assertEqual(topic_prefixes(r'^org\.(fp)+\.koji'), ['org.fp'])
+
+    def test_unbalanced_group(self):
+        self.assertEqual(topic_prefixes(r'^(?:abc'), [''])
+        self.assertEqual(topic_prefixes(r'^org\.(abc'), ['org.'])
+
+    def test_stops_at_special_characters(self):
+        self.assertEqual(topic_prefixes(r'^org\.fp\.pro?d'), ['org.fp.pr'])
+        self.assertEqual(topic_prefixes(r'^org\.[a-z]+\.prod'), ['org.'])
+        self.assertEqual(topic_prefixes(r'^org\d'), ['org'])
+        self.assertEqual(topic_prefixes(r'^(org)?\.fp'), [''])
+
+    def test_unanchored(self):
+        self.assertEqual(topic_prefixes('_heartbeat'), [''])
+        self.assertEqual(topic_prefixes('^((?!_heartbeat).)*$'), [''])
+        self.assertEqual(topic_prefixes(r'^org\.fp|koji'), [''])
+
+    def test_topics(self):
+        self.assertEqual(
+            topic_prefixes(r'^org\.fp\.prod\.bodhi', ['org.fp.prod', 'org.fp.stg']),
+            ['org.fp.prod.bodhi'])
+        self.assertEqual(
+            topic_prefixes(r'^org\.fp\.(prod|stg)', ['org.fp.prod.bodhi']),
+            ['org.fp.prod.bodhi'])
+        self.assertEqual(topic_prefixes('_heartbeat', ['a', 'b']), ['a', 'b'])
+        self.assertEqual(topic_prefixes('_heartbeat', None), [''])
+
+
 class DictQueryTests(unittest.TestCase):
 
     def test_dict_query_basic(self):
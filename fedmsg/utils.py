@@ -20,8 +20,19 @@
 
 import six
 import zmq
+import binascii
 import inspect
+import json
+import os
+import socket
 import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from kitchen.iterutils import iterate
+from multiprocessing.pool import ThreadPool
 
 try:
     from collections import OrderedDict
@@ -29,13 +40,66 @@ except ImportError:
     from ordereddict import OrderedDict
 
 
+class ByteBudget(object):
+    """ Keep the queues of a zmq socket to about ``budget`` bytes.
+
+    zeromq only counts messages, so this follows the average size of the
+    messages going through the socket and sets the high water mark to the
+    number of such messages that fit in the budget.  Call :meth:`add` with
+    the size of every message sent or received.
+    """
+
+    #: The message size to assume until we've seen some.
+    initial_size = 1024
+    #: How many messages to see between two looks at the high water mark.
+    interval = 64
+
+    def __init__(self, socket, budget, options=None):
+        self.socket = socket
+        self.budget = budget
+        self.options = options or (zmq.SNDHWM, zmq.RCVHWM)
+        self.average = float(self.initial_size)
+        self.count = 0
+        self.hwm = None
+        self._apply()
+
+    def add(self, size):
+        """ Account for a message of ``size`` bytes. """
+        self.count += 1
+        # A moving average that starts out as a plain one, so that the first
+        # few messages don't have to fight the initial guess.
+        self.average += (size - self.average) / min(self.count, self.interval)
+        if self.count % self.interval == 0:
+            self._apply()
+
+    def _apply(self):
+        hwm = max(1, int(self.budget // max(self.average, 1)))
+        # Small changes aren't worth a trip to the socket options.
+        if self.hwm is not None and abs(hwm - self.hwm) * 4 <= self.hwm:
+            return
+        for option in self.options:
+            self.socket.setsockopt(option, hwm)
+        self.hwm = hwm
+
+
 def set_high_water_mark(socket, config):
     """ Set a high water mark on the zmq socket.  Do so in a way that is
     cross-compatible with zeromq2 and zeromq3.
+
+    With a ``high_water_mark_bytes`` budget in ``config``, the high water
+    mark follows the size of the messages and the :class:`ByteBudget` doing
+    so is returned; otherwise this returns ``None``.
     """
 
+    # Recent pyzmq defines zmq.HWM whatever the version of libzmq, so ask
+    # libzmq itself.
+    zeromq2 = zmq.zmq_version().startswith("2.")
+
+    if config.get('high_water_mark_bytes') and not zeromq2:
+        return ByteBudget(socket, config['high_water_mark_bytes'])
+
     if config['high_water_mark']:
-        if hasattr(zmq, 'HWM'):
+        if zeromq2:
             # zeromq2
             socket.setsockopt(zmq.HWM, config['high_water_mark'])
         else:
@@ -44,18 +108,273 @@ def set_high_water_mark(socket, config):
             socket.setsockopt(zmq.RCVHWM, config['high_water_mark'])
 
 
+# The millisecond and counter of the last time-ordered UUID, so that two of
+# them made within a millisecond still sort in the order they were made.
+_last_uuid = [0, 0]
+_last_uuid_lock = threading.Lock()
+
+
+def time_ordered_uuid(now=None):
+    """ Return a version 7 UUID, as a string, made at ``now``.
+
+    Its first 48 bits are the time in milliseconds and the next 12 count the
+    UUIDs made within that millisecond, so the ones made by a process sort
+    in the order they were made, both as UUIDs and as strings.  The
+    remaining 62 bits are random, to set apart those of different processes.
+    """
+    ms = int((time.time() if now is None else now) * 1000)
+    with _last_uuid_lock:
+        last_ms, counter = _last_uuid
+        if ms > last_ms:
+            counter = 0
+        else:
+            # Same millisecond, or the clock went back: keep counting.
+            ms, counter = last_ms, counter + 1
+            if counter > 0xfff:
+                ms, counter = ms + 1, 0
+        _last_uuid[:] = [ms, counter]
+
+    rand = int(binascii.hexlify(os.urandom(8)), 16) & ((1 << 62) - 1)
+    value = (ms & ((1 << 48) - 1)) << 80 | 0x7 << 76 | counter << 64 | \
+        0x2 << 62 | rand
+    return str(uuid.UUID(int=value))
+
+
+# A map of code objects to the top-level name of the module that owns them.
+# Every code object belongs to exactly one module, so once we've seen a call
+# site we never need to look at its globals again.  Code compiled on the fly
+# (exec, templates) would make this grow forever, so it is capped.
+_modname_cache = {}
+_modname_cache_size = 4096
+
+
 # TODO -- this should be in kitchen, not fedmsg
 def guess_calling_module(default=None):
+    """ Return the top-level name of the first non-fedmsg module on the stack.
+
+    This walks raw frame objects with :func:`sys._getframe` rather than using
+    :func:`inspect.stack`, which builds full frame records and reads source
+    lines for every frame.  Results are cached by code object, so repeated
+    calls from the same call site cost a handful of dict lookups.
+    """
+    getframe = getattr(sys, '_getframe', None)
+    if getframe is None:
+        # Not every interpreter provides frame objects this way.
+        for frame in (f[0] for f in inspect.stack()):
+            modname = frame.f_globals['__name__'].split('.')[0]
+            if modname != "fedmsg":
+                return modname
+        return default
+
     # Iterate up the call-stack and return the first new top-level module
-    for frame in (f[0] for f in inspect.stack()):
-        modname = frame.f_globals['__name__'].split('.')[0]
+    frame = getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        modname = _modname_cache.get(code)
+        if modname is None:
+            modname = frame.f_globals.get('__name__', '').split('.')[0]
+            if len(_modname_cache) >= _modname_cache_size:
+                _modname_cache.clear()
+            _modname_cache[code] = modname
         if modname != "fedmsg":
             return modname
+        frame = frame.f_back
 
     # Otherwise, give up and just return the default.
     return default
 
 
+def leased_endpoints(directory, name, endpoints):
+    """ Yield ``(endpoint, lease)`` for the endpoints we can claim.
+
+    Each endpoint of ``name`` has a lock file in ``directory``.  An endpoint is
+    only yielded once we hold an exclusive, non-blocking :func:`fcntl.flock`
+    on its file; ``lease`` is the open file descriptor holding that lock.
+    Close it to give the endpoint back.  The kernel releases the lock when
+    the process dies, so a crashed worker never leaks its endpoint.
+
+    The search starts at an index derived from our pid, so the workers of a
+    prefork server usually find a free endpoint on their first try instead of
+    every one of them walking the list from the top.
+    """
+    import fcntl
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    count = len(endpoints)
+    start = os.getpid() % count
+    for offset in range(count):
+        index = (start + offset) % count
+        path = os.path.join(directory, "%s.%i.lock" % (
+            name.replace(os.path.sep, '_'), index))
+        lease = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            # Somebody else has this one.
+            os.close(lease)
+            continue
+        yield endpoints[index], lease
+
+
+# Whether a hostname is this host, by hostname.
+_local_hosts = {}
+
+
+def is_local_host(hostname, addresses=None):
+    """ Return whether ``hostname`` names this host.
+
+    That is, whether it resolves to a loopback address or to an address of
+    our own hostname.  ``addresses`` maps hostnames to their addresses, as
+    :func:`resolve_hostnames` returns them, so that ``hostname`` and our own
+    hostname aren't looked up again if they are in there.  Without it,
+    answers are cached for the life of the process.
+    """
+    if hostname in ('*', 'localhost'):
+        return True
+
+    if addresses is None:
+        try:
+            return _local_hosts[hostname]
+        except KeyError:
+            pass
+
+    def lookup(name):
+        if addresses is not None and name in addresses:
+            return addresses[name]
+        return _addresses(name)
+
+    own = lookup(socket.gethostname())
+    result = any(
+        address.startswith('127.') or address in own
+        for address in lookup(hostname))
+
+    if addresses is None:
+        _local_hosts[hostname] = result
+    return result
+
+
+def ipc_endpoint(config, name, endpoint):
+    """ Return the ``ipc://`` twin of ``endpoint``, one of the endpoints of
+    ``name``, if it has one; see :ref:`conf-ipc-endpoints`.
+    """
+    twins = list(iterate(config.get('ipc_endpoints', {}).get(name, [])))
+    endpoints = list(iterate(config['endpoints'].get(name, [])))
+    if endpoint not in endpoints or endpoints.index(endpoint) >= len(twins):
+        return None
+    return twins[endpoints.index(endpoint)]
+
+
+def _tcp_host(endpoint):
+    """ Return the host of a ``tcp://`` endpoint, ``None`` for others. """
+    if not endpoint.startswith('tcp://'):
+        return None
+    return endpoint[len('tcp://'):].rsplit(':', 1)[0]
+
+
+def subscription_endpoint(config, name, endpoint, addresses=None):
+    """ Return what to connect to to subscribe to ``endpoint`` of ``name``.
+
+    That's its ``ipc://`` twin if the publisher is on this host, and
+    ``endpoint`` itself otherwise.  ``addresses`` is passed on to
+    :func:`is_local_host`.
+    """
+    twin = ipc_endpoint(config, name, endpoint)
+    host = _tcp_host(endpoint)
+    if twin and host and is_local_host(host, addresses):
+        return twin
+    return endpoint
+
+
+def subscription_endpoints(config):
+    """ Return the endpoints to subscribe to for all of ``endpoints``, as
+    :func:`subscription_endpoint` sees them.
+    """
+    endpoints = [
+        (name, endpoint)
+        for name, endpoints in config['endpoints'].items()
+        for endpoint in iterate(endpoints)
+    ]
+
+    # Look up the hosts of the endpoints with ipc:// twins all at once.
+    hostnames = set(
+        _tcp_host(endpoint) for name, endpoint in endpoints
+        if ipc_endpoint(config, name, endpoint)) - set([None, '*', 'localhost'])
+    addresses = None
+    if hostnames:
+        hostnames.add(socket.gethostname())
+        addresses = resolve_hostnames(hostnames, config)
+
+    return [
+        subscription_endpoint(config, name, endpoint, addresses)
+        for name, endpoint in endpoints
+    ]
+
+
+def _addresses(hostname):
+    try:
+        return socket.gethostbyname_ex(hostname)[2]
+    except (socket.error, UnicodeError):
+        return []
+
+
+def _load_dns_cache(path):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _save_dns_cache(path, cache):
+    # Write elsewhere and rename, so that readers never see half a file.
+    tmp = '%s.%i.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        # The cache is a nicety.  Not having it just makes us slower.
+        pass
+
+
+def resolve_hostnames(hostnames, config):
+    """ Return a dict mapping each of ``hostnames`` to its IPv4 addresses,
+    an empty list for those that don't resolve.
+
+    The lookups run concurrently, so this takes about as long as the slowest
+    of them.  Answers, good and bad, are kept in the :ref:`conf-dns-cache`
+    file, if there is one, for :ref:`conf-dns-cache-expiry` seconds.
+    """
+    path = config.get('dns_cache', None)
+    expiry = config.get('dns_cache_expiry', 300)
+    now = time.time()
+
+    cache = _load_dns_cache(path) if path else {}
+    # Forget what has expired, so that the file doesn't grow forever.
+    cache = dict(
+        (hostname, entry) for hostname, entry in cache.items()
+        if isinstance(entry, list) and len(entry) == 2 and entry[0] > now and
+        isinstance(entry[1], list))
+
+    missing = [hostname for hostname in set(hostnames) if hostname not in cache]
+    if missing:
+        pool = ThreadPool(min(len(missing), 32))
+        try:
+            answers = pool.map(_addresses, missing)
+        finally:
+            pool.close()
+            pool.join()
+        for hostname, addresses in zip(missing, answers):
+            cache[hostname] = [now + expiry, addresses]
+        if path:
+            _save_dns_cache(path, cache)
+
+    return dict((hostname, cache[hostname][1]) for hostname in hostnames)
+
+
 def set_tcp_keepalive(socket, config):
     """ Set a series of TCP keepalive options on the socket if
     and only if
@@ -136,6 +455,169 @@ def load_class(location):
         raise ImportError("%r not found in %r" % (cls_name, mod_name))
 
 
+def _class_end(pattern, i):
+    """ Return the index of the ``]`` closing the class opened at ``i``. """
+    j = i + 1
+    if pattern[j:j + 1] == '^':
+        j += 1
+    if pattern[j:j + 1] == ']':
+        j += 1
+    while j < len(pattern):
+        if pattern[j] == '\\':
+            j += 2
+            continue
+        if pattern[j] == ']':
+            return j
+        j += 1
+    return None
+
+
+def _split_regexp(pattern):
+    """ Split ``pattern`` on its top-level ``|``. """
+    pieces, depth, start, i = [], 0, 0, 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 1
+        elif c == '[':
+            i = _class_end(pattern, i)
+            if i is None:
+                return None
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            pieces.append(pattern[start:i])
+            start = i + 1
+        i += 1
+    pieces.append(pattern[start:])
+    return pieces
+
+
+def _group_end(pattern, i):
+    """ Return the index of the ``)`` closing the group opened at ``i``. """
+    depth = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 1
+        elif c == '[':
+            i = _class_end(pattern, i)
+            if i is None:
+                return None
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return None
+
+
+def _literal(pattern):
+    """ Return the text ``pattern`` matches if it is plain text, or ``None``.
+    """
+    text, i = '', 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            text, i = text + pattern[i + 1], i + 2
+        elif c in '\\.^$*+?{}[]|()':
+            return None
+        else:
+            text, i = text + c, i + 1
+    return text
+
+
+def _regexp_prefixes(pattern, anchored):
+    """ Return strings one of which every match of ``pattern`` starts with.
+
+    ``''`` stands for "anything".  Only matches at the start count, so
+    unless ``anchored``, every alternative must start with ``^``.
+    """
+    pieces = _split_regexp(pattern)
+    if pieces is None:
+        return ['']
+
+    prefixes = []
+    for piece in pieces:
+        if not anchored:
+            if not piece.startswith('^'):
+                return ['']
+            piece = piece[1:]
+
+        prefix, i = '', 0
+        while i < len(piece):
+            c = piece[i]
+            if c == '(':
+                end = _group_end(piece, i)
+                if end is None:
+                    break
+                inner = piece[i + 1:end]
+                if inner.startswith('?:'):
+                    inner = inner[2:]
+                elif inner.startswith('?'):
+                    # Lookarounds, flags and named groups too.
+                    break
+                after = piece[end + 1:end + 2]
+                if after in ('?', '*', '{'):
+                    break
+
+                alternatives = _split_regexp(inner) or [None]
+                literals = [_literal(a) for a in alternatives if a is not None]
+                if after != '+' and len(literals) == len(alternatives) and \
+                        None not in literals:
+                    # Whole words: what follows the group follows them.
+                    rest = _regexp_prefixes(piece[end + 1:], True)
+                    prefix = [prefix + p + r for p in literals for r in rest]
+                else:
+                    prefix = [prefix + p for p in _regexp_prefixes(inner, True)]
+                break
+            elif c == '\\' and i + 1 < len(piece) and not piece[i + 1].isalnum():
+                char, width = piece[i + 1], 2
+            elif c in '\\.^$*+?{}[]|)':
+                break
+            else:
+                char, width = c, 1
+
+            # An optional character may not be there.
+            if piece[i + width:i + width + 1] in ('?', '*', '{'):
+                break
+            prefix += char
+            i += width
+
+        prefixes.extend(prefix if isinstance(prefix, list) else [prefix])
+    return prefixes
+
+
+def topic_prefixes(regexp, topics=('',)):
+    """ Return the topic prefixes to subscribe to for the topics that start
+    with one of ``topics`` and match ``regexp``.
+
+    Only what ``regexp`` anchors at the start of a topic narrows things
+    down.  ``'^org\\.fedoraproject\\.prod\\.(bodhi|koji)\\.'`` makes
+    ``['org.fedoraproject.prod.bodhi.', 'org.fedoraproject.prod.koji.']``,
+    but ``'_heartbeat'`` leaves ``topics`` as they are.
+    """
+    topics = [topic for topic in iterate(topics) if topic is not None] or ['']
+    prefixes = _regexp_prefixes(regexp, False)
+
+    result = set()
+    for topic in topics:
+        for prefix in prefixes:
+            if prefix.startswith(topic):
+                result.add(prefix)
+            elif topic.startswith(prefix):
+                result.add(topic)
+    # Prefixes that have a shorter one in there already add nothing.
+    return sorted(
+        prefix for prefix in result
+        if not any(prefix != other and prefix.startswith(other)
+                   for other in result)) or topics
+
+
 def dict_query(dic, query):
     """ Query a dict with 'dotted notation'.  Returns an OrderedDict.
 